@@ -0,0 +1,374 @@
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+from contextlib import contextmanager, redirect_stdout
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(BASE_DIR, 'benchmark_results')
+DOC_COUNTS = [100, 1000, 10000]
+DOC_LENGTH = 300        # средняя длина документа в словах
+VOCAB_SIZE = 50000
+ZIPF_EXPONENT = 1.1
+TEXT_SAMPLE = 200       # документов для стадий HTML -> текст -> токены -> леммы
+QUERIES = 200
+TOP_K = 10
+REGRESSION_THRESHOLD = 0.10
+
+# Бенчмарк всех стадий на синтетическом корпусе. Слова - псевдорусские
+# основы с падежными окончаниями, частоты - по закону Ципфа. Каждый размер
+# корпуса прогоняется в отдельном процессе, поэтому пиковый RSS относится
+# только к нему. Стадии разбора HTML и лемматизации идут на выборке
+# документов (их время линейно по числу документов), TF-IDF, индексы и
+# запросы - на всем корпусе.
+#
+#   python benchmark.py --docs 100 1000 10000      -> benchmark_results/*.json
+#   python benchmark.py --compare old.json new.json
+
+SYLLABLES = ['ка', 'ро', 'ли', 'на', 'те', 'му', 'за', 'ви', 'до', 'се', 'пе', 'лу',
+             'би', 'го', 'ра', 'ны', 'ко', 'ста', 'про', 'мен', 'тор', 'вер']
+ENDINGS = ['', 'а', 'ы', 'ов', 'ами', 'ой', 'е', 'ом']
+
+
+def make_vocabulary(size, rng):
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(SYLLABLES, rng.integers(2, 6))))
+    return sorted(words)
+
+
+def zipf_sampler(size, exponent, rng):
+    weights = 1.0 / np.arange(1, size + 1) ** exponent
+    cdf = np.cumsum(weights / weights.sum())
+    return lambda n: np.minimum(np.searchsorted(cdf, rng.random(n)), size - 1)
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдает килобайты, macOS - байты
+    return round(peak / (1 << 20 if sys.platform == 'darwin' else 1 << 10), 1)
+
+
+@contextmanager
+def stage(results, name, items=None):
+    """Время стадии и прирост пикового RSS за нее; ошибка записывается, а прогон
+    продолжается.
+
+    ru_maxrss - максимум за всю жизнь процесса, поэтому rss_growth_mb - на
+    сколько стадия подняла этот максимум: 0, если ей хватило памяти, уже
+    занятой более ранними стадиями (ее собственный пик тогда не виден).
+    """
+    rss_before = peak_rss_mb()
+    start = time.perf_counter()
+    entry = results[name] = {}
+    try:
+        yield entry
+    except Exception as e:
+        entry['error'] = f"{type(e).__name__}: {e}"
+    seconds = time.perf_counter() - start
+    entry.update(seconds=round(seconds, 6), rss_growth_mb=round(peak_rss_mb() - rss_before, 1))
+    if items:
+        entry.update(items=items, per_item_ms=round(seconds * 1000 / items, 4))
+
+
+def latency(search, queries, warmup=10):
+    for query in queries[:warmup]:
+        search(query)
+    timings = np.empty(len(queries))
+    for i, query in enumerate(queries):
+        start = time.perf_counter()
+        search(query)
+        timings[i] = time.perf_counter() - start
+    timings *= 1000
+    return {
+        'queries': len(queries),
+        'p50_ms': round(float(np.percentile(timings, 50)), 4),
+        'p99_ms': round(float(np.percentile(timings, 99)), 4),
+        'mean_ms': round(float(timings.mean()), 4),
+        'qps': round(len(queries) / (timings.sum() / 1000), 1),
+    }
+
+
+def write_html(path, words):
+    # та же разметка, что у страниц Хабра: шум вокруг div.tm-article-body
+    paragraphs = ''.join(f"<p>{' '.join(words[i:i + 40])}</p>" for i in range(0, len(words), 40))
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("<html><head><title>Статья</title><script>var x = 1;</script></head><body>"
+                "<header><nav>Главная Лента</nav></header>"
+                f"<div class=\"tm-article-body\">{paragraphs}<pre><code>print(1)</code></pre></div>"
+                "<footer>Подвал</footer></body></html>")
+
+
+def run_text_stages(results, docs, workdir):
+    """HTML -> текст -> токены -> леммы на выборке документов"""
+    import lemma_token_extractor as extractor
+    from dedup import SignatureIndex, simhash
+
+    pages_dir = os.path.join(workdir, 'pages')
+    os.makedirs(pages_dir)
+    paths = []
+    for i, words in enumerate(docs, 1):
+        paths.append(os.path.join(pages_dir, f'page_{i}.html'))
+        write_html(paths[-1], words)
+
+    texts, token_lists = [], []
+    with stage(results, 'extract_text_from_html', len(paths)):
+        texts = [extractor.extract_text_from_html(path) for path in paths]
+    with stage(results, 'simhash', len(texts)):
+        signatures = SignatureIndex()
+        for i, text in enumerate(texts):
+            signatures.add(i, simhash(text))
+    with stage(results, 'init_analyzers'):
+        extractor.init_analyzers()
+    with stage(results, 'clean_and_tokenize', len(texts)):
+        token_lists = [extractor.clean_and_tokenize(text) for text in texts]
+    with stage(results, 'lemmatize_tokens', len(token_lists)):
+        for tokens in token_lists:
+            extractor.lemmatize_tokens(tokens)
+
+
+def run_corpus(n_docs, config):
+    """Прогон одного размера корпуса (в отдельном процессе)"""
+    from collections import defaultdict
+
+    import tf_idf_extractor
+    import inverted_index
+    from index_store import compile_vector_index, open_index
+    from doc_store import DocStoreWriter, make_snippet, open_doc_store
+    from lsa import build_lsa_index
+    sys.path.insert(0, os.path.join(BASE_DIR, 'demo'))
+    from search_engine import VectorSearchEngine
+
+    rng = np.random.default_rng(config['seed'])
+    stages = {}
+    workdir = tempfile.mkdtemp(prefix=f'bench_{n_docs}_', dir=config['workdir'])
+    try:
+        with stage(stages, 'generate_corpus', n_docs):
+            vocabulary = np.array(make_vocabulary(config['vocab'], rng), dtype=object)
+            sample = zipf_sampler(len(vocabulary), config['zipf'], rng)
+            lengths = np.maximum(rng.poisson(config['doc_length'], n_docs), 10)
+
+            # те же структуры, что строит pipeline.run_pipeline
+            token_index = defaultdict(list)
+            lemma_index = defaultdict(list)
+            token_stats = defaultdict(dict)
+            lemma_stats = defaultdict(dict)
+            doc_lemmas = {}
+            text_docs = []
+            for i, length in enumerate(lengths, 1):
+                doc_id = f'page_{i}'
+                ids, counts = np.unique(sample(length), return_counts=True)
+                lemmas = vocabulary[ids]
+                for lemma, count in zip(lemmas, counts):
+                    token_index[lemma].append(doc_id)
+                    token_stats[doc_id][lemma] = 1
+                    lemma_index[f"{lemma}:"].append(doc_id)
+                    lemma_stats[doc_id][f"{lemma}:"] = int(count)
+                doc_lemmas[doc_id] = list(lemmas)
+                if len(text_docs) < config['text_sample']:
+                    endings = rng.choice(ENDINGS, length)
+                    text_docs.append([vocabulary[j] + e for j, e in zip(sample(length), endings)])
+            data = (token_index, lemma_index, token_stats, lemma_stats, set(doc_lemmas))
+
+        run_text_stages(stages, text_docs, workdir)
+
+        # выходные каталоги модулей перенаправляются во временную папку
+        tfidf_dir = os.path.join(workdir, 'tfidf')
+        tf_idf_extractor.TOKENS_OUTPUT = os.path.join(tfidf_dir, 'tokens')
+        tf_idf_extractor.LEMMAS_OUTPUT = os.path.join(tfidf_dir, 'lemmas')
+        os.makedirs(tf_idf_extractor.TOKENS_OUTPUT)
+        os.makedirs(tf_idf_extractor.LEMMAS_OUTPUT)
+        inverted_index.INDEX_FOLDER = os.path.join(workdir, 'inverted_index')
+        index_file = os.path.join(workdir, 'index.txt')
+        with open(index_file, 'w', encoding='utf-8') as f:
+            f.writelines(f"{i}\thttps://example.com/{i}/\n" for i in range(1, n_docs + 1))
+        compiled_dir = os.path.join(workdir, 'compiled')
+
+        with stage(stages, 'compute_tfidf', n_docs):
+            tf_idf_extractor.compute_tfidf(data)
+        with stage(stages, 'build_index', n_docs), redirect_stdout(io.StringIO()):
+            inverted_index.build_index_from_documents(
+                (doc_id, doc_lemmas[doc_id]) for doc_id in sorted(doc_lemmas))
+        with stage(stages, 'compile_vector_index', n_docs):
+            compile_vector_index(tf_idf_extractor.LEMMAS_OUTPUT, index_file, compiled_dir)
+        # текст документа для хранилища - его леммы через пробел
+        store_dir = os.path.join(workdir, 'doc_store')
+        with stage(stages, 'doc_store', n_docs), DocStoreWriter(store_dir) as store:
+            for doc_id, lemmas in doc_lemmas.items():
+                store.add(doc_id, ' '.join(lemmas))
+        lsa_dir = os.path.join(workdir, 'lsa')
+        with stage(stages, 'build_lsa', n_docs):
+            build_lsa_index(compiled_dir, lsa_dir)
+        del data, token_index, lemma_index, token_stats, lemma_stats, doc_lemmas
+
+        # слова запросов - уже леммы, поэтому анализатор запросов не нужен
+        with stage(stages, 'load_vector_text'):
+            VectorSearchEngine(tf_idf_extractor.LEMMAS_OUTPUT, index_file, analyzer=False)
+        with stage(stages, 'load_vector_compiled'):
+            engine = VectorSearchEngine(tf_idf_extractor.LEMMAS_OUTPUT, index_file,
+                                        compiled_dir, analyzer=False, lsa_dir=lsa_dir)
+        # тот же индекс без отсечения - для сравнения с полным перебором
+        full_engine = VectorSearchEngine(tf_idf_extractor.LEMMAS_OUTPUT, index_file,
+                                         compiled_dir, analyzer=False, pruning=False)
+        with stage(stages, 'load_boolean'):
+            index = open_index(inverted_index.INDEX_FOLDER)
+        doc_store = open_doc_store(store_dir)
+
+        words = vocabulary[sample(3 * config['queries'])].reshape(-1, 3)
+        vector_queries = [' '.join(row[:1 + i % 3]) for i, row in enumerate(words)]
+        shapes = ['{0}', '{0} AND {1}', '{0} OR {1}', '{0} AND NOT {1}', '({0} OR {1}) AND {2}']
+        boolean_queries = [shapes[i % len(shapes)].format(*row) for i, row in enumerate(words)]
+
+        queries = {}
+        with stage(stages, 'query_vector', len(vector_queries)):
+            queries['vector'] = latency(lambda q: engine.search(q, top_k=TOP_K), vector_queries)
+        with stage(stages, 'query_vector_full', len(vector_queries)):
+            queries['vector_full'] = latency(lambda q: full_engine.search(q, top_k=TOP_K), vector_queries)
+        with stage(stages, 'query_semantic', len(vector_queries)):
+            queries['semantic'] = latency(
+                lambda q: engine.search(q, top_k=TOP_K, mode='semantic'), vector_queries)
+        with stage(stages, 'query_boolean', len(boolean_queries)):
+            queries['boolean'] = latency(lambda q: inverted_index.search(q, index), boolean_queries)
+        # фрагмент случайного документа по словам запроса
+        snippet_docs = [f'page_{i}' for i in rng.integers(1, n_docs + 1, len(vector_queries))]
+        snippet_queries = list(zip(snippet_docs, vector_queries))
+        with stage(stages, 'query_snippet', len(snippet_queries)):
+            queries['snippet'] = latency(
+                lambda item: make_snippet(doc_store.get(item[0]), item[1].split()), snippet_queries)
+        return {'docs': n_docs, 'stages': stages, 'queries': queries, 'peak_rss_mb': peak_rss_mb()}
+    finally:
+        if not config['keep']:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(doc_counts, config):
+    runs = []
+    for n_docs in doc_counts:
+        print(f"[БЕНЧМАРК] Корпус из {n_docs} документов...")
+        # свежий процесс на каждый размер: пиковый RSS не наследуется
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            run = executor.submit(run_corpus, n_docs, config).result()
+        runs.append(run)
+        print(format_run(run))
+    return {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'config': config,
+        'runs': runs,
+    }
+
+
+def format_run(run):
+    lines = []
+    for name, entry in run['stages'].items():
+        if 'error' in entry:
+            lines.append(f"  {name:<24} ошибка: {entry['error']}")
+            continue
+        per_item = f"  ({entry['per_item_ms']:.3f} мс/шт)" if 'per_item_ms' in entry else ''
+        growth = f", RSS +{entry['rss_growth_mb']} МБ" if entry.get('rss_growth_mb') else ''
+        lines.append(f"  {name:<24} {entry['seconds']:10.4f} с{per_item}{growth}")
+    for engine, stats in run['queries'].items():
+        lines.append(f"  {engine:<24} p50 {stats['p50_ms']:.3f} мс, p99 {stats['p99_ms']:.3f} мс, "
+                     f"{stats['qps']} запросов/с")
+    lines.append(f"  пиковый RSS: {run['peak_rss_mb']} МБ")
+    return '\n'.join(lines)
+
+
+def metrics(run):
+    """Плоский набор сравниваемых чисел прогона (меньше - лучше)"""
+    values = {f"{name}.seconds": entry['seconds']
+              for name, entry in run['stages'].items() if 'error' not in entry}
+    for engine, stats in run['queries'].items():
+        values[f"{engine}.p50_ms"] = stats['p50_ms']
+        values[f"{engine}.p99_ms"] = stats['p99_ms']
+    values['peak_rss_mb'] = run['peak_rss_mb']
+    return values
+
+
+def compare(old_path, new_path, threshold=REGRESSION_THRESHOLD):
+    """Сравнение двух файлов результатов; возвращает число регрессий"""
+    with open(old_path, 'r', encoding='utf-8') as f:
+        old = json.load(f)
+    with open(new_path, 'r', encoding='utf-8') as f:
+        new = json.load(f)
+    print(f"Сравнение {old.get('commit')} -> {new.get('commit')}")
+    old_runs = {run['docs']: run for run in old['runs']}
+    regressions = 0
+    for run in new['runs']:
+        if run['docs'] not in old_runs:
+            continue
+        print(f"\nДокументов: {run['docs']}")
+        before = metrics(old_runs[run['docs']])
+        for name, value in metrics(run).items():
+            if name not in before or not before[name]:
+                continue
+            change = value / before[name] - 1
+            mark = ''
+            if change > threshold:
+                mark = '  РЕГРЕССИЯ'
+                regressions += 1
+            print(f"  {name:<34} {before[name]:>12.4f} -> {value:>12.4f} ({change:+.1%}){mark}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк стадий сборки и поиска на синтетическом корпусе")
+    parser.add_argument('--docs', type=int, nargs='+', default=DOC_COUNTS, help="размеры корпусов")
+    parser.add_argument('--doc-length', type=int, default=DOC_LENGTH)
+    parser.add_argument('--vocab', type=int, default=VOCAB_SIZE)
+    parser.add_argument('--zipf', type=float, default=ZIPF_EXPONENT)
+    parser.add_argument('--text-sample', type=int, default=TEXT_SAMPLE,
+                        help="документов для стадий разбора HTML и лемматизации")
+    parser.add_argument('--queries', type=int, default=QUERIES)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', default=None, help="папка для временных файлов")
+    parser.add_argument('--keep', action='store_true', help="не удалять сгенерированные файлы")
+    parser.add_argument('--output', default=None, help="JSON с результатами")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help="сравнить два файла результатов")
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help="рост, считающийся регрессией (доля)")
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if compare(*args.compare, threshold=args.threshold) else 0)
+
+    config = {'doc_length': args.doc_length, 'vocab': args.vocab, 'zipf': args.zipf,
+              'text_sample': args.text_sample, 'queries': args.queries, 'seed': args.seed,
+              'workdir': args.workdir, 'keep': args.keep}
+    report = run_benchmark(args.docs, config)
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"bench-{report['commit'] or 'nogit'}-"
+                                           f"{time.strftime('%Y%m%d%H%M%S')}.json")
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"[БЕНЧМАРК] Результаты сохранены в: {output}")
+
+
+if __name__ == '__main__':
+    main()
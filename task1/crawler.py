@@ -1,50 +1,282 @@
 import os
-import requests
+import json
 import time
 import shutil
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+BASE_URL = 'https://habr.com/ru/post/'
+PAGES_DIR = 'pages'
+INDEX_FILE = 'index.txt'
+STATE_FILE = 'crawl_state.json'
+TARGET_PAGES = 100
+CONCURRENCY = 8
+RATE = 1.0          # запросов в секунду на хост
+BURST = 2
+MAX_RETRIES = 4
+BACKOFF = 1.0       # базовая задержка повтора, с
+TIMEOUT = 30
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# подряд неудачных номеров (нет поста, отказ сервера, сетевая ошибка), после
+# которых обход прекращается: постов дальше нет или сайт недоступен
+MAX_FAILURES = 500
+
+
+class TokenBucket:
+    """Ограничение частоты запросов: rate токенов в секунду, не больше burst"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class CrawlState:
+    """Контрольная точка обхода, чтобы прерванный обход продолжался с места остановки.
+
+    Номера постов ниже low_water уже обработаны (скачаны или отсутствуют),
+    finished - обработанные номера выше этой границы. pending - страницы,
+    номер которых уже записан в контрольную точку, а файл и строка index.txt
+    еще могут быть не записаны: page_num -> (номер поста, url).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.low_water = 1
+        self.finished = set()
+        self.downloaded = 0
+        self.pending = {}
+        if path and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.low_water = data['low_water']
+            self.finished = set(data['finished'])
+            self.downloaded = data['downloaded']
+            self.pending = {int(page_num): tuple(page)
+                            for page_num, page in data.get('pending', {}).items()}
+
+    def is_finished(self, post_id):
+        return post_id < self.low_water or post_id in self.finished
+
+    def mark_finished(self, post_id):
+        self.finished.add(post_id)
+        while self.low_water in self.finished:
+            self.finished.remove(self.low_water)
+            self.low_water += 1
+
+    def save(self):
+        if not self.path:
+            return
+        data = {'low_water': self.low_water, 'finished': sorted(self.finished),
+                'downloaded': self.downloaded, 'pending': self.pending}
+        with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(self.path + '.tmp', self.path)
+
+
+class Crawler:
+    def __init__(self, base_url=BASE_URL, pages_dir=PAGES_DIR, index_file=INDEX_FILE,
+                 state_file=STATE_FILE, target=TARGET_PAGES, concurrency=CONCURRENCY,
+                 rate=RATE, burst=BURST, max_retries=MAX_RETRIES, backoff=BACKOFF,
+                 max_failures=MAX_FAILURES):
+        self.base_url = base_url
+        self.pages_dir = pages_dir
+        self.index_file = index_file
+        self.target = target
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.rate = rate
+        self.burst = burst
+        self.max_failures = max_failures
+        self.failures = 0
+        self.max_failures = max_failures
+        self.failures = 0
 
-#папка для храения файлов
-if not os.path.exists('pages'):
-    os.makedirs('pages')
-
-def download_page(url, page_num):
-    try:
-        response = requests.get(url)
-        #страница существует
-        if response.status_code == 200:
-            file_path = f'pages/page_{page_num}.html'
-            with open(file_path, 'w', encoding='utf-8') as file:
-                file.write(response.text)
-
-            #запись номера и ссылки
-            with open('index.txt', 'a', encoding='utf-8') as index_file:
-                index_file.write(f'{page_num}\t{url}\n')
+        self.state = CrawlState(state_file)
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.next_post = self.state.low_water
+
+        # общий пул keep-alive соединений на все потоки
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _bucket(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.rate, self.burst)
+            return self.buckets[host]
+
+    def _take_post_id(self):
+        with self.lock:
+            if self.state.downloaded >= self.target or self.failures >= self.max_failures:
+                return None
+            while self.state.is_finished(self.next_post):
+                self.next_post += 1
+            post_id = self.next_post
+            self.next_post += 1
+            return post_id
+
+    def _fetch(self, url, tmp_path):
+        """Скачивает страницу во временный файл; возвращает HTTP-статус"""
+        bucket = self._bucket(url)
+        for attempt in range(self.max_retries + 1):
+            bucket.acquire()
+            try:
+                with self.session.get(url, stream=True, timeout=TIMEOUT) as response:
+                    if response.status_code == 200:
+                        response.encoding = response.encoding or 'utf-8'
+                        with open(tmp_path, 'w', encoding='utf-8') as file:
+                            for chunk in response.iter_content(chunk_size=65536, decode_unicode=True):
+                                file.write(chunk)
+                        return 200
+                    if response.status_code not in RETRY_STATUSES or attempt == self.max_retries:
+                        return response.status_code
+                    retry_after = response.headers.get('Retry-After', '')
+                    delay = float(retry_after) if retry_after.isdigit() else self.backoff * 2 ** attempt
+            except requests.RequestException as e:
+                if attempt == self.max_retries:
+                    raise
+                print(f'Повтор {url} после ошибки: {e}')
+                delay = self.backoff * 2 ** attempt
+            time.sleep(delay)
+
+    def _download(self, post_id, index_file):
+        url = f'{self.base_url}{post_id}/'
+        tmp_path = os.path.join(self.pages_dir, f'.post_{post_id}.tmp')
+        try:
+            status = self._fetch(url, tmp_path)
+        except Exception as e:
+            # сетевая ошибка после всех повторов: номер не отмечается обработанным
+            print(f'Ошибка при скачивании {url} (Ошибка: {e})')
+            self._failed()
+            return
+        if status != 200:
+            self._failed()
+        if status in RETRY_STATUSES:
+            # 429/5xx и после всех повторов - временный отказ сервера, а не
+            # отсутствие поста: как и сетевая ошибка, номер остается
+            # необработанным и скачивается заново при следующем запуске
+            print(f'Сервер не отдал {url} (Статус: {status}), повтор при следующем запуске')
+            return
+
+        with self.lock:
+            if status == 200 and self.state.downloaded >= self.target:
+                # цель уже достигнута другими потоками: страница останется
+                # необработанной и будет скачана при следующем запуске
+                os.remove(tmp_path)
+                return
+            if status != 200:
+                print(f'Пропуск {url} (Статус: {status})')
+                self.state.mark_finished(post_id)
+                self.state.save()
+                return
+            self.failures = 0
+            self.state.downloaded += 1
+            page_num = self.state.downloaded
+            # номер страницы попадает в контрольную точку до публикации файла:
+            # после сбоя между ними запуск допишет страницу (_recover), а не
+            # выдаст тот же номер другому посту
+            self.state.pending[page_num] = (post_id, url)
+            self.state.mark_finished(post_id)
+            self.state.save()
+            self._publish_page(page_num, post_id, url, index_file)
+            del self.state.pending[page_num]
+            self.state.save()
             print(f'Страница {page_num} успешно скачана: {url}')
-            return True
-        else:
-            print(f'Ошибка при скачивании страницы {page_num}: {url} (Статус: {response.status_code})')
-            return False
-    except Exception as e:
-        print(f'Ошибка при скачивании страницы {page_num}: {url} (Ошибка: {e})')
-        return False
-
-base_url = 'https://habr.com/ru/post/'
-
-downloaded_pages = 0
-
-#перебираем страницы от 1 до 100
-page_num = 1
-while downloaded_pages < 100:
-    url = f'{base_url}{page_num}/'  #формируем полный URL с числовым параметром
-    if download_page(url, downloaded_pages + 1):
-        downloaded_pages += 1
-    page_num += 1
-
-    #задержка между запросами 1 с
-    time.sleep(1)
-
-print(f'Все) Скачано {downloaded_pages} страниц.')
-
-# Создаем архив, если скачано больше 2MB
-if downloaded_pages > 0:
-    shutil.make_archive('pages_archive', 'zip', 'pages')
+
+    def _failed(self):
+        with self.lock:
+            self.failures += 1
+
+    def _publish_page(self, page_num, post_id, url, index_file, written=()):
+        """Файл page_N.html и строка index.txt; written - номера, уже записанные в index.txt"""
+        tmp_path = os.path.join(self.pages_dir, f'.post_{post_id}.tmp')
+        if os.path.exists(tmp_path):
+            os.replace(tmp_path, os.path.join(self.pages_dir, f'page_{page_num}.html'))
+        if page_num not in written:
+            # запись номера и ссылки
+            index_file.write(f'{page_num}\t{url}\n')
+            index_file.flush()
+
+    def _recover(self, index_file):
+        """Дописывает страницы, публикация которых прервалась при прошлом запуске"""
+        if not self.state.pending:
+            return
+        written = set()
+        if os.path.exists(self.index_file):
+            with open(self.index_file, 'r', encoding='utf-8') as f:
+                written = {int(line.split('\t', 1)[0]) for line in f if line.strip()}
+        for page_num, (post_id, url) in sorted(self.state.pending.items()):
+            self._publish_page(page_num, post_id, url, index_file, written)
+            print(f'Страница {page_num} восстановлена после сбоя: {url}')
+        self.state.pending = {}
+        self.state.save()
+
+    def _worker(self, index_file):
+        while True:
+            post_id = self._take_post_id()
+            if post_id is None:
+                return
+            self._download(post_id, index_file)
+
+    def run(self):
+        os.makedirs(self.pages_dir, exist_ok=True)
+        with open(self.index_file, 'a', encoding='utf-8') as index_file:
+            self._recover(index_file)
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                for future in [executor.submit(self._worker, index_file)
+                               for _ in range(self.concurrency)]:
+                    future.result()
+        self.session.close()
+        if self.failures >= self.max_failures:
+            print(f'Обход остановлен: {self.failures} номеров подряд не удалось скачать')
+        return self.state.downloaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Скачивание постов Хабра")
+    parser.add_argument('--base-url', default=BASE_URL)
+    parser.add_argument('--pages', type=int, default=TARGET_PAGES, help="сколько страниц скачать")
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY, help="число параллельных загрузок")
+    parser.add_argument('--rate', type=float, default=RATE, help="запросов в секунду на хост")
+    parser.add_argument('--state', default=STATE_FILE, help="файл контрольной точки")
+    parser.add_argument('--max-failures', type=int, default=MAX_FAILURES,
+                        help="остановиться после стольких неудачных номеров подряд")
+    args = parser.parse_args()
+
+    crawler = Crawler(args.base_url, target=args.pages, concurrency=args.concurrency,
+                      rate=args.rate, state_file=args.state, max_failures=args.max_failures)
+    downloaded_pages = crawler.run()
+    print(f'Все) Скачано {downloaded_pages} страниц.')
+
+    # Создаем архив скачанных страниц
+    if downloaded_pages > 0:
+        shutil.make_archive('pages_archive', 'zip', PAGES_DIR)
+
+
+if __name__ == '__main__':
+    main()
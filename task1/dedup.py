@@ -0,0 +1,155 @@
+import os
+import json
+import zlib
+import argparse
+from collections import defaultdict
+
+import numpy as np
+
+from doc_store import WORD_RE
+from instrumentation import timed
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEDUP_DIR = os.path.join(BASE_DIR, 'dedup')
+SIGNATURES_FILE = 'signatures.json'
+REPORT_FILE = 'report.tsv'
+FINGERPRINT_BITS = 64
+SHINGLE_WORDS = 3   # слов в шингле
+# страницы с отпечатками на расстоянии Хэмминга не больше этого - дубликаты
+# (6 из 64 бит - сходство около 90%; у разных статей обычно 20 и больше)
+MAX_DISTANCE = 6
+
+# Поиск почти одинаковых страниц по SimHash (Charikar; Manku и др.). Текст
+# статьи разбивается на шинглы - тройки соседних слов; каждый шингл хэшируется
+# в 64 бита, и бит отпечатка равен 1, если он установлен у большинства
+# шинглов. У похожих текстов отпечатки отличаются в немногих битах. Индекс
+# отпечатков делит 64 бита на MAX_DISTANCE + 1 полосу: у отпечатков на
+# расстоянии не больше MAX_DISTANCE хотя бы одна полоса совпадает целиком,
+# поэтому сравнивать новый отпечаток нужно только с совпавшими по полосе.
+
+_SHINGLE_PRIME = np.uint64(1099511628211)
+_MIX1 = np.uint64(0xbf58476d1ce4e5b9)
+_MIX2 = np.uint64(0x94d049bb133111eb)
+_BITS = np.arange(FINGERPRINT_BITS, dtype=np.uint64)
+
+
+def _mix(x):
+    """Перемешивание битов (финализатор splitmix64)"""
+    x = (x ^ (x >> np.uint64(30))) * _MIX1
+    x = (x ^ (x >> np.uint64(27))) * _MIX2
+    return x ^ (x >> np.uint64(31))
+
+
+@timed('simhash')
+def simhash(text):
+    """64-битный отпечаток текста; 0 для текста без слов"""
+    words = WORD_RE.findall(text.lower())
+    if not words:
+        return 0
+    # crc32 не зависит от PYTHONHASHSEED - отпечатки можно сохранять между запусками
+    word_hashes = np.fromiter((zlib.crc32(word.encode('utf-8')) for word in words),
+                              dtype=np.uint64, count=len(words))
+    size = min(SHINGLE_WORDS, len(words))
+    n = len(words) - size + 1
+    hashes = np.zeros(n, dtype=np.uint64)
+    for i in range(size):
+        hashes = hashes * _SHINGLE_PRIME + word_hashes[i:i + n]
+    bits = (_mix(hashes)[:, None] >> _BITS) & np.uint64(1)
+    majority = np.flatnonzero(2 * bits.sum(axis=0) > n)
+    return sum(1 << int(bit) for bit in majority)
+
+
+def max_distance_arg(value):
+    """Тип аргумента --max-distance: целое 0 <= d < FINGERPRINT_BITS"""
+    distance = int(value)
+    if not 0 <= distance < FINGERPRINT_BITS:
+        raise argparse.ArgumentTypeError(f"ожидается число от 0 до {FINGERPRINT_BITS - 1}")
+    return distance
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+class SignatureIndex:
+    """Отпечатки принятых страниц и найденные дубликаты"""
+
+    def __init__(self, max_distance=MAX_DISTANCE):
+        # полос max_distance + 1, и каждой нужен хотя бы один бит
+        if not 0 <= max_distance < FINGERPRINT_BITS:
+            raise ValueError(f"max_distance должно быть от 0 до {FINGERPRINT_BITS - 1}: {max_distance}")
+        self.max_distance = max_distance
+        # границы полос; последняя забирает остаток битов
+        step = FINGERPRINT_BITS // (max_distance + 1)
+        self.bands = [(i * step, step if i < max_distance else FINGERPRINT_BITS - i * step)
+                      for i in range(max_distance + 1)]
+        self.tables = [defaultdict(list) for _ in self.bands]
+        self.fingerprints = {}
+        self.duplicates = {}    # дубликат -> (оставленная страница, расстояние)
+
+    def __len__(self):
+        return len(self.fingerprints)
+
+    def _keys(self, fingerprint):
+        for shift, width in self.bands:
+            yield (fingerprint >> shift) & ((1 << width) - 1)
+
+    def find(self, fingerprint):
+        """(ближайшая принятая страница, расстояние) или None"""
+        best = None
+        for table, key in zip(self.tables, self._keys(fingerprint)):
+            for doc_id in table.get(key, ()):
+                distance = hamming(fingerprint, self.fingerprints[doc_id])
+                if distance <= self.max_distance and (best is None or distance < best[1]):
+                    best = (doc_id, distance)
+        return best
+
+    def add(self, doc_id, fingerprint):
+        """Принимает страницу; для дубликата возвращает (оригинал, расстояние) и не добавляет ее"""
+        match = self.find(fingerprint)
+        if match is not None:
+            self.duplicates[doc_id] = match
+            return match
+        self.fingerprints[doc_id] = fingerprint
+        for table, key in zip(self.tables, self._keys(fingerprint)):
+            table[key].append(doc_id)
+        return None
+
+    def save(self, out_dir=DEDUP_DIR):
+        """signatures.json - отпечатки принятых страниц, report.tsv - отброшенные"""
+        os.makedirs(out_dir, exist_ok=True)
+        path = os.path.join(out_dir, SIGNATURES_FILE)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'max_distance': self.max_distance,
+                       'fingerprints': {doc_id: f"{fingerprint:016x}"
+                                        for doc_id, fingerprint in self.fingerprints.items()}}, f)
+        os.replace(path + '.tmp', path)
+        with open(os.path.join(out_dir, REPORT_FILE), 'w', encoding='utf-8') as f:
+            f.write("дубликат\tоригинал\tрасстояние\n")
+            for doc_id, (original, distance) in sorted(self.duplicates.items()):
+                f.write(f"{doc_id}\t{original}\t{distance}\n")
+
+
+def main():
+    from html_text import extract_article_text
+
+    parser = argparse.ArgumentParser(description="Поиск почти одинаковых HTML-страниц (SimHash)")
+    parser.add_argument('--pages', default=os.path.join(BASE_DIR, 'pages'))
+    parser.add_argument('--out', default=DEDUP_DIR, help="папка для отпечатков и отчета")
+    parser.add_argument('--max-distance', type=max_distance_arg, default=MAX_DISTANCE,
+                        help="наибольшее расстояние Хэмминга между отпечатками дубликатов")
+    args = parser.parse_args()
+
+    index = SignatureIndex(args.max_distance)
+    for filename in sorted(f for f in os.listdir(args.pages) if f.endswith('.html')):
+        with open(os.path.join(args.pages, filename), 'r', encoding='utf-8') as f:
+            text = extract_article_text(f.read())
+        if text:
+            index.add(os.path.splitext(filename)[0], simhash(text))
+    index.save(args.out)
+    print(f"Страниц: {len(index) + len(index.duplicates)}, дубликатов: {len(index.duplicates)}\n"
+          f"Отчет: {os.path.join(args.out, REPORT_FILE)}")
+
+
+if __name__ == '__main__':
+    main()
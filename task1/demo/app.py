@@ -1,30 +1,206 @@
-from flask import Flask, render_template, request
-from search_engine import VectorSearchEngine
+from flask import Flask, Response, jsonify, render_template, request
+from markupsafe import Markup, escape
+from search_engine import SEARCH_MODES, VectorSearchEngine
+from query_cache import QueryCache
+from instrumentation import registry
 import os
-
-app = Flask(__name__, template_folder='templates', static_folder='static')
+import hmac
 
 # Пути к данным
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATA_DIR = os.path.join(BASE_DIR, '..', 'tfidf_results', 'lemmas')
 INDEX_FILE = os.path.join(BASE_DIR, '..', 'index.txt')
+COMPILED_DIR = os.path.join(BASE_DIR, '..', 'compiled_index')
+DOC_STORE_DIR = os.path.join(BASE_DIR, '..', 'doc_store')
+LSA_DIR = os.path.join(BASE_DIR, '..', 'lsa_index')
+
+QUERY_CACHE_SIZE = 1024
+QUERY_CACHE_TTL = 600  # секунд
+MAX_TOP_K = 100
+MAX_BATCH_QUERIES = 100  # запросов в одном /api/search_many
+# токен для /admin/reload; без него перезагрузка по запросу выключена
+ADMIN_TOKEN = os.environ.get('SEARCH_ADMIN_TOKEN', '')
+
+
+def parse_top_k(value, default=10):
+    """top_k из запроса; None, если это не целое число"""
+    if isinstance(value, float) and not value.is_integer():
+        # 3.5 не округляется до 3; сюда же попадают Infinity и NaN из JSON
+        return None
+    try:
+        top_k = int(value if value is not None else default)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    return max(1, min(top_k, MAX_TOP_K))
+
+
+def highlight(text, spans):
+    """Фрагмент с совпадениями в <mark>; остальной текст экранируется"""
+    parts = []
+    pos = 0
+    for start, end in spans or ():
+        parts.append(escape(text[pos:start]))
+        parts.append(Markup('<mark>%s</mark>') % text[start:end])
+        pos = end
+    parts.append(escape(text[pos:]))
+    return Markup('').join(parts)
+
+
+def create_app(search_engine=None, watch=True):
+    """Фабрика приложения.
+
+    Индекс загружается один раз при создании приложения. При запуске через
+    gunicorn с preload_app (см. gunicorn.conf.py) это происходит в мастере до
+    fork, и воркеры делят его страницы: компилированный индекс - через mmap,
+    текстовый - копированием при записи. С watch=True каждый процесс при
+    первом запросе запускает наблюдатель, который подменяет индекс при его
+    пересборке без перезапуска сервера.
+    """
+    if search_engine is None:
+        search_engine = VectorSearchEngine(DATA_DIR, INDEX_FILE, COMPILED_DIR, store_dir=DOC_STORE_DIR,
+                                           lsa_dir=LSA_DIR)
+    # кэш запросов у каждого воркера свой
+    query_cache = QueryCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+
+    app = Flask(__name__, template_folder='templates', static_folder='static')
+    app.extensions['search_engine'] = search_engine
+    app.add_template_filter(highlight)
+
+    if watch:
+        @app.before_request
+        def ensure_watcher():
+            search_engine.start_watcher()
+
+    def cached_search(query, top_k=10, mode='exact'):
+        """Поиск с кэшем по нормализованному запросу; кэш сбрасывается при смене версии индекса"""
+        query_cache.set_version(search_engine.version)
+        key = (' '.join(query.lower().split()), top_k, mode)
+        results = query_cache.get(key)
+        if results is None:
+            results = search_engine.search(query, top_k=top_k, mode=mode)
+            query_cache.put(key, results)
+        return results
+
+    @app.route('/', methods=['GET', 'POST'])
+    def index():
+        results = []
+        query = ""
+
+        if request.method == 'POST':
+            query = request.form.get('query', '').strip()
+            if query:
+                results = cached_search(query, top_k=10)
+
+        return render_template('index.html', query=query, results=results)
+
+    @app.route('/api/search', methods=['GET', 'POST'])
+    def api_search():
+        """Поиск без шаблона: ?q=...&top_k=10&mode=exact или
+        {"query": "...", "top_k": 10, "mode": "semantic"}"""
+        if request.method == 'POST':
+            params = request.get_json(silent=True) or {}
+            if not isinstance(params, dict):
+                return jsonify({'error': "ожидается JSON-объект"}), 400
+        else:
+            params = {'query': request.args.get('q'), 'top_k': request.args.get('top_k'),
+                      'mode': request.args.get('mode')}
+        query = params.get('query')
+        if not isinstance(query, str):
+            return jsonify({'error': "ожидается строка запроса 'query' (или параметр 'q')"}), 400
+        top_k = parse_top_k(params.get('top_k'))
+        if top_k is None:
+            return jsonify({'error': "'top_k' должно быть целым числом"}), 400
+        mode = params.get('mode') or 'exact'
+        if mode not in SEARCH_MODES:
+            return jsonify({'error': f"'mode' должно быть одним из: {', '.join(SEARCH_MODES)}"}), 400
+
+        query = query.strip()
+        try:
+            results = cached_search(query, top_k=top_k, mode=mode) if query else []
+        except ValueError as e:
+            # семантический режим без LSA-индекса
+            return jsonify({'error': str(e)}), 400
+        return jsonify({'query': query, 'mode': mode, 'results': results})
+
+    @app.route('/api/search_many', methods=['POST'])
+    def api_search_many():
+        """Пакетный поиск: {"queries": [...], "top_k": 10} -> {"results": [[...], ...]}"""
+        payload = request.get_json(silent=True) or {}
+        if not isinstance(payload, dict):
+            return jsonify({'error': "ожидается JSON-объект"}), 400
+        queries = payload.get('queries')
+        if not isinstance(queries, list) or not all(isinstance(q, str) for q in queries):
+            return jsonify({'error': "ожидается поле 'queries' со списком строк"}), 400
+        if len(queries) > MAX_BATCH_QUERIES:
+            return jsonify({'error': f"не больше {MAX_BATCH_QUERIES} запросов за раз"}), 400
+        top_k = parse_top_k(payload.get('top_k'))
+        if top_k is None:
+            return jsonify({'error': "'top_k' должно быть целым числом"}), 400
+
+        return jsonify({'results': search_engine.search_many(queries, top_k=top_k)})
+
+    @app.route('/health')
+    def health():
+        return jsonify({
+            'status': 'ok',
+            'index_version': search_engine.version,
+            'documents': len(search_engine.filenames),
+            'semantic': search_engine.semantic_available,
+            'pid': os.getpid(),
+        })
 
-# Инициализация поисковой системы
-search_engine = VectorSearchEngine(DATA_DIR, INDEX_FILE)
+    @app.route('/admin/reload', methods=['POST'])
+    def admin_reload():
+        """Немедленная перезагрузка индекса в процессе, принявшем запрос"""
+        token = request.headers.get('X-Admin-Token', '')
+        if not ADMIN_TOKEN or not hmac.compare_digest(token, ADMIN_TOKEN):
+            return jsonify({'error': 'доступ запрещен'}), 403
+        try:
+            reloaded = search_engine.reload(force=request.args.get('force') == '1')
+        except Exception as e:
+            return jsonify({'error': f'не удалось загрузить индекс: {e}'}), 500
+        return jsonify({'reloaded': reloaded, 'index_version': search_engine.version,
+                        'pid': os.getpid()})
 
+    @app.route('/metrics')
+    def metrics():
+        """Метрики процесса-воркера в формате Prometheus.
 
-@app.route('/', methods=['GET', 'POST'])
-def index():
-    results = []
-    query = ""
+        Под gunicorn у каждого воркера свой реестр и свои кэши, а общего
+        сбора между процессами нет: ответ - значения того воркера, который
+        принял запрос, и соседние опросы могут попасть в разные воркеры.
+        Для суммы по серверу воркеры нужно опрашивать по отдельности.
+        Кэш фрагментов создается заново с каждой версией индекса, и его
+        счетчики после перезагрузки начинаются с нуля.
+        """
+        query_stats = query_cache.stats()
+        preview_stats = search_engine.preview_cache.stats()
+        gauges = {
+            'index_documents': len(search_engine.filenames),
+            'query_cache_size': query_stats['size'],
+        }
+        # попадания и промахи только растут - это счетчики, а не gauge
+        counters = {
+            'query_cache_hits': query_stats['hits'],
+            'query_cache_misses': query_stats['misses'],
+            'preview_cache_hits': preview_stats['hits'],
+            'preview_cache_misses': preview_stats['misses'],
+        }
+        return Response(registry.prometheus(gauges, counters),
+                        mimetype='text/plain; version=0.0.4')
 
-    if request.method == 'POST':
-        query = request.form.get('query', '').strip()
-        if query:
-            results = search_engine.search(query, top_k=10)
+    @app.route('/stats')
+    def stats():
+        return jsonify({
+            'index_version': search_engine.version,
+            'query_cache': query_cache.stats(),
+            'preview_cache': search_engine.preview_cache.stats(),
+        })
 
-    return render_template('index.html', query=query, results=results)
+    return app
 
 
 if __name__ == '__main__':
-    app.run(debug=True, port=5000)
\ No newline at end of file
+    # отладочный сервер для разработки, без перезагрузчика (он загружал индекс дважды);
+    # в продакшене: gunicorn -c gunicorn.conf.py
+    create_app().run(debug=True, use_reloader=False, port=5000)
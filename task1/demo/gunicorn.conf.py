@@ -0,0 +1,21 @@
+import gc
+import os
+import multiprocessing
+
+# Приложение (и индекс) создается в мастер-процессе до fork: воркеры получают
+# его готовым и делят память, а не загружают каждый свою копию.
+chdir = os.path.dirname(os.path.abspath(__file__))
+wsgi_app = 'wsgi:app'
+preload_app = True
+
+bind = os.environ.get('SEARCH_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('SEARCH_WORKERS', multiprocessing.cpu_count()))
+threads = int(os.environ.get('SEARCH_THREADS', 1))
+timeout = 30
+accesslog = '-'
+
+
+def when_ready(server):
+    # объекты загруженного индекса переносятся в постоянное поколение сборщика
+    # мусора: он не трогает их в воркерах, и страницы не копируются при записи
+    gc.freeze()
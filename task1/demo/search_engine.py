@@ -1,106 +1,298 @@
 import os
-import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
+import sys
+import time
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from search import (load_tfidf_data, load_url_mapping, normalize_rows, process_queries,
+                    process_query, score_documents, score_queries, top_k_indices, top_k_rows)
+from index_store import current_version as index_version, index_exists, open_index
+from maxscore import MaxScoreIndex
+from doc_store import make_snippet, open_doc_store, store_exists
+from lsa import lsa_exists, open_lsa_index
+from query_analyzer import load_query_analyzer
+from query_cache import QueryCache
+from instrumentation import inc, timed
+
+PREVIEW_CACHE_SIZE = 4096
+SEARCH_MODES = ('exact', 'semantic')
+RELOAD_INTERVAL = 5.0  # секунд между проверками индекса
+
+
+class IndexSnapshot:
+    """Загруженный индекс. Снимок не меняется после создания: перезагрузка
+    создает новый, а запросы, начатые на старом, дорабатывают на нем."""
+
+    def __init__(self, term_matrix, vocab, filenames, doc_norms, urls, version, index=None,
+                 pruned=None, doc_store=None, lsa=None):
+        self.term_matrix = term_matrix
+        self.vocab = vocab
+        self.filenames = filenames
+        self.doc_norms = doc_norms
+        self.urls = urls
+        self.version = version
+        self.index = index
+        # top-k с отсечением (MaxScore); None - полный перебор документов
+        self.pruned = pruned
+        # тексты статей для фрагментов (doc_store); None - превью из TF-IDF файлов
+        self.doc_store = doc_store
+        # LSA-индекс для семантического режима; None - режим недоступен
+        self.lsa = lsa
+        # фрагменты строятся один раз на документ, запрос и версию индекса
+        self.preview_cache = QueryCache(PREVIEW_CACHE_SIZE)
 
 
 class VectorSearchEngine:
-    def __init__(self, data_dir, index_file):
+    def __init__(self, data_dir, index_file, compiled_dir=None, analyzer=None, pruning=True,
+                 store_dir=None, lsa_dir=None):
         self.data_dir = data_dir
-        self.url_mapping = self._load_url_mapping(index_file)
-        self.tfidf_matrix, self.vocab, self.filenames = self._load_data()
+        # запросы лемматизируются так же, как документы при индексации;
+        # analyzer=False - слова запроса берутся как есть
+        self.analyzer = load_query_analyzer() if analyzer is None else analyzer
+        self.index_file = index_file
+        self.compiled_dir = compiled_dir
+        self.pruning = pruning
+        self.store_dir = store_dir
+        self.lsa_dir = lsa_dir
+        self.reload_lock = threading.Lock()
+        self.snapshot = self._load_snapshot()
+        self._pending_version = None
+        self._watcher_pid = None
+
+    # атрибуты текущего снимка
+    @property
+    def version(self):
+        return self.snapshot.version
+
+    @property
+    def filenames(self):
+        return self.snapshot.filenames
+
+    @property
+    def preview_cache(self):
+        return self.snapshot.preview_cache
+
+    def _compiled_available(self):
+        return bool(self.compiled_dir) and index_exists(self.compiled_dir)
+
+    def _load_snapshot(self):
+        url_mapping = self._load_url_mapping(self.index_file)
+        doc_store = None
+        if self.store_dir and store_exists(self.store_dir):
+            doc_store = open_doc_store(self.store_dir)
+
+        if self._compiled_available():
+            # компилированный индекс отображается в память без разбора текстов
+            index = open_index(self.compiled_dir)
+            pruned = MaxScoreIndex.from_index(index) if self.pruning else None
+            lsa, lsa_version = self._load_lsa(index.version)
+            return IndexSnapshot(index.term_matrix(), index.vocab, index.filenames,
+                                 index.doc_norms, index.urls,
+                                 self._combined_version(index.version, lsa_version), index, pruned,
+                                 doc_store, lsa)
+
+        version = self._text_version()
+        tfidf_matrix, vocab, filenames = self._load_data()
+        # строки нормируются один раз при загрузке, а не на каждый запрос
+        tfidf_matrix, doc_norms = normalize_rows(tfidf_matrix)
+        urls = [url_mapping.get(filename, "#") for filename in filenames]
+        term_matrix = tfidf_matrix.tocsc()
+        term_matrix.sort_indices()
+        pruned = MaxScoreIndex(term_matrix) if self.pruning else None
+        return IndexSnapshot(term_matrix, vocab, filenames, doc_norms, urls, version, None, pruned,
+                             doc_store)
+
+    def _load_lsa(self, index_version):
+        """(LSA-индекс или None, версия LSA на диске): индекс используется, только
+        если он собран по этой версии компилированного индекса"""
+        if not self.lsa_dir or not lsa_exists(self.lsa_dir):
+            return None, None
+        lsa = open_lsa_index(self.lsa_dir)
+        if lsa.source_version != index_version:
+            # столбцы терминов могли измениться - векторы запросов были бы неверными
+            print(f"[ИНДЕКС] LSA-индекс собран по версии {lsa.source_version}, "
+                  f"а загружена {index_version}; семантический режим выключен")
+            return None, lsa.version
+        return lsa, lsa.version
+
+    @staticmethod
+    def _combined_version(index_version, lsa_version):
+        """Версия снимка: компилированный индекс и LSA-индекс - пересборка
+        любого из них дает новую версию, и наблюдатель перезагружает снимок"""
+        return f"{index_version}+lsa-{lsa_version}" if lsa_version else index_version
+
+    def _text_version(self):
+        """Версия текстовых данных: число файлов и время последнего изменения"""
+        mtimes = [entry.stat().st_mtime for entry in os.scandir(self.data_dir)
+                  if entry.name.endswith('.txt')]
+        return f"text-{len(mtimes)}-{max(mtimes, default=0):.0f}"
+
+    def current_version(self):
+        """Версия данных на диске (без загрузки); None, если читать их сейчас нельзя"""
+        if self._compiled_available():
+            # версия публикуется заменой указателя, каталог не пропадает
+            version = index_version(self.compiled_dir)
+            if version is None or not self.lsa_dir:
+                return version
+            return self._combined_version(version, index_version(self.lsa_dir))
+        if self.snapshot.index is not None or not os.path.isdir(self.data_dir):
+            # компилированный индекс удалили - текст вместо него не подхватываем
+            return None
+        return self._text_version()
+
+    def reload(self, force=False):
+        """Загружает новую версию индекса и подменяет снимок; True, если подменил"""
+        with self.reload_lock:
+            version = self.current_version()
+            if not force and (version is None or version == self.snapshot.version):
+                return False
+            snapshot = self._load_snapshot()
+            # присваивание атомарно: новые запросы берут новый снимок,
+            # старый освобождается, когда завершатся запросы на нем
+            self.snapshot = snapshot
+            self._pending_version = None
+            inc('index_reloads')
+            print(f"[ИНДЕКС] Загружена версия {snapshot.version}")
+            return True
+
+    def check_for_update(self):
+        """Перезагрузка, если версия на диске изменилась и держится между проверками.
+
+        Текстовые TF-IDF файлы переписываются по одному, поэтому новая версия
+        подхватывается, только когда два опроса подряд видят одно и то же;
+        компилированный индекс подменяется целиком и загружается сразу.
+        """
+        version = self.current_version()
+        if version is None or version == self.snapshot.version:
+            self._pending_version = None
+            return False
+        if self._compiled_available() or version == self._pending_version:
+            return self.reload()
+        self._pending_version = version
+        return False
+
+    def _watch(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.check_for_update()
+            except Exception as e:
+                # при ошибке продолжаем отвечать по старому снимку
+                print(f"[ИНДЕКС] Не удалось перезагрузить индекс: {e}")
+
+    def start_watcher(self, interval=RELOAD_INTERVAL):
+        """Фоновая проверка обновлений индекса. Потоки не переживают fork,
+        поэтому наблюдатель запускается заново в каждом процессе."""
+        if self._watcher_pid == os.getpid():
+            return
+        self._watcher_pid = os.getpid()
+        threading.Thread(target=self._watch, args=(interval,), daemon=True,
+                         name='index-watcher').start()
 
     def _load_url_mapping(self, index_file):
-        mapping = {}
-        with open(index_file, 'r', encoding='utf-8') as f:
-            for line in f:
-                parts = line.strip().split('\t')
-                if len(parts) >= 2:
-                    filename = f"page_{parts[0]}.txt"
-                    url = parts[1]
-                    mapping[filename] = url
-        return mapping
+        return load_url_mapping(index_file)
 
     def _load_data(self):
         """Загрузка TF-IDF данных"""
         if not os.path.exists(self.data_dir):
             raise FileNotFoundError(f"Директория не найдена: {self.data_dir}")
 
-        all_words = set()
-        documents_tfidf = []
-        filenames = []
+        return load_tfidf_data(self.data_dir)
 
-        for filename in sorted(os.listdir(self.data_dir)):
-            if not filename.endswith(".txt"):
-                continue
+    @property
+    def semantic_available(self):
+        return self.snapshot.lsa is not None
 
-            full_path = os.path.join(self.data_dir, filename)
-            try:
-                with open(full_path, 'r', encoding='utf-8') as file:
-                    doc_words = {}
-                    for line in file:
-                        parts = line.strip().split()
-                        if len(parts) < 3:
-                            continue
-                        word = parts[0].rstrip(':')
-                        tf, idf = map(float, parts[1:3])
-                        doc_words[word] = tf * idf
-                        all_words.add(word)
-
-                    documents_tfidf.append(doc_words)
-                    filenames.append(filename)
-            except Exception as e:
-                print(f"Ошибка чтения {filename}: {e}")
+    def search(self, query, top_k=10, mode='exact'):
+        """Поиск документов.
 
-        vocab = sorted(all_words)
-        tfidf_matrix = np.zeros((len(documents_tfidf), len(vocab)))
+        mode='exact' - косинус TF-IDF векторов, 'semantic' - косинус в
+        пространстве LSA (ValueError, если LSA-индекса нет).
+        """
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"неизвестный режим поиска: {mode}")
+        snapshot = self.snapshot
+        if mode == 'semantic' and snapshot.lsa is None:
+            raise ValueError("семантический режим недоступен: LSA-индекс не собран")
+        inc('vector_queries')
+        query_vector = self._process_query(query, snapshot)
+        if query_vector is None:
+            inc('vector_empty_results')
+            return []
 
-        for i, doc in enumerate(documents_tfidf):
-            for j, word in enumerate(vocab):
-                tfidf_matrix[i, j] = doc.get(word, 0.0)
+        if mode == 'semantic':
+            inc('semantic_queries')
+            top_indices, scores = snapshot.lsa.search(*query_vector, top_k)
+        elif snapshot.pruned is not None:
+            top_indices, scores = snapshot.pruned.top_k(*query_vector, top_k)
+        else:
+            similarities = score_documents(query_vector, snapshot.term_matrix)
+            top_indices = top_k_indices(similarities, top_k)
+            scores = similarities[top_indices]
+        if not len(top_indices):
+            inc('vector_empty_results')
+        return self._format_results(snapshot, top_indices, scores, self._query_terms(query))
 
-        return tfidf_matrix, vocab, filenames
+    def search_many(self, queries, top_k=10):
+        """Пакетный поиск: одна матрица запросов и одно произведение на все запросы"""
+        snapshot = self.snapshot
+        # те же счетчики, что у search, чтобы пакетные запросы были видны в /metrics
+        inc('vector_queries', len(queries))
+        query_matrix = process_queries(queries, snapshot.vocab, self.analyzer)
+        score_matrix = score_queries(query_matrix, snapshot.term_matrix)
+        results = []
+        for query, (top_indices, scores) in zip(queries, top_k_rows(score_matrix, top_k)):
+            if not len(top_indices):
+                inc('vector_empty_results')
+            results.append(self._format_results(snapshot, top_indices, scores,
+                                                self._query_terms(query)))
+        return results
 
-    def search(self, query, top_k=10):
-        """Поиск документов"""
-        query_vector = self._process_query(query)
-        if query_vector is None:
-            return []
+    def _format_results(self, snapshot, top_indices, scores, terms=()):
+        results = []
+        for idx, score in zip(top_indices, scores):
+            content, highlights = self._get_document_preview(snapshot, idx, terms)
+            results.append({
+                'document': snapshot.filenames[idx],
+                'url': snapshot.urls[idx],
+                'score': float(score),
+                'content': content,
+                # [начало, конец) совпавших с запросом слов в content
+                'highlights': highlights,
+            })
+        return results
 
-        similarities = cosine_similarity(
-            query_vector.reshape(1, -1),
-            self.tfidf_matrix
-        )[0]
-
-        top_indices = np.argsort(similarities)[-top_k:][::-1]
-        return [
-            {
-                'document': self.filenames[idx],
-                'url': self.url_mapping.get(self.filenames[idx], "#"),
-                'score': float(similarities[idx]),
-                'content': self._get_document_preview(idx)
-            }
-            for idx in top_indices
-        ]
-
-    def _process_query(self, query):
+    def _query_terms(self, query):
+        """Леммы запроса для подсветки во фрагментах (разбор запроса кэширован)"""
+        return self.analyzer(query) if self.analyzer else query.lower().split()
+
+    def _process_query(self, query, snapshot):
         """Обработка поискового запроса"""
-        query_words = query.lower().split()
-        vector = np.zeros(len(self.vocab))
-
-        for word in query_words:
-            if word in self.vocab:
-                idx = self.vocab.index(word)
-                vector[idx] += 1
-
-        if np.sum(vector) > 0:
-            vector /= len(query_words)
-            return vector
-        return None
-
-    def _get_document_preview(self, doc_idx):
-        filename = self.filenames[doc_idx]
-        try:
-            with open(os.path.join(self.data_dir, filename), 'r', encoding='utf-8') as f:
-                return f.read()[:300] + "..."
-        except:
-            return "Не удалось загрузить содержимое"
\ No newline at end of file
+        query_vector = process_query(query, snapshot.vocab, self.analyzer)
+        if len(query_vector[0]) == 0:
+            return None
+        return query_vector
+
+    @timed('preview_fetch')
+    def _get_document_preview(self, snapshot, doc_idx, terms=()):
+        """(фрагмент, подсветка): фрагмент текста статьи вокруг терминов запроса"""
+        key = (doc_idx, frozenset(terms))
+        preview = snapshot.preview_cache.get(key)
+        if preview is not None:
+            return preview
+
+        filename = snapshot.filenames[doc_idx]
+        text = None
+        if snapshot.doc_store is not None:
+            text = snapshot.doc_store.get(os.path.splitext(filename)[0])
+        if text is not None:
+            preview = make_snippet(text, terms, self.analyzer.lemma if self.analyzer else None)
+        else:
+            # хранилища текстов нет (старая сборка) - начало TF-IDF файла
+            try:
+                with open(os.path.join(self.data_dir, filename), 'r', encoding='utf-8') as f:
+                    preview = (f.read()[:300] + "...", [])
+            except:
+                return "Не удалось загрузить содержимое", []
+        snapshot.preview_cache.put(key, preview)
+        return preview
@@ -0,0 +1,8 @@
+"""Точка входа для WSGI-серверов.
+
+    gunicorn -c gunicorn.conf.py                  # pre-fork, индекс загружен в мастере
+    waitress-serve --threads=8 --listen=*:8000 wsgi:app   # один процесс, потоки
+"""
+from app import create_app
+
+app = create_app()
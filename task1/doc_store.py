@@ -0,0 +1,236 @@
+import os
+import re
+import mmap
+import zlib
+import shutil
+import argparse
+from functools import lru_cache
+
+import numpy as np
+
+from index_store import (Vocabulary, exists, load_array, new_version_dir, open_current, publish,
+                         read_meta, save_strings, write_meta)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DOC_STORE_DIR = os.path.join(BASE_DIR, 'doc_store')
+META_FILE = 'meta.json'
+BLOB_FILE = 'blocks.bin'
+FORMAT_VERSION = 1
+BLOCK_SIZE = 64 * 1024      # байт текста в блоке до сжатия
+COMPRESSION_LEVEL = 6
+BLOCK_CACHE_SIZE = 256      # распакованных блоков в памяти процесса
+
+SNIPPET_WORDS = 30          # длина фрагмента в словах
+SNIPPET_CONTEXT = 5         # слов перед первым совпадением
+SNIPPET_SCAN_CHARS = 20000  # совпадения ищутся в начале текста такой длины
+MAX_SNIPPET_HITS = 500
+# слова - как у токенизатора lemma_token_extractor
+WORD_RE = re.compile(r'[а-яА-ЯёЁa-zA-Z]+')
+
+# Хранилище текстов статей: один файл сжатых zlib-блоков и таблица
+# документ -> (блок, смещение в распакованном блоке, длина). Документы
+# пишутся подряд, блок закрывается, когда набирает BLOCK_SIZE байт.
+#   blocks.bin                   - сжатые блоки подряд
+#   blocks.offsets.npy           - границы блоков в blocks.bin
+#   docs.npy                     - (блок, смещение, длина) по номеру документа
+#   doc_names.blob/offsets.npy   - имена документов (page_N), отсортированы по байтам
+# Чтение документа - поиск имени, один срез отображенного в память файла и
+# распаковка одного блока, поэтому его цена не растет с размером корпуса.
+
+
+class DocStoreWriter:
+    """Потоковая запись хранилища; документы добавляются в любом порядке.
+
+    Хранилище пишется новой версией каталога store_dir (см. index_store) и
+    публикуется при close(); при исключении внутри with остается прежнее.
+    """
+
+    def __init__(self, store_dir=DOC_STORE_DIR, block_size=BLOCK_SIZE):
+        self.store_dir = store_dir
+        self.version, self.tmp_dir = new_version_dir(store_dir)
+        self.block_size = block_size
+        self.blob = open(os.path.join(self.tmp_dir, BLOB_FILE), 'wb')
+        self.block_offsets = [0]
+        self.buffer = []
+        self.buffered = 0
+        self.entries = {}
+
+    def add(self, doc_id, text):
+        data = text.encode('utf-8')
+        self.entries[doc_id] = (len(self.block_offsets) - 1, self.buffered, len(data))
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            self._flush_block()
+
+    def _flush_block(self):
+        if not self.buffer:
+            return
+        compressed = zlib.compress(b''.join(self.buffer), COMPRESSION_LEVEL)
+        self.blob.write(compressed)
+        self.block_offsets.append(self.block_offsets[-1] + len(compressed))
+        self.buffer = []
+        self.buffered = 0
+
+    def close(self):
+        self._flush_block()
+        self.blob.close()
+        names = sorted(self.entries, key=lambda name: name.encode('utf-8'))
+        save_strings(self.tmp_dir, 'doc_names', names)
+        docs = np.array([self.entries[name] for name in names], dtype=np.int64).reshape(-1, 3)
+        np.save(os.path.join(self.tmp_dir, 'docs.npy'), docs)
+        np.save(os.path.join(self.tmp_dir, 'blocks.offsets.npy'),
+                np.asarray(self.block_offsets, dtype=np.int64))
+
+        meta = {
+            'format': FORMAT_VERSION,
+            'version': self.version,
+            'compression': 'zlib',
+            'n_docs': len(names),
+            'n_blocks': len(self.block_offsets) - 1,
+            'text_bytes': int(docs[:, 2].sum()),
+            'stored_bytes': self.block_offsets[-1],
+        }
+        write_meta(self.tmp_dir, meta, META_FILE)
+        publish(self.store_dir, self.tmp_dir)
+        return meta
+
+    def abort(self):
+        self.blob.close()
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class DocStore:
+    """Открытое хранилище: текст документа по имени (store_dir - каталог версии)"""
+
+    def __init__(self, store_dir, cache_blocks=BLOCK_CACHE_SIZE):
+        self.store_dir = store_dir
+        self.meta = read_meta(store_dir, FORMAT_VERSION, META_FILE)
+
+        self.names = Vocabulary(self._array('doc_names.blob'), self._array('doc_names.offsets'))
+        self.docs = self._array('docs')
+        self.block_offsets = self._array('blocks.offsets')
+        self.blob = b''
+        with open(os.path.join(store_dir, BLOB_FILE), 'rb') as f:
+            if self.meta['stored_bytes']:
+                self.blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # часто показываемые документы не распаковываются заново
+        self._block = lru_cache(maxsize=cache_blocks)(self._read_block)
+
+    @property
+    def version(self):
+        return self.meta['version']
+
+    def __len__(self):
+        return self.meta['n_docs']
+
+    def __contains__(self, doc_id):
+        return self.names.get(doc_id) is not None
+
+    def _array(self, name):
+        return load_array(self.store_dir, name)
+
+    def _read_block(self, block):
+        start, end = self.block_offsets[block], self.block_offsets[block + 1]
+        return zlib.decompress(self.blob[start:end])
+
+    def get(self, doc_id, default=None):
+        i = self.names.get(doc_id)
+        if i is None:
+            return default
+        block, offset, length = (int(value) for value in self.docs[i])
+        return self._block(block)[offset:offset + length].decode('utf-8')
+
+
+def store_exists(store_dir):
+    return exists(store_dir, META_FILE)
+
+
+def open_doc_store(store_dir=DOC_STORE_DIR):
+    if not store_exists(store_dir):
+        raise FileNotFoundError(f"Хранилище текстов не найдено: {store_dir}")
+    return open_current(store_dir, DocStore)
+
+
+def make_snippet(text, terms, lemma=None, words=SNIPPET_WORDS):
+    """Фрагмент текста с наибольшим числом разных терминов запроса и
+    [(начало, конец)] совпавших слов во фрагменте.
+
+    terms - леммы запроса, lemma - приведение слова текста к лемме
+    (QueryAnalyzer.lemma); без него слова сравниваются как есть.
+    """
+    terms = set(terms)
+    spans = [match.span() for match in WORD_RE.finditer(text, 0, SNIPPET_SCAN_CHARS)]
+    if not spans:
+        return text[:300], []
+
+    hits = []   # (номер слова, термин)
+    if terms:
+        for i, (start, end) in enumerate(spans):
+            word = text[start:end].lower()
+            term = word if word in terms or lemma is None else lemma(word)
+            if term in terms:
+                hits.append((i, term))
+                if len(hits) == MAX_SNIPPET_HITS:
+                    break
+
+    # окно из words - SNIPPET_CONTEXT слов с первым совпадением в начале;
+    # лучшее - больше разных терминов, затем больше совпадений, затем раньше
+    first, best = 0, (0, 0)
+    span_words = max(words - SNIPPET_CONTEXT, 1)
+    for j, (i, _) in enumerate(hits):
+        window = [term for k, term in hits[j:j + span_words] if k < i + span_words]
+        score = (len(set(window)), len(window))
+        if score > best:
+            first, best = max(i - SNIPPET_CONTEXT, 0), score
+    last = min(first + words, len(spans))
+
+    start = spans[first][0] if first else 0
+    prefix = '...' if first else ''
+    if last < len(spans) or len(text) > SNIPPET_SCAN_CHARS:
+        end, suffix = spans[last - 1][1], '...'
+    else:
+        end, suffix = len(text), ''
+    shift = len(prefix) - start
+    highlights = [(spans[i][0] + shift, spans[i][1] + shift) for i, _ in hits if first <= i < last]
+    return prefix + text[start:end] + suffix, highlights
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Хранилище текстов статей")
+    parser.add_argument('doc_id', nargs='?', help="показать текст документа (page_N)")
+    parser.add_argument('--store', default=DOC_STORE_DIR)
+    parser.add_argument('--query', default='', help="показать фрагмент для запроса")
+    args = parser.parse_args()
+
+    store = open_doc_store(args.store)
+    if not args.doc_id:
+        meta = store.meta
+        print(f"Хранилище: {args.store}\n- Документов: {meta['n_docs']}\n- Блоков: {meta['n_blocks']}\n"
+              f"- Текст: {meta['text_bytes']} байт, на диске: {meta['stored_bytes']} байт")
+        return
+    text = store.get(args.doc_id)
+    if text is None:
+        print(f"[ОШИБКА] Документ не найден: {args.doc_id}")
+    elif args.query:
+        from query_analyzer import load_query_analyzer
+        analyzer = load_query_analyzer()
+        terms = analyzer(args.query) if analyzer else args.query.lower().split()
+        snippet, highlights = make_snippet(text, terms, analyzer.lemma if analyzer else None)
+        print(snippet)
+        print(f"Совпадений во фрагменте: {len(highlights)}")
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+import os
+import re
+import sys
+import time
+from html.parser import HTMLParser
+
+# Потоковое извлечение текста статьи - тот же результат, что у разбора через
+# BeautifulSoup в lemma_token_extractor, но без построения дерева и без
+# повторных обходов: ненужные поддеревья пропускаются прямо при разборе.
+
+# удаляются вместе с содержимым по всему документу
+SKIP_TAGS = {'script', 'style', 'meta', 'link', 'footer', 'header', 'nav', 'noscript',
+             'iframe', 'svg', 'img', 'button'}
+# удаляются только внутри тела статьи
+BODY_SKIP_TAGS = {'pre', 'code'}
+# элементы без закрывающего тега (как в BeautifulSoup)
+VOID_TAGS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link',
+             'menuitem', 'meta', 'param', 'source', 'track', 'wbr', 'basefont', 'bgsound',
+             'command', 'frame', 'image', 'isindex', 'nextid', 'spacer'}
+ARTICLE_CLASS = 'tm-article-body'
+
+
+class ArticleTextParser(HTMLParser):
+    """Собирает строки текста документа, первого div.tm-article-body и первого article"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.stack = []            # открытые элементы: [тег, пропуск, тело, pre/code]
+        self.skip_depth = 0
+        self.body_skip_depth = 0
+        self.buffer = []
+        self.all_strings = []
+        # для каждого кандидата: строки и признак "сейчас внутри"
+        self.div_strings = None
+        self.article_strings = None
+        self.in_div = False
+        self.in_article = False
+
+    def _flush(self):
+        # соседние куски данных между тегами - одна строка, как в BeautifulSoup
+        if not self.buffer:
+            return
+        text = ''.join(self.buffer).strip()
+        self.buffer = []
+        if not text or self.skip_depth:
+            return
+        self.all_strings.append(text)
+        if not self.body_skip_depth:
+            if self.in_div:
+                self.div_strings.append(text)
+            if self.in_article:
+                self.article_strings.append(text)
+
+    def handle_starttag(self, tag, attrs):
+        self._flush()
+        if tag in VOID_TAGS:
+            return
+
+        skip = tag in SKIP_TAGS
+        body_skip = tag in BODY_SKIP_TAGS and (self.in_div or self.in_article)
+        opens = None
+        if not self.skip_depth and not skip:
+            if tag == 'div' and self.div_strings is None:
+                classes = (dict(attrs).get('class') or '').split()
+                if ARTICLE_CLASS in classes:
+                    self.div_strings = []
+                    self.in_div = True
+                    opens = 'div'
+            elif tag == 'article' and self.article_strings is None:
+                self.article_strings = []
+                self.in_article = True
+                opens = 'article'
+
+        self.stack.append([tag, skip, opens, body_skip])
+        self.skip_depth += skip
+        self.body_skip_depth += body_skip
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_TAGS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        self._flush()
+        for pos in range(len(self.stack) - 1, -1, -1):
+            if self.stack[pos][0] == tag:
+                break
+        else:
+            return
+        while len(self.stack) > pos:
+            _, skip, opens, body_skip = self.stack.pop()
+            self.skip_depth -= skip
+            self.body_skip_depth -= body_skip
+            if opens == 'div':
+                self.in_div = False
+            elif opens == 'article':
+                self.in_article = False
+
+    def handle_data(self, data):
+        self.buffer.append(data)
+
+    def handle_comment(self, data):
+        self._flush()
+
+    def handle_decl(self, decl):
+        self._flush()
+
+    def handle_pi(self, data):
+        self._flush()
+
+    def text(self):
+        self.close()
+        self._flush()
+        for strings in (self.div_strings, self.article_strings):
+            if strings is not None:
+                return ' '.join(strings)
+        return ' '.join(self.all_strings)
+
+
+def extract_article_text(html, lower=True):
+    parser = ArticleTextParser()
+    parser.feed(html)
+    text = re.sub(r'\s+', ' ', parser.text())
+    return text.lower() if lower else text
+
+
+def benchmark(pages_dir):
+    """Сравнение скорости и результата с разбором через BeautifulSoup"""
+    import lemma_token_extractor
+
+    files = sorted(os.path.join(pages_dir, f) for f in os.listdir(pages_dir) if f.endswith('.html'))
+    timings = {}
+    outputs = {}
+    for backend in lemma_token_extractor.HTML_BACKENDS:
+        start = time.perf_counter()
+        outputs[backend] = [lemma_token_extractor.extract_text_from_html(path, backend) for path in files]
+        timings[backend] = (time.perf_counter() - start) / max(len(files), 1)
+
+    mismatches = sum(a != b for a, b in zip(outputs['bs4'], outputs['stream']))
+    for backend, seconds in timings.items():
+        print(f"{backend:>6}: {seconds * 1000:.2f} мс/страница")
+    print(f"Ускорение: {timings['bs4'] / timings['stream']:.1f}x, "
+          f"расхождений: {mismatches} из {len(files)}")
+
+
+if __name__ == '__main__':
+    benchmark(sys.argv[1] if len(sys.argv) > 1 else 'pages')
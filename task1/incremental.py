@@ -0,0 +1,467 @@
+import os
+import math
+import shutil
+import sqlite3
+import hashlib
+import argparse
+from collections import Counter
+
+import numpy as np
+from scipy import sparse
+
+from index_store import (COMPILED_INDEX_DIR, INDEX_FILE, load_array, open_index, save_postings,
+                         save_vector_index)
+from search import top_k_indices
+from tf_idf_extractor import TFIDF_THRESHOLD
+from query_analyzer import load_query_analyzer
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PAGES_DIR = os.path.join(BASE_DIR, 'pages')
+INCREMENTAL_DIR = os.path.join(BASE_DIR, 'incremental_index')
+STATE_FILE = 'state.sqlite'
+SEGMENT_PREFIX = 'seg_'
+MERGE_FACTOR = 4    # сегментов одного уровня, которые сливаются в один
+
+# Инкрементальный индекс - набор неизменяемых сегментов (формат index_store,
+# веса - TF леммы в документе) и state.sqlite с изменяемым состоянием:
+#   files    - имя страницы -> mtime, размер, sha1, сегмент и номер в нем
+#   segments - сегмент -> число документов и число удаленных
+#   deleted  - удаленные (устаревшие) номера документов по сегментам
+#   df       - документная частота каждой леммы по живым документам
+# Обновление меняет только строки затронутых страниц и лемм. Кроме списков
+# по терминам сегмент хранит списки лемм по документам (doc_terms.indptr,
+# doc_terms.cols - номера столбцов), поэтому удаление документа уменьшает DF
+# без просмотра сегмента.
+# IDF считается при запросе из df, поэтому добавление страниц не требует
+# переписывать веса уже проиндексированных документов.
+# Сегменты сливаются по уровням размера: уровень k - сегменты с числом живых
+# документов в [F^k, F^(k+1)), F = MERGE_FACTOR. Когда на уровне набирается F
+# сегментов, они сливаются в один (он попадает уровнем выше), так что каждый
+# документ переписывается O(log N) раз, а не при каждом слиянии.
+# Инкрементально обновляется только сам набор сегментов: его поиск (search,
+# команда search) видит изменения сразу после update. demo/search_engine
+# сегменты не читает - он обслуживает компилированный индекс, а compile
+# собирает его заново из всех живых документов, то есть за O(корпуса), как и
+# пересборка LSA после него. Это периодический пакетный шаг (например, по
+# расписанию), а не часть каждого update.
+
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def lemma_tf(lemma_dict):
+    """TF лемм так же, как в tf_idf_extractor: доля словоформ леммы"""
+    total = sum(len(forms) for forms in lemma_dict.values())
+    return {lemma: len(forms) / total for lemma, forms in lemma_dict.items()}
+
+
+def idf(df, n_docs):
+    return math.log((n_docs + 1) / (df + 1))
+
+
+def document_weights(tf_matrix, idf_cols):
+    """Веса документов как у индекса из файлов tf_idf_extractor (см.
+    search.load_tfidf_data): idf * tfidf, где tfidf = tf * idf не меньше
+    TFIDF_THRESHOLD"""
+    idf_diag = sparse.diags(np.asarray(idf_cols, dtype=np.float64))
+    tfidf = (tf_matrix @ idf_diag).tocsr()
+    tfidf.data[tfidf.data < TFIDF_THRESHOLD] = 0
+    tfidf.eliminate_zeros()
+    return (tfidf @ idf_diag).tocsr()
+
+
+def doc_name(filename):
+    """Имя документа, как у остальных индексов: page_N.html -> page_N.txt"""
+    return os.path.splitext(filename)[0] + '.txt'
+
+
+def size_tier(n_docs):
+    """Уровень сегмента: floor(log_F(n_docs))"""
+    tier = 0
+    while n_docs >= MERGE_FACTOR:
+        n_docs //= MERGE_FACTOR
+        tier += 1
+    return tier
+
+
+def doc_terms_arrays(matrix):
+    """Списки столбцов по документам из CSR-матрицы документы x термины"""
+    return {'doc_terms.indptr': np.asarray(matrix.indptr, dtype=np.int64),
+            'doc_terms.cols': np.asarray(matrix.indices, dtype=np.int32)}
+
+
+class IncrementalIndex:
+    def __init__(self, index_dir=INCREMENTAL_DIR):
+        self.index_dir = index_dir
+        os.makedirs(index_dir, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(index_dir, STATE_FILE), timeout=30)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (filename TEXT PRIMARY KEY, mtime REAL, size INTEGER,
+                                              sha1 TEXT, segment TEXT, doc INTEGER);
+            CREATE INDEX IF NOT EXISTS files_segment ON files (segment);
+            CREATE TABLE IF NOT EXISTS segments (name TEXT PRIMARY KEY, n_docs INTEGER,
+                                                 n_deleted INTEGER);
+            CREATE TABLE IF NOT EXISTS deleted (segment TEXT, doc INTEGER);
+            CREATE INDEX IF NOT EXISTS deleted_segment ON deleted (segment);
+            CREATE TABLE IF NOT EXISTS df (term TEXT PRIMARY KEY, df INTEGER);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER);
+        """)
+        self._segments = {}
+        self._doc_terms = {}
+        self._deleted = {}
+        self._weights = {}
+        self._df = None
+
+    @property
+    def segment_names(self):
+        return [name for name, in self.db.execute("SELECT name FROM segments ORDER BY name")]
+
+    @property
+    def df(self):
+        """DF всех лемм: читается из базы один раз и дальше меняется вместе с ней"""
+        if self._df is None:
+            self._df = dict(self.db.execute("SELECT term, df FROM df"))
+        return self._df
+
+    @property
+    def n_docs(self):
+        return self.db.execute("SELECT COALESCE(SUM(n_docs - n_deleted), 0) FROM segments").fetchone()[0]
+
+    def segment(self, name):
+        if name not in self._segments:
+            self._segments[name] = open_index(os.path.join(self.index_dir, name))
+        return self._segments[name]
+
+    def _deleted_docs(self, name):
+        if name not in self._deleted:
+            self._deleted[name] = np.fromiter(
+                (doc for doc, in self.db.execute("SELECT doc FROM deleted WHERE segment = ?", (name,))),
+                dtype=np.int64)
+        return self._deleted[name]
+
+    def _changed(self):
+        # удаленные документы и веса (они зависят от IDF) читаются заново
+        self._deleted = {}
+        self._weights = {}
+
+    def _next_segment_name(self):
+        """Имя нового сегмента. Счетчик сохраняется вместе с остальными изменениями,
+        поэтому каталог сегмента, записанного перед сбоем, будет просто перезаписан."""
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'next_segment'").fetchone()
+        number = row[0] if row else 1
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('next_segment', ?)", (number + 1,))
+        return f"{SEGMENT_PREFIX}{number:06d}"
+
+    def scan(self, pages_dir=PAGES_DIR):
+        """Новые/измененные и удаленные страницы относительно состояния индекса"""
+        known = {filename: (mtime, size, sha1) for filename, mtime, size, sha1
+                 in self.db.execute("SELECT filename, mtime, size, sha1 FROM files")}
+        changed = []
+        touched = []
+        current = set()
+        for filename in sorted(os.listdir(pages_dir)):
+            if not filename.endswith('.html'):
+                continue
+            current.add(filename)
+            path = os.path.join(pages_dir, filename)
+            stat = os.stat(path)
+            entry = known.get(filename)
+            if entry and entry[0] == stat.st_mtime and entry[1] == stat.st_size:
+                continue
+            # mtime мог измениться без изменения содержимого
+            digest = file_hash(path)
+            if entry and entry[2] == digest:
+                touched.append((stat.st_mtime, stat.st_size, filename))
+                continue
+            changed.append((filename, stat.st_mtime, stat.st_size, digest))
+        self.db.executemany("UPDATE files SET mtime = ?, size = ? WHERE filename = ?", touched)
+        removed = [filename for filename in known if filename not in current]
+        return changed, removed
+
+    def _doc_term_list(self, name, doc):
+        if name not in self._doc_terms:
+            index_dir = self.segment(name).index_dir
+            self._doc_terms[name] = (load_array(index_dir, 'doc_terms.indptr'),
+                                     load_array(index_dir, 'doc_terms.cols'))
+        indptr, cols = self._doc_terms[name]
+        vocab = self.segment(name).vocab
+        return [vocab[int(col)] for col in cols[indptr[doc]:indptr[doc + 1]]]
+
+    def _delete(self, filenames, df_delta):
+        for filename in filenames:
+            row = self.db.execute("SELECT segment, doc FROM files WHERE filename = ?",
+                                  (filename,)).fetchone()
+            if row is None:
+                continue
+            self.db.execute("DELETE FROM files WHERE filename = ?", (filename,))
+            name, doc = row
+            if not name:
+                continue
+            self.db.execute("INSERT INTO deleted VALUES (?, ?)", (name, doc))
+            self.db.execute("UPDATE segments SET n_deleted = n_deleted + 1 WHERE name = ?", (name,))
+            df_delta.subtract(self._doc_term_list(name, doc))
+
+    def _apply_df(self, df_delta):
+        changes = [(term, value) for term, value in df_delta.items() if value]
+        self.db.executemany("INSERT INTO df VALUES (?, ?) "
+                            "ON CONFLICT (term) DO UPDATE SET df = df + excluded.df", changes)
+        self.db.executemany("DELETE FROM df WHERE term = ? AND df <= 0",
+                            [(term,) for term, _ in changes])
+        if self._df is not None:
+            for term, value in changes:
+                self._df[term] = self._df.get(term, 0) + value
+                if self._df[term] <= 0:
+                    del self._df[term]
+
+    def _write_segment(self, docs, df_delta):
+        """docs - список (имя страницы, {лемма: tf}); пишет новый сегмент"""
+        name = self._next_segment_name()
+
+        postings = {}
+        for doc, (_, tf) in enumerate(docs):
+            for term, value in tf.items():
+                postings.setdefault(term, []).append((doc, value))
+            df_delta.update(tf.keys())
+
+        terms = sorted(postings, key=lambda term: term.encode('utf-8'))
+        columns = {term: col for col, term in enumerate(terms)}
+        indptr = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum([len(postings[term]) for term in terms], out=indptr[1:])
+        pairs = [pair for term in terms for pair in postings[term]]
+        doc_ids = np.fromiter((doc for doc, _ in pairs), dtype=np.int64, count=len(pairs))
+        weights = np.fromiter((value for _, value in pairs), dtype=np.float32, count=len(pairs))
+        doc_indptr = np.zeros(len(docs) + 1, dtype=np.int64)
+        np.cumsum([len(tf) for _, tf in docs], out=doc_indptr[1:])
+        doc_cols = np.fromiter((columns[term] for _, tf in docs for term in tf), dtype=np.int32,
+                               count=doc_indptr[-1])
+        save_postings(os.path.join(self.index_dir, name), terms, indptr, doc_ids,
+                      [filename for filename, _ in docs], weights=weights,
+                      extra={'doc_terms.indptr': doc_indptr, 'doc_terms.cols': doc_cols})
+
+        self.db.execute("INSERT INTO segments VALUES (?, ?, 0)", (name, len(docs)))
+        self.db.executemany("UPDATE files SET segment = ?, doc = ? WHERE filename = ?",
+                            [(name, doc, filename) for doc, (filename, _) in enumerate(docs)])
+        return name
+
+    def update(self, pages_dir=PAGES_DIR, analyze=None):
+        """Переиндексирует только новые и измененные страницы"""
+        if analyze is None:
+            import lemma_token_extractor
+            lemma_token_extractor.init_analyzers(lemma_token_extractor.LEMMA_CACHE_FILE)
+            analyze = lambda filename: lemma_token_extractor.analyze_file(filename, pages_dir)
+
+        changed, removed = self.scan(pages_dir)
+        df_delta = Counter()
+        self._delete(removed + [filename for filename, *_ in changed], df_delta)
+
+        docs = []
+        for filename, mtime, size, digest in changed:
+            self.db.execute("INSERT INTO files (filename, mtime, size, sha1) VALUES (?, ?, ?, ?)",
+                            (filename, mtime, size, digest))
+            result = analyze(filename)
+            if result is not None and result[1]:
+                docs.append((filename, lemma_tf(result[1])))
+
+        if docs:
+            self._write_segment(docs, df_delta)
+        self._apply_df(df_delta)
+        self.db.commit()
+        self._changed()
+        merges = self.merge_tiers()
+        return {'changed': len(changed), 'removed': len(removed), 'indexed': len(docs),
+                'merges': merges}
+
+    def merge_tiers(self):
+        """Слияние сегментов по уровням размера; возвращает число слияний"""
+        merges = 0
+        while True:
+            tiers = {}
+            for name, n_docs, n_deleted in self.db.execute(
+                    "SELECT name, n_docs, n_deleted FROM segments ORDER BY name"):
+                tiers.setdefault(size_tier(n_docs - n_deleted), []).append(name)
+            full = [names for _, names in sorted(tiers.items()) if len(names) >= MERGE_FACTOR]
+            if not full:
+                return merges
+            self.merge(full[0][:MERGE_FACTOR])
+            merges += 1
+
+    def _live_matrix(self, names):
+        """(CSR-матрица TF живых документы x термины, термины, имена страниц) сегментов names"""
+        terms = sorted({term for name in names for term in self.segment(name).vocab},
+                       key=lambda term: term.encode('utf-8'))
+        columns = {term: col for col, term in enumerate(terms)}
+        blocks = []
+        filenames = []
+        for name in names:
+            segment = self.segment(name)
+            live = np.setdiff1d(np.arange(segment.n_docs), self._deleted_docs(name))
+            remap = np.fromiter((columns[term] for term in segment.vocab), dtype=np.int64,
+                                count=len(segment.vocab))
+            block = segment.term_matrix().tocoo()
+            block = sparse.csr_matrix((block.data, (block.row, remap[block.col])),
+                                      shape=(segment.n_docs, len(terms)))
+            blocks.append(block[live])
+            filenames.extend(segment.filenames[int(doc)] for doc in live)
+        matrix = sparse.vstack(blocks, format='csr') if blocks else sparse.csr_matrix((0, 0))
+        return matrix, terms, filenames
+
+    def merge(self, names=None):
+        """Сливает сегменты names (по умолчанию все) в один, отбрасывая удаленные документы"""
+        names = names or self.segment_names
+        if not names:
+            return None
+
+        merged, terms, filenames = self._live_matrix(names)
+        name = None
+        if filenames:
+            merged = merged.tocsc()
+            # леммы, оставшиеся только в удаленных документах, в сегмент не попадают
+            nonempty = np.flatnonzero(np.diff(merged.indptr))
+            merged = merged[:, nonempty]
+            merged.sort_indices()
+            terms = [terms[col] for col in nonempty]
+            name = self._next_segment_name()
+            save_postings(os.path.join(self.index_dir, name), terms, merged.indptr, merged.indices,
+                          filenames, weights=merged.data, extra=doc_terms_arrays(merged.tocsr()))
+            self.db.execute("INSERT INTO segments VALUES (?, ?, 0)", (name, len(filenames)))
+            self.db.executemany("UPDATE files SET segment = ?, doc = ? WHERE filename = ?",
+                                [(name, doc, filename) for doc, filename in enumerate(filenames)])
+        self.db.executemany("DELETE FROM segments WHERE name = ?", [(old,) for old in names])
+        self.db.executemany("DELETE FROM deleted WHERE segment = ?", [(old,) for old in names])
+        self.db.commit()
+        self._changed()
+
+        # старые сегменты удаляются только после записи состояния
+        for old in names:
+            self._segments.pop(old, None)
+            self._doc_terms.pop(old, None)
+        self._remove_unused_segments()
+        return name
+
+    def _remove_unused_segments(self):
+        """Каталоги сегментов, которых нет в состоянии (в том числе оставшиеся после сбоя)"""
+        used = set(self.segment_names)
+        for entry in os.listdir(self.index_dir):
+            if entry.startswith(SEGMENT_PREFIX) and entry not in used:
+                shutil.rmtree(os.path.join(self.index_dir, entry), ignore_errors=True)
+
+    def compile(self, out_dir=COMPILED_INDEX_DIR, index_file=INDEX_FILE):
+        """Компилированный индекс (index_store) по живым документам при текущих DF;
+        веса - document_weights, документы по имени файла. Полная сборка по
+        всему корпусу - пакетный шаг, см. комментарий в начале модуля."""
+        matrix, terms, filenames = self._live_matrix(self.segment_names)
+        if not filenames:
+            raise ValueError(f"Инкрементальный индекс пуст: {self.index_dir}")
+        idf_cols = [idf(self.df.get(term, 0), len(filenames)) for term in terms]
+        names = [doc_name(filename) for filename in filenames]
+        order = np.argsort(np.array(names, dtype=object), kind='stable')
+        weights = document_weights(matrix, idf_cols)[order].astype(np.float32)
+        vocab = {term: col for col, term in enumerate(terms)}
+        return save_vector_index(out_dir, weights, vocab, [names[i] for i in order], index_file)
+
+    def _segment_weights(self, name):
+        """(CSC-матрица весов документов сегмента, L2-нормы строк) при текущих DF"""
+        if name not in self._weights:
+            segment = self.segment(name)
+            n_docs = self.n_docs
+            idf_cols = [idf(self.df.get(term, 0), n_docs) for term in segment.vocab]
+            weights = document_weights(segment.term_matrix(), idf_cols)
+            norms = np.sqrt(np.asarray(weights.multiply(weights).sum(axis=1)).ravel())
+            self._weights[name] = (weights.tocsc(), norms)
+        return self._weights[name]
+
+    def search(self, query, top_k=10, analyzer=None):
+        """Косинусная близость с весами document_weights при текущих DF, как у
+        компилированного индекса; [(документ page_N.txt, оценка)].
+
+        analyzer (QueryAnalyzer) приводит слова запроса к леммам индекса.
+        """
+        query_words = analyzer(query) if analyzer else query.lower().split()
+        counts = {}
+        for word in query_words:
+            if word in self.df:
+                counts[word] = counts.get(word, 0) + 1
+        if not counts:
+            return []
+        query_weights = {term: count / len(query_words) for term, count in counts.items()}
+        query_norm = math.sqrt(sum(w * w for w in query_weights.values()))
+
+        all_scores = []
+        owners = []
+        for name in self.segment_names:
+            segment = self.segment(name)
+            weights, norms = self._segment_weights(name)
+            cols = []
+            values = []
+            for term, weight in query_weights.items():
+                col = segment.vocab.get(term)
+                if col is not None:
+                    cols.append(col)
+                    values.append(weight)
+            scores = np.zeros(segment.n_docs, dtype=np.float32)
+            if cols:
+                scores[:] = weights[:, cols] @ np.asarray(values)
+            np.divide(scores, norms * query_norm, out=scores, where=norms > 0)
+            scores[self._deleted_docs(name)] = 0
+            all_scores.append(scores)
+            owners.append(segment)
+
+        offsets = np.cumsum([0] + [len(scores) for scores in all_scores])
+        scores = np.concatenate(all_scores) if all_scores else np.zeros(0, dtype=np.float32)
+        results = []
+        for idx in top_k_indices(scores, top_k):
+            seg = np.searchsorted(offsets, idx, side='right') - 1
+            filename = owners[seg].filenames[int(idx - offsets[seg])]
+            results.append((doc_name(filename), float(scores[idx])))
+        return results
+
+
+def compile_and_refresh(index, out_dir):
+    """Публикация компилированного индекса и пересборка LSA-индекса по нему"""
+    from lsa import LSA_DIR, refresh_lsa_index
+
+    meta = index.compile(out_dir)
+    print(f"Компилированный индекс сохранен в: {out_dir}, документов: {meta['n_docs']}")
+    if refresh_lsa_index(out_dir):
+        print(f"LSA-индекс пересобран: {LSA_DIR}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Инкрементальный индекс по сегментам")
+    parser.add_argument('command', choices=('update', 'merge', 'compile', 'search'))
+    parser.add_argument('query', nargs='?', default='')
+    parser.add_argument('--pages', default=PAGES_DIR, help="папка с HTML-страницами")
+    parser.add_argument('--index', default=INCREMENTAL_DIR, help="папка инкрементального индекса")
+    parser.add_argument('--out', default=COMPILED_INDEX_DIR,
+                        help="компилированный индекс для compile и update --compile")
+    parser.add_argument('--compile', action='store_true',
+                        help="после update пересобрать компилированный индекс целиком "
+                             "(полная сборка по корпусу, а не по изменениям)")
+    args = parser.parse_args()
+
+    index = IncrementalIndex(args.index)
+    if args.command == 'update':
+        stats = index.update(args.pages)
+        print(f"Изменено/новых: {stats['changed']}, удалено: {stats['removed']}, "
+              f"проиндексировано: {stats['indexed']}, слияний: {stats['merges']}, "
+              f"сегментов: {len(index.segment_names)}")
+        if args.compile and (stats['changed'] or stats['removed']):
+            compile_and_refresh(index, args.out)
+    elif args.command == 'merge':
+        index.merge()
+        print(f"Сегменты слиты, документов: {index.n_docs}")
+    elif args.command == 'compile':
+        compile_and_refresh(index, args.out)
+    else:
+        results = index.search(args.query, analyzer=load_query_analyzer())
+        for i, (filename, score) in enumerate(results, 1):
+            print(f"{i}. {filename} (сходство: {score:.4f})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,455 @@
+import os
+import json
+import time
+import fcntl
+import shutil
+import uuid
+from contextlib import contextmanager
+import numpy as np
+from scipy import sparse
+
+from search import TFIDF_RESULTS_DIR, load_tfidf_data, load_url_mapping, normalize_rows
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+COMPILED_INDEX_DIR = os.path.join(BASE_DIR, "compiled_index")
+INDEX_FILE = os.path.join(BASE_DIR, "index.txt")
+META_FILE = "meta.json"
+POINTER_FILE = "CURRENT"
+VERSION_PREFIX = "v-"
+PUBLISHED_FILE = "PUBLISHED"
+LOCK_FILE = ".lock"
+STALE_BUILD_AGE = 24 * 3600  # с; неопубликованная версия старше этого брошена
+FORMAT_VERSION = 1
+OPEN_ATTEMPTS = 3
+
+# Компилированный индекс - каталог с .npy-массивами, которые открываются
+# через np.load(mmap_mode='r'): загрузка не копирует данные, а страницы
+# файлов разделяются между всеми процессами, открывшими индекс.
+#   terms.blob/terms.offsets        - словарь (UTF-8, отсортирован по байтам)
+#   postings.indptr                 - границы списков для каждого термина
+#   postings.doc_ids                - номера документов в списках
+#   postings.doc_gaps               - то же в сжатом виде: разности соседних
+#                                     номеров внутри списка, varint-кодирование
+#   postings.weights                - веса (строки матрицы нормированы по L2)
+#   impact.doc_ids/impact.weights   - те же списки по убыванию веса (для
+#                                     поиска с отсечением, см. maxscore)
+#   terms.max_weight                - максимальный вес в списке термина
+#   doc_norms                       - исходные L2-нормы документов
+#   doc_names.*/doc_urls.*          - таблицы имен файлов и URL по номеру документа
+#
+# Каталог индекса (как и хранилища текстов, LSA и шардов) хранит версии:
+# каждая сборка пишется в новый подкаталог v-<версия> и после записи
+# публикуется атомарной заменой файла-указателя CURRENT. Опубликованная
+# версия не меняется, поэтому читатель, открывший ее по указателю, никогда не
+# видит смесь файлов двух сборок или пропавший на время подмены каталог.
+# Предыдущая версия остается на диске до следующей публикации - ее еще могут
+# дочитывать процессы, открывшие ее до подмены. Публикации в один каталог
+# идут под блокировкой (.lock), а очистка не трогает каталоги, которые еще не
+# публиковались (отметка PUBLISHED): их может дописывать параллельная сборка.
+
+
+def varint_encode(values):
+    """Кодирование неотрицательных целых в varint (7 бит на байт)"""
+    values = np.asarray(values, dtype=np.uint64)
+    n_bytes = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 10):
+        n_bytes += values >= np.uint64(1 << (7 * k))
+    starts = np.zeros(len(values), dtype=np.int64)
+    np.cumsum(n_bytes[:-1], out=starts[1:])
+
+    out = np.empty(int(n_bytes.sum()), dtype=np.uint8)
+    for k in range(int(n_bytes.max()) if len(values) else 0):
+        mask = n_bytes > k
+        chunk = (values[mask] >> np.uint64(7 * k)) & np.uint64(0x7f)
+        more = np.where(n_bytes[mask] > k + 1, 0x80, 0).astype(np.uint64)
+        out[starts[mask] + k] = chunk | more
+    return out
+
+
+def varint_decode(buf):
+    """Обратное к varint_encode, векторизованно по всему буферу"""
+    buf = np.asarray(buf, dtype=np.uint8)
+    ends = np.flatnonzero(buf < 0x80)
+    if not len(ends):
+        return np.zeros(0, dtype=np.uint64)
+    starts = np.zeros(len(ends), dtype=np.int64)
+    starts[1:] = ends[:-1] + 1
+    shifts = np.arange(len(buf), dtype=np.int64) - np.repeat(starts, ends - starts + 1)
+    parts = (buf & 0x7f).astype(np.uint64) << (7 * shifts).astype(np.uint64)
+    return np.bitwise_or.reduceat(parts, starts)
+
+
+def delta_encode(indptr, doc_ids):
+    """Разности соседних номеров внутри каждого списка; первый номер - как есть"""
+    doc_ids = np.asarray(doc_ids, dtype=np.int64)
+    gaps = np.diff(doc_ids, prepend=0)
+    starts = np.asarray(indptr[:-1], dtype=np.int64)
+    starts = starts[starts < len(doc_ids)]
+    gaps[starts] = doc_ids[starts]
+    return varint_encode(gaps)
+
+
+def delta_decode(indptr, blob, dtype=np.uint32):
+    """Восстановление номеров документов по разностям сегментированной суммой"""
+    totals = np.cumsum(varint_decode(blob), dtype=np.uint64)
+    indptr = np.asarray(indptr, dtype=np.int64)
+    counts = np.diff(indptr)
+    bases = np.zeros(len(counts), dtype=np.uint64)
+    nonfirst = indptr[:-1] > 0
+    bases[nonfirst] = totals[indptr[:-1][nonfirst] - 1]
+    return (totals - np.repeat(bases, counts)).astype(dtype)
+
+
+class StringTable:
+    """Таблица строк поверх склеенного UTF-8 блоба и массива смещений"""
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class Vocabulary(StringTable):
+    """Отсортированный словарь: термин -> номер столбца бинарным поиском"""
+
+    def get(self, term, default=None):
+        key = term.encode('utf-8')
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            value = bytes(self.blob[self.offsets[mid]:self.offsets[mid + 1]])
+            if value < key:
+                lo = mid + 1
+            elif value > key:
+                hi = mid
+            else:
+                return mid
+        return default
+
+    def __contains__(self, term):
+        return self.get(term) is not None
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            col = self.get(key)
+            if col is None:
+                raise KeyError(key)
+            return col
+        return super().__getitem__(key)
+
+
+class CompiledIndex:
+    """Открытый компилированный индекс; массивы отображены в память"""
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self.meta = read_meta(index_dir, FORMAT_VERSION)
+
+        self.vocab = Vocabulary(self._array('terms.blob'), self._array('terms.offsets'))
+        self.filenames = StringTable(self._array('doc_names.blob'), self._array('doc_names.offsets'))
+        self.indptr = self._array('postings.indptr')
+        self.doc_ids = self._array('postings.doc_ids', required=False)
+        if self.doc_ids is None:
+            # сжатые списки распаковываются один раз в общий массив uint32
+            self.doc_ids = delta_decode(self.indptr, self._array('postings.doc_gaps'))
+        self.weights = self._array('postings.weights', required=False)
+        # в индексах старых сборок списков по весу нет
+        self.impact_doc_ids = self._array('impact.doc_ids', required=False)
+        self.impact_weights = self._array('impact.weights', required=False)
+        self.max_weights = self._array('terms.max_weight', required=False)
+        self.doc_norms = self._array('doc_norms', required=False)
+        urls_blob = self._array('doc_urls.blob', required=False)
+        self.urls = None
+        if urls_blob is not None:
+            self.urls = StringTable(urls_blob, self._array('doc_urls.offsets'))
+
+    @property
+    def version(self):
+        return self.meta['version']
+
+    @property
+    def n_docs(self):
+        return self.meta['n_docs']
+
+    def _array(self, name, required=True):
+        return load_array(self.index_dir, name, required)
+
+    def postings(self, col):
+        """Номера документов (и веса, если есть) для столбца термина"""
+        start, end = self.indptr[col], self.indptr[col + 1]
+        weights = self.weights[start:end] if self.weights is not None else None
+        return self.doc_ids[start:end], weights
+
+    def term_matrix(self):
+        """CSC-матрица документы x термины поверх отображенных массивов"""
+        if self.weights is None:
+            raise ValueError("В индексе нет весов терминов")
+        # при совпадающих типах индексов scipy не копирует массивы
+        return sparse.csc_matrix(
+            (self.weights, self.doc_ids, self.indptr),
+            shape=(self.n_docs, len(self.vocab)),
+            copy=False
+        )
+
+
+def impact_order(indptr, doc_ids, weights):
+    """Списки по убыванию веса (при равных весах - по номеру документа)
+    и максимальный вес каждого термина. Номера документов внутри списков
+    должны возрастать, веса - быть неотрицательными."""
+    indptr = np.asarray(indptr, dtype=np.int64)
+    doc_ids = np.asarray(doc_ids)
+    weights = np.asarray(weights, dtype=np.float32)
+    cols = np.repeat(np.arange(len(indptr) - 1, dtype=np.uint64), np.diff(indptr))
+    # биты неотрицательного float32 упорядочены так же, как значения, поэтому
+    # один ключ (столбец, инвертированный вес) сортирует по столбцу и убыванию
+    # веса; устойчивая сортировка сохраняет порядок документов при равных весах
+    key = (cols << np.uint64(32)) | (np.uint32(0xffffffff) - weights.view(np.uint32)).astype(np.uint64)
+    order = np.argsort(key, kind='stable')
+    impact_weights = weights[order]
+    max_weights = np.zeros(len(indptr) - 1, dtype=np.float32)
+    nonempty = np.diff(indptr) > 0
+    max_weights[nonempty] = impact_weights[indptr[:-1][nonempty]]
+    return doc_ids[order], impact_weights, max_weights
+
+
+def save_strings(out_dir, name, strings):
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(s) for s in encoded], out=offsets[1:])
+    blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    np.save(os.path.join(out_dir, f"{name}.blob.npy"), blob)
+    np.save(os.path.join(out_dir, f"{name}.offsets.npy"), offsets)
+
+
+def new_version():
+    """Версия сборки: время, pid и случайный суффикс - различает и пересборки
+    в одну секунду"""
+    return time.strftime('%Y%m%d%H%M%S') + f"-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+def new_version_dir(out_dir):
+    """(версия, каталог для записи новой версии внутри out_dir)"""
+    version = new_version()
+    path = os.path.join(out_dir, VERSION_PREFIX + version)
+    os.makedirs(path)
+    return version, path
+
+
+@contextmanager
+def publish_lock(out_dir):
+    """Блокировка публикаций в out_dir между процессами"""
+    with open(os.path.join(out_dir, LOCK_FILE), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def publish(out_dir, version_dir):
+    """Делает version_dir текущей версией out_dir заменой указателя и удаляет
+    старые версии, кроме предыдущей"""
+    pointer = os.path.join(out_dir, POINTER_FILE)
+    with publish_lock(out_dir):
+        if not os.path.isdir(version_dir):
+            raise FileNotFoundError(f"Каталог версии не найден: {version_dir}")
+        previous = os.path.basename(current_dir(out_dir))
+        # отметка нужна очистке: неотмеченный каталог - сборка, которую еще пишут
+        open(os.path.join(version_dir, PUBLISHED_FILE), 'w').close()
+        tmp_path = f"{pointer}.tmp-{os.getpid()}"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(os.path.basename(version_dir))
+        os.replace(tmp_path, pointer)
+        _prune(out_dir, {os.path.basename(version_dir), previous})
+
+
+def _prune(out_dir, keep):
+    """Удаляет из out_dir опубликованные версии, кроме keep, и файлы индекса,
+    записанного до появления версий. Каталоги, которые еще не публиковались,
+    могут принадлежать параллельной сборке и удаляются, только когда
+    устареют (брошены после сбоя)."""
+    now = time.time()
+    for entry in os.listdir(out_dir):
+        # указатель, временные указатели других процессов и блокировка
+        if entry in keep or entry.startswith(POINTER_FILE) or entry == LOCK_FILE:
+            continue
+        path = os.path.join(out_dir, entry)
+        if entry.startswith(VERSION_PREFIX) and os.path.isdir(path):
+            if (not os.path.exists(os.path.join(path, PUBLISHED_FILE))
+                    and now - os.path.getmtime(path) < STALE_BUILD_AGE):
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+
+
+def current_dir(index_dir):
+    """Каталог текущей версии; для каталога без указателя (старая сборка) - он сам"""
+    try:
+        with open(os.path.join(index_dir, POINTER_FILE), 'r', encoding='utf-8') as f:
+            return os.path.join(index_dir, f.read().strip())
+    except FileNotFoundError:
+        return index_dir
+
+
+def write_meta(out_dir, meta, name=META_FILE):
+    """Запись meta.json; пишется последним - его наличие означает, что версия записана целиком"""
+    tmp_path = os.path.join(out_dir, name + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(out_dir, name))
+
+
+def read_meta(version_dir, format_version=None, name=META_FILE):
+    """meta.json каталога версии; ValueError при другом формате"""
+    with open(os.path.join(version_dir, name), 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    if format_version is not None and meta.get('format') != format_version:
+        raise ValueError(f"Неподдерживаемый формат {version_dir}: {meta.get('format')}")
+    return meta
+
+
+def load_array(version_dir, name, required=True):
+    """Массив name.npy, отображенный в память; None, если его нет и он необязателен"""
+    path = os.path.join(version_dir, f"{name}.npy")
+    if not required and not os.path.exists(path):
+        return None
+    return np.load(path, mmap_mode='r')
+
+
+def exists(index_dir, name=META_FILE):
+    """Есть ли опубликованная версия"""
+    return os.path.exists(os.path.join(current_dir(index_dir), name))
+
+
+def current_version(index_dir, name=META_FILE):
+    """Версия текущей сборки без ее загрузки; None, если сборки нет"""
+    try:
+        return read_meta(current_dir(index_dir), name=name)['version']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def open_current(index_dir, opener, attempts=OPEN_ATTEMPTS):
+    """opener(каталог текущей версии). Если версию удалили во время загрузки
+    (за это время вышли две новые), открывается снова уже новая текущая."""
+    for attempt in range(attempts):
+        path = current_dir(index_dir)
+        try:
+            return opener(path)
+        except FileNotFoundError:
+            if attempt == attempts - 1 or current_dir(index_dir) == path:
+                raise
+
+
+def save_postings(out_dir, terms, indptr, doc_ids, filenames,
+                  weights=None, doc_norms=None, urls=None, compress=False, extra=None,
+                  versioned=True):
+    """Запись индекса. terms должны быть отсортированы по UTF-8 байтам.
+
+    При compress=True номера документов (возрастающие внутри каждого списка)
+    сохраняются как varint-разности вместо массива фиксированной ширины.
+    extra - дополнительные массивы {имя: массив} в той же версии каталога.
+    Индекс пишется новой версией каталога out_dir и публикуется после записи,
+    поэтому читатели видят либо старый индекс, либо новый, но не их смесь.
+    versioned=False пишет прямо в out_dir - для каталогов внутри еще не
+    опубликованной версии (шарды), которую публикует вызывающий.
+    """
+    final_dir = out_dir
+    if versioned:
+        version, out_dir = new_version_dir(final_dir)
+    else:
+        version = new_version()
+        os.makedirs(out_dir)
+    nnz = len(doc_ids)
+    index_dtype = np.int32 if max(nnz, len(filenames)) < 2 ** 31 else np.int64
+
+    save_strings(out_dir, 'terms', terms)
+    save_strings(out_dir, 'doc_names', filenames)
+    if urls is not None:
+        save_strings(out_dir, 'doc_urls', urls)
+    np.save(os.path.join(out_dir, 'postings.indptr.npy'), np.asarray(indptr, dtype=index_dtype))
+    if compress:
+        np.save(os.path.join(out_dir, 'postings.doc_gaps.npy'), delta_encode(indptr, doc_ids))
+    else:
+        np.save(os.path.join(out_dir, 'postings.doc_ids.npy'), np.asarray(doc_ids, dtype=index_dtype))
+    if weights is not None:
+        np.save(os.path.join(out_dir, 'postings.weights.npy'), np.asarray(weights, dtype=np.float32))
+        impact_doc_ids, impact_weights, max_weights = impact_order(indptr, doc_ids, weights)
+        np.save(os.path.join(out_dir, 'impact.doc_ids.npy'), impact_doc_ids.astype(index_dtype))
+        np.save(os.path.join(out_dir, 'impact.weights.npy'), impact_weights)
+        np.save(os.path.join(out_dir, 'terms.max_weight.npy'), max_weights)
+    if doc_norms is not None:
+        np.save(os.path.join(out_dir, 'doc_norms.npy'), np.asarray(doc_norms, dtype=np.float32))
+    for name, array in (extra or {}).items():
+        np.save(os.path.join(out_dir, f"{name}.npy"), array)
+
+    meta = {
+        'format': FORMAT_VERSION,
+        'version': version,
+        'n_docs': len(filenames),
+        'n_terms': len(terms),
+        'nnz': nnz,
+    }
+    write_meta(out_dir, meta)
+    if versioned:
+        publish(final_dir, out_dir)
+    return meta
+
+
+def index_exists(index_dir):
+    return exists(index_dir)
+
+
+def open_index(index_dir):
+    if not index_exists(index_dir):
+        raise FileNotFoundError(f"Компилированный индекс не найден: {index_dir}")
+    return open_current(index_dir, CompiledIndex)
+
+
+def compile_vector_index(data_dir=TFIDF_RESULTS_DIR, index_file=INDEX_FILE, out_dir=COMPILED_INDEX_DIR):
+    """Сборка компилированного индекса из текстовых TF-IDF файлов"""
+    tfidf_matrix, vocab, filenames = load_tfidf_data(data_dir)
+    return save_vector_index(out_dir, tfidf_matrix, vocab, filenames, index_file)
+
+
+def save_vector_index(out_dir, tfidf_matrix, vocab, filenames, index_file=INDEX_FILE):
+    """Запись матрицы документы x термины (как у load_tfidf_data) в компилированный индекс"""
+    tfidf_matrix, doc_norms = normalize_rows(tfidf_matrix)
+
+    terms = sorted(vocab, key=lambda term: term.encode('utf-8'))
+    order = np.fromiter((vocab[term] for term in terms), dtype=np.int64, count=len(terms))
+    term_matrix = tfidf_matrix.tocsc()[:, order]
+    term_matrix.sort_indices()
+
+    url_mapping = load_url_mapping(index_file)
+    urls = [url_mapping.get(filename, "#") for filename in filenames]
+
+    return save_postings(out_dir, terms, term_matrix.indptr, term_matrix.indices, filenames,
+                         weights=term_matrix.data, doc_norms=doc_norms, urls=urls)
+
+
+if __name__ == "__main__":
+    print(f"Сборка компилированного индекса из: {TFIDF_RESULTS_DIR}")
+    meta = compile_vector_index()
+    print(f"Индекс сохранен в: {COMPILED_INDEX_DIR}\n"
+          f"- Документов: {meta['n_docs']}\n- Терминов: {meta['n_terms']}\n- Постингов: {meta['nnz']}")
+    # LSA-индекс по прежней версии выключил бы семантический режим
+    from lsa import LSA_DIR, refresh_lsa_index
+    if refresh_lsa_index(COMPILED_INDEX_DIR):
+        print(f"LSA-индекс пересобран: {LSA_DIR}")
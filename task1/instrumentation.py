@@ -0,0 +1,136 @@
+import os
+import time
+import bisect
+import threading
+import functools
+
+# Таймеры и счетчики горячих путей. Включены по умолчанию; SEARCH_METRICS=0
+# отключает их при импорте: timed() возвращает функцию без обертки, inc()
+# ничего не делает, так что выключенные метрики не стоят ничего.
+# Метрики собираются в пределах процесса; воркеры пула передают свои
+# наблюдения главному процессу через take()/merge().
+ENABLED = os.environ.get('SEARCH_METRICS', '1') != '0'
+PREFIX = 'search'
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Registry:
+    """Гистограммы длительностей стадий и счетчики событий"""
+
+    def __init__(self):
+        self.timings = {}   # стадия -> [счетчики корзин, сумма, число, максимум]
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name, seconds):
+        slot = bisect.bisect_left(BUCKETS, seconds)
+        with self.lock:
+            entry = self.timings.get(name)
+            if entry is None:
+                entry = self.timings[name] = [[0] * (len(BUCKETS) + 1), 0.0, 0, 0.0]
+            entry[0][slot] += 1
+            entry[1] += seconds
+            entry[2] += 1
+            if seconds > entry[3]:
+                entry[3] = seconds
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def take(self):
+        """Снимок накопленного со сбросом (для передачи из воркера)"""
+        with self.lock:
+            snapshot = {'timings': self.timings, 'counters': self.counters}
+            self.timings, self.counters = {}, {}
+        return snapshot
+
+    def merge(self, snapshot):
+        with self.lock:
+            for name, (buckets, total, count, peak) in snapshot['timings'].items():
+                entry = self.timings.get(name)
+                if entry is None:
+                    self.timings[name] = [list(buckets), total, count, peak]
+                    continue
+                entry[0] = [a + b for a, b in zip(entry[0], buckets)]
+                entry[1] += total
+                entry[2] += count
+                entry[3] = max(entry[3], peak)
+            for name, value in snapshot['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def prometheus(self, gauges=None, counters=None):
+        """Текстовый формат экспозиции Prometheus; gauges и counters - внешние
+        значения {имя: число} (счетчики получают суффикс _total)"""
+        with self.lock:
+            timings = {name: (list(e[0]), e[1], e[2]) for name, e in self.timings.items()}
+            events = dict(self.counters)
+
+        lines = [f"# HELP {PREFIX}_stage_seconds Длительность стадий обработки",
+                 f"# TYPE {PREFIX}_stage_seconds histogram"]
+        for name, (buckets, total, count) in sorted(timings.items()):
+            cumulative = 0
+            for bound, hits in zip(BUCKETS + ('+Inf',), buckets):
+                cumulative += hits
+                lines.append(f'{PREFIX}_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+            lines.append(f'{PREFIX}_stage_seconds_sum{{stage="{name}"}} {total}')
+            lines.append(f'{PREFIX}_stage_seconds_count{{stage="{name}"}} {count}')
+
+        lines += [f"# HELP {PREFIX}_events_total Число событий",
+                  f"# TYPE {PREFIX}_events_total counter"]
+        for name, value in sorted(events.items()):
+            lines.append(f'{PREFIX}_events_total{{event="{name}"}} {value}')
+
+        for name, value in sorted((gauges or {}).items()):
+            lines += [f"# TYPE {PREFIX}_{name} gauge", f"{PREFIX}_{name} {value}"]
+        for name, value in sorted((counters or {}).items()):
+            lines += [f"# TYPE {PREFIX}_{name}_total counter", f"{PREFIX}_{name}_total {value}"]
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Сводка для конца пакетного запуска"""
+        with self.lock:
+            timings = sorted(self.timings.items(), key=lambda item: -item[1][1])
+            counters = sorted(self.counters.items())
+        if not timings and not counters:
+            return ''
+        lines = [f"{'стадия':<22}{'вызовов':>10}{'всего, с':>12}{'среднее, мс':>14}{'макс, мс':>12}"]
+        for name, (_, total, count, peak) in timings:
+            lines.append(f"{name:<22}{count:>10}{total:>12.3f}{total * 1000 / count:>14.3f}{peak * 1000:>12.3f}")
+        for name, value in counters:
+            lines.append(f"{name:<22}{value:>10}")
+        return '\n'.join(lines)
+
+
+registry = Registry()
+
+
+def timed(name):
+    """Декоратор: время каждого вызова функции попадает в гистограмму стадии name"""
+    def decorator(func):
+        if not ENABLED:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                registry.observe(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def _noop(name, value=1):
+    pass
+
+
+inc = registry.inc if ENABLED else _noop
+
+
+def print_summary():
+    summary = registry.summary() if ENABLED else ''
+    if summary:
+        print(f"\n[МЕТРИКИ]\n{summary}")
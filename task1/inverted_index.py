@@ -1,137 +1,345 @@
 import os
-import json
 import re
+import json
+import argparse
+from array import array
 from collections import defaultdict
 
+import numpy as np
+
+from index_store import index_exists, open_index, save_postings
+from query_analyzer import load_query_analyzer
+from instrumentation import inc, print_summary, timed
+
 LEMMAS_FOLDER = "lemma_token_output/lemmas"
 INDEX_FOLDER = "inverted_index_output"
-INDEX_FILE = os.path.join(INDEX_FOLDER, "inverted_index.json")
+# текстовая выгрузка индекса термин -> документы (хранится в репозитории,
+# как lemma_token_output/ и tfidf_results/; сам индекс - артефакт сборки)
+INDEX_JSON = "inverted_index.json"
+
+
+EMPTY_POSTINGS = np.zeros(0, dtype=np.uint32)
+
+
+# Операции над отсортированными списками номеров документов (uint32)
+def intersect_postings(a, b):
+    if len(a) > len(b):
+        a, b = b, a
+    if not len(a):
+        return EMPTY_POSTINGS
+    # бинарный поиск элементов короткого списка в длинном
+    pos = np.minimum(np.searchsorted(b, a), len(b) - 1)
+    return a[b[pos] == a]
+
+
+def difference_postings(a, b):
+    if not len(a) or not len(b):
+        return a
+    pos = np.minimum(np.searchsorted(b, a), len(b) - 1)
+    return a[b[pos] != a]
+
+
+def complement_postings(a, n_docs):
+    mask = np.ones(n_docs, dtype=bool)
+    mask[a] = False
+    return np.flatnonzero(mask).astype(np.uint32)
 
 
 def build_index():
     print("[ИНДЕКС] Начало построения индекса...")
-    os.makedirs(INDEX_FOLDER, exist_ok=True)
 
-    index = defaultdict(list)
-    doc_ids = set()
-
-    lemma_files = [f for f in os.listdir(LEMMAS_FOLDER) if f.endswith('.txt')]
+    lemma_files = sorted(f for f in os.listdir(LEMMAS_FOLDER) if f.endswith('.txt'))
     if not lemma_files:
         print(f"[ОШИБКА] В папке '{LEMMAS_FOLDER}' нет .txt файлов!")
-        return None, None
+        return None
 
     print(f"[ИНДЕКС] Обработка {len(lemma_files)} файлов с леммами...")
+    return build_index_from_documents(read_lemma_documents(lemma_files))
+
 
+def read_lemma_documents(lemma_files, folder=None):
+    """Поток (doc_id, леммы) из файлов "лемма: формы" """
+    folder = folder or LEMMAS_FOLDER
     for filename in lemma_files:
         doc_id = filename[:-4]
-        print(f"[ИНДЕКС] Обработка документа: {doc_id}")
-        with open(os.path.join(LEMMAS_FOLDER, filename), 'r', encoding='utf-8') as f:
-            for line in f:
-                if ':' in line:
-                    lemma, tokens = line.split(':', 1)
-                    lemma = lemma.strip()
-                    index[lemma].append(doc_id)
-                    doc_ids.add(doc_id)
+        with open(os.path.join(folder, filename), 'r', encoding='utf-8') as f:
+            yield doc_id, [line.split(':', 1)[0].strip() for line in f if ':' in line]
 
-    with open(INDEX_FILE, 'w', encoding='utf-8') as f:
-        json.dump(dict(index), f, ensure_ascii=False, indent=2)
 
-    print(f"[ИНДЕКС] Успешно построен индекс. Сохранен в: {os.path.abspath(INDEX_FILE)}")
-    print(f"[ИНДЕКС] Статистика: {len(doc_ids)} документов, {len(index)} уникальных терминов")
+@timed('index_build')
+def build_index_from_documents(documents, out_dir=None, verbose=True, versioned=True):
+    """Строит компилированный индекс по потоку (doc_id, леммы документа).
 
-    return index, doc_ids
+    Документы нумеруются в порядке поступления, поэтому их нужно подавать
+    отсортированными по doc_id. По умолчанию индекс пишется в INDEX_FOLDER;
+    versioned передается в save_postings.
+    """
+    out_dir = out_dir or INDEX_FOLDER
+    # номера документов - плотные целые в порядке имен файлов
+    index = defaultdict(lambda: array('I'))
+    doc_names = []
+    for doc_id, lemmas in documents:
+        doc_num = len(doc_names)
+        doc_names.append(doc_id)
+        for lemma in lemmas:
+            postings = index[lemma]
+            if not postings or postings[-1] != doc_num:
+                postings.append(doc_num)
 
+    # компилированный индекс: словарь, сжатые списки номеров и таблица документов
+    terms = sorted(index, key=lambda term: term.encode('utf-8'))
+    indptr = np.zeros(len(terms) + 1, dtype=np.int64)
+    np.cumsum([len(index[term]) for term in terms], out=indptr[1:])
+    doc_nums = array('I')
+    for term in terms:
+        doc_nums.extend(index[term])
+    save_postings(out_dir, terms, indptr, doc_nums, doc_names, compress=True, versioned=versioned)
+    inc('index_documents', len(doc_names))
 
-def search(query, index, doc_ids):
-    print(f"\n[ПОИСК] Начало обработки запроса: '{query}'")
+    if verbose:
+        print(f"[ИНДЕКС] Успешно построен индекс. Сохранен в: {os.path.abspath(out_dir)}")
+        print(f"[ИНДЕКС] Статистика: {len(doc_names)} документов, {len(terms)} уникальных терминов")
 
-    if not index:
-        print("[ОШИБКА] Индекс не загружен!")
-        return []
+    return open_index(out_dir)
+
+
+def load_index():
+    """Открывает компилированный индекс без повторного разбора файлов с леммами"""
+    return open_index(INDEX_FOLDER)
+
+
+def export_json(index, path=None):
+    """Выгружает индекс в JSON {термин: [документы]}"""
+    path = path or INDEX_JSON
+    postings = {}
+    for col, term in enumerate(index.vocab):
+        doc_ids, _ = index.postings(col)
+        postings[term] = [index.filenames[i] for i in doc_ids]
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(postings, f, ensure_ascii=False, indent=2)
+    print(f"[ИНДЕКС] Индекс выгружен в: {os.path.abspath(path)}")
+
+
+# Разбор запроса: лексемы -> дерево (NOT > AND > OR, скобки).
+# Узлы дерева - кортежи ('term', термин), ('not', узел), ('and', [узлы]), ('or', [узлы]).
+# Соседние операнды без оператора между ними объединяются через AND.
+TOKEN_RE = re.compile(r'\(|\)|[^\s()]+')
+OPERATORS = {'and', 'or', 'not'}
+
+
+def tokenize_query(query):
+    return TOKEN_RE.findall(query.lower())
+
+
+@timed('boolean_parse')
+def parse_query(query):
+    """Строит дерево запроса; при синтаксической ошибке - ValueError"""
+    tokens = tokenize_query(query)
+    pos = 0
+
+    def peek():
+        return tokens[pos] if pos < len(tokens) else None
+
+    def take():
+        nonlocal pos
+        pos += 1
+        return tokens[pos - 1]
 
-    def parse_expression(expr, depth=0):
-        indent = "  " * depth
-        expr = expr.strip().lower()
-        print(f"{indent}[ПАРСЕР] Уровень {depth}: разбираем '{expr}'")
-
-        # Если выражение уже содержит ID документов (после обработки скобок)
-        if all(part.startswith('page_') for part in expr.split()):
-            print(f"{indent}[DOCIDS] Возвращаем готовые ID документов: {expr.split()}")
-            return set(expr.split())
-
-        # Базовый случай - одиночный термин
-        if ' ' not in expr and '(' not in expr:
-            if expr.startswith('not '):
-                term = expr[4:].strip()
-                print(f"{indent}[NOT] Поиск документов БЕЗ термина '{term}'")
-                result = doc_ids - set(index.get(term, []))
-                print(f"{indent}[NOT] Найдено {len(result)} документов без '{term}'")
-                return result
-            print(f"{indent}[ТЕРМ] Поиск термина '{expr}'")
-            result = set(index.get(expr, []))
-            print(f"{indent}[ТЕРМ] Найдено {len(result)} документов с '{expr}'")
-            return result
-
-        # Обрабатываем вложенные скобки
-        while '(' in expr:
-            print(f"{indent}[СКОБКИ] Обнаружены скобки в '{expr}'")
-            expr = re.sub(
-                r'\(([^()]+)\)',
-                lambda m: ' '.join(sorted(parse_expression(m.group(1), depth + 1))),
-                expr
-            )
-            print(f"{indent}[СКОБКИ] После обработки: '{expr}'")
-
-        # Разбиваем на OR части
-        or_parts = [part.strip() for part in re.split(r'\s+or\s+', expr)]
-        if len(or_parts) > 1:
-            print(f"{indent}[OR] Разбиваем на {len(or_parts)} частей: {or_parts}")
-            result = set()
-            for part in or_parts:
-                part_result = parse_expression(part, depth + 1)
-                print(f"{indent}[OR] Часть '{part}' → {len(part_result)} документов")
-                result.update(part_result)
-            print(f"{indent}[OR] Итоговый результат: {len(result)} документов")
-            return result
-
-        # Разбиваем на AND части
-        and_parts = [part.strip() for part in re.split(r'\s+and\s+', expr)]
-        if len(and_parts) > 1:
-            print(f"{indent}[AND] Разбиваем на {len(and_parts)} частей: {and_parts}")
-            result = None
-            for part in and_parts:
-                part_result = parse_expression(part, depth + 1)
-                print(f"{indent}[AND] Часть '{part}' → {len(part_result)} документов")
-                if result is None:
-                    result = part_result
-                else:
-                    result &= part_result
-                print(f"{indent}[AND] Текущее пересечение: {len(result)} документов")
-                if not result:
+    def parse_or():
+        parts = [parse_and()]
+        while peek() == 'or':
+            take()
+            parts.append(parse_and())
+        return parts[0] if len(parts) == 1 else ('or', parts)
+
+    def parse_and():
+        parts = [parse_not()]
+        while peek() is not None and peek() not in ('or', ')'):
+            if peek() == 'and':
+                take()
+            parts.append(parse_not())
+        return parts[0] if len(parts) == 1 else ('and', parts)
+
+    def parse_not():
+        if peek() == 'not':
+            take()
+            return ('not', parse_not())
+        return parse_atom()
+
+    def parse_atom():
+        token = peek()
+        if token is None:
+            raise ValueError("неожиданный конец запроса")
+        if token == '(':
+            take()
+            node = parse_or()
+            if peek() != ')':
+                raise ValueError("не закрыта скобка")
+            take()
+            return node
+        if token == ')' or token in OPERATORS:
+            raise ValueError(f"неожиданная лексема '{token}'")
+        return ('term', take())
+
+    if not tokens:
+        raise ValueError("пустой запрос")
+    tree = parse_or()
+    if pos != len(tokens):
+        raise ValueError(f"неожиданная лексема '{tokens[pos]}'")
+    return tree
+
+
+def lemmatize_tree(node, analyzer):
+    """Заменяет слова запроса леммами индекса (QueryAnalyzer).
+
+    Стоп-слова и короткие слова не индексируются, поэтому выбрасываются из
+    дерева; если от узла ничего не осталось - None. Слово, которое делится
+    токенизатором на несколько (через дефис), становится их AND.
+    """
+    kind = node[0]
+    if kind == 'term':
+        terms = [('term', lemma) for lemma in dict.fromkeys(analyzer(node[1]))]
+        if not terms:
+            return None
+        return terms[0] if len(terms) == 1 else ('and', terms)
+    if kind == 'not':
+        child = lemmatize_tree(node[1], analyzer)
+        return None if child is None else ('not', child)
+    children = [child for child in (lemmatize_tree(child, analyzer) for child in node[1])
+                if child is not None]
+    if not children:
+        return None
+    return children[0] if len(children) == 1 else (kind, children)
+
+
+def estimate_cost(node, index):
+    """Оценка размера результата узла без его вычисления"""
+    kind = node[0]
+    if kind == 'term':
+        col = index.vocab.get(node[1])
+        return 0 if col is None else int(index.indptr[col + 1] - index.indptr[col])
+    if kind == 'not':
+        return index.n_docs - estimate_cost(node[1], index)
+    costs = [estimate_cost(child, index) for child in node[1]]
+    return min(costs) if kind == 'and' else min(sum(costs), index.n_docs)
+
+
+def evaluate(node, index, trace=False, depth=0):
+    indent = "  " * depth
+    kind = node[0]
+
+    if kind == 'term':
+        col = index.vocab.get(node[1])
+        result = EMPTY_POSTINGS if col is None else index.postings(col)[0]
+        if trace:
+            print(f"{indent}[ТЕРМ] '{node[1]}' → {len(result)} документов")
+        return result
+
+    if kind == 'not':
+        result = complement_postings(evaluate(node[1], index, trace, depth + 1), index.n_docs)
+        if trace:
+            print(f"{indent}[NOT] → {len(result)} документов")
+        return result
+
+    if kind == 'or':
+        parts = [evaluate(child, index, trace, depth + 1) for child in node[1]]
+        parts = [part for part in parts if len(part)]
+        if not parts:
+            result = EMPTY_POSTINGS
+        elif len(parts) == 1:
+            result = parts[0]
+        else:
+            result = np.unique(np.concatenate(parts))
+        if trace:
+            print(f"{indent}[OR] {len(node[1])} частей → {len(result)} документов")
+        return result
+
+    # AND: операнды по возрастанию оценки размера, "a AND NOT b" - разность
+    positive = sorted((child for child in node[1] if child[0] != 'not'),
+                      key=lambda child: estimate_cost(child, index))
+    negative = [child[1] for child in node[1] if child[0] == 'not']
+
+    if positive:
+        result = None
+        for child in positive:
+            part = evaluate(child, index, trace, depth + 1)
+            result = part if result is None else intersect_postings(result, part)
+            if not len(result):
+                if trace:
                     print(f"{indent}[AND] Пустое пересечение, прекращаем обработку")
-                    break
-            return result or set()
+                return EMPTY_POSTINGS
+        for child in negative:
+            result = difference_postings(result, evaluate(child, index, trace, depth + 1))
+            if not len(result):
+                break
+    else:
+        excluded = evaluate(('or', negative), index, trace, depth + 1)
+        result = complement_postings(excluded, index.n_docs)
+
+    if trace:
+        print(f"{indent}[AND] {len(node[1])} частей → {len(result)} документов")
+    return result
+
 
-        return set(index.get(expr, []))
+@timed('boolean_search')
+def search(query, index, trace=False, analyzer=None):
+    if trace:
+        print(f"\n[ПОИСК] Начало обработки запроса: '{query}'")
+
+    if not index:
+        print("[ОШИБКА] Индекс не загружен!")
+        return []
 
     try:
-        result = sorted(parse_expression(query))
-        print(f"[ПОИСК] Запрос '{query}' обработан. Найдено {len(result)} документов")
+        tree = parse_query(query)
+        if analyzer:
+            tree = lemmatize_tree(tree, analyzer)
+            if tree is None:
+                print("[ПОИСК] В запросе только стоп-слова")
+                return []
+        if trace:
+            print(f"[ПАРСЕР] {tree}")
+        result = [index.filenames[i] for i in evaluate(tree, index, trace)]
+        inc('boolean_queries')
+        if not result:
+            inc('boolean_empty_results')
+        if trace:
+            print(f"[ПОИСК] Запрос '{query}' обработан. Найдено {len(result)} документов")
         return result
-    except Exception as e:
-        print(f"[ОШИБКА] Ошибка обработки запроса: {e}")
+    except ValueError as e:
+        print(f"[ОШИБКА] Ошибка разбора запроса: {e}")
         return []
 
 
 def main():
-    if not os.path.exists(LEMMAS_FOLDER):
-        print(f"[ОШИБКА] Папка '{LEMMAS_FOLDER}' не найдена!")
-        return
+    parser = argparse.ArgumentParser(description="Булев поиск по инвертированному индексу")
+    parser.add_argument('--rebuild', action='store_true',
+                        help="пересобрать индекс из файлов с леммами")
+    parser.add_argument('--trace', action='store_true',
+                        help="печатать ход вычисления запроса")
+    parser.add_argument('--raw', action='store_true',
+                        help="искать слова запроса как есть, без лемматизации")
+    parser.add_argument('--export-json', action='store_true',
+                        help=f"выгрузить индекс в {INDEX_JSON} и выйти")
+    args = parser.parse_args()
+
+    if args.rebuild or not index_exists(INDEX_FOLDER):
+        if not os.path.exists(LEMMAS_FOLDER):
+            print(f"[ОШИБКА] Папка '{LEMMAS_FOLDER}' не найдена!")
+            return
 
-    print("\nПостроение индекса...")
-    index, doc_ids = build_index()
+        print("\nПостроение индекса...")
+        index = build_index()
+        print_summary()
+    else:
+        print("\nЗагрузка компилированного индекса...")
+        index = load_index()
     if not index:
         return
+    if args.export_json:
+        export_json(index)
+        return
+    analyzer = None if args.raw else load_query_analyzer()
 
     print("\n" + "=" * 50)
     print("Введите поисковый запрос (AND, OR, NOT, скобки)")
@@ -144,7 +352,7 @@ def main():
         if query.lower() == 'exit':
             break
 
-        results = search(query, index, doc_ids)
+        results = search(query, index, trace=args.trace, analyzer=analyzer)
         print(f"\n[РЕЗУЛЬТАТ] Найдено документов: {len(results)}")
         for doc in results:
             print(f"- {doc}")
@@ -0,0 +1,104 @@
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import pymorphy2
+
+MAX_SIZE = 200000
+FLUSH_EVERY = 1000
+
+
+class LemmaCache:
+    """Кэш разбора словоформ: токен -> (нормальная форма, оценка разбора).
+
+    Первый уровень - ограниченный LRU в памяти на всё время работы процесса,
+    второй (необязательный) - sqlite-файл, который переживает перезапуски,
+    так что уже встречавшиеся словоформы не разбираются повторно.
+    """
+
+    def __init__(self, analyzer=None, path=None, maxsize=MAX_SIZE):
+        self.analyzer = analyzer or pymorphy2.MorphAnalyzer()
+        self.maxsize = maxsize
+        self.path = path
+        self.memory = OrderedDict()
+        self.pending = []
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = None
+        if path:
+            self._open_db(path)
+
+    def _open_db(self, path):
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS lemmas "
+                        "(token TEXT PRIMARY KEY, normal_form TEXT, score REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        # при смене версии анализатора сохраненные разборы устаревают
+        version = f"pymorphy2 {pymorphy2.__version__}"
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'analyzer'").fetchone()
+        if row is None or row[0] != version:
+            self.db.execute("DELETE FROM lemmas")
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('analyzer', ?)", (version,))
+        self.db.commit()
+
+    def parse(self, token):
+        with self.lock:
+            cached = self.memory.get(token)
+            if cached is not None:
+                self.memory.move_to_end(token)
+                self.hits += 1
+                return cached
+
+            if self.db is not None:
+                cached = self.db.execute(
+                    "SELECT normal_form, score FROM lemmas WHERE token = ?", (token,)
+                ).fetchone()
+            if cached is not None:
+                self.disk_hits += 1
+            else:
+                parsed = self.analyzer.parse(token)[0]
+                cached = (parsed.normal_form, parsed.score)
+                self.misses += 1
+                if self.db is not None:
+                    self.pending.append((token, *cached))
+                    if len(self.pending) >= FLUSH_EVERY:
+                        self._flush()
+
+            cached = tuple(cached)
+            self.memory[token] = cached
+            if len(self.memory) > self.maxsize:
+                self.memory.popitem(last=False)
+            return cached
+
+    def _flush(self):
+        if self.db is not None and self.pending:
+            self.db.executemany("INSERT OR IGNORE INTO lemmas VALUES (?, ?, ?)", self.pending)
+            self.db.commit()
+            self.pending = []
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        self.flush()
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def take_stats(self):
+        """Счетчики с момента прошлого вызова (для сбора статистики с воркеров)"""
+        with self.lock:
+            stats = {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses}
+            self.hits = self.disk_hits = self.misses = 0
+        return stats
+
+
+def format_stats(stats):
+    total = sum(stats.values())
+    rate = (stats['hits'] + stats['disk_hits']) / total if total else 0.0
+    return (f"кэш лемм: {total} обращений, в памяти {stats['hits']}, "
+            f"на диске {stats['disk_hits']}, разобрано {stats['misses']} "
+            f"(попаданий {rate:.1%})")
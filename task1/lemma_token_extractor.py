@@ -1,32 +1,37 @@
 import os
 import re
 import logging
-from concurrent.futures import ThreadPoolExecutor
+import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from bs4 import BeautifulSoup
 import nltk
-import pymorphy2
-from nltk.tokenize import RegexpTokenizer
-from nltk.corpus import stopwords
 
-nltk.download('punkt')
-nltk.download('stopwords')
+import text_analysis
+from text_analysis import clean_and_tokenize, init_analyzers, lemmatize_tokens
+from lemma_cache import format_stats
+from instrumentation import inc, print_summary, registry, timed
+from html_text import extract_article_text
+from dedup import simhash
 
 INPUT_FOLDER = 'pages'
 OUTPUT_FOLDER = 'lemma_token_output'
 TOKENS_FOLDER = os.path.join(OUTPUT_FOLDER, 'tokens')
 LEMMAS_FOLDER = os.path.join(OUTPUT_FOLDER, 'lemmas')
-WORKERS = 4
-
-logging.basicConfig(
-    filename='processing.log',
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
-
-morph = pymorphy2.MorphAnalyzer()
-stop_words_ru = set(stopwords.words('russian'))
-stop_words_en = set(stopwords.words('english'))
-tokenizer = RegexpTokenizer(r'\b[а-яА-ЯёЁa-zA-Z]+\b')
+WORKERS = os.cpu_count() or 1
+CHUNK_SIZE = 16
+LEMMA_CACHE_FILE = 'lemma_cache.sqlite'
+LOG_FILE = 'processing.log'
+# 'stream' - потоковый разбор html_text, 'bs4' - дерево BeautifulSoup
+HTML_BACKENDS = ('stream', 'bs4')
+HTML_BACKEND = 'stream'
+
+def setup_logging():
+    """Журнал обработки в LOG_FILE - только для запусков сборки из командной строки"""
+    logging.basicConfig(
+        filename=LOG_FILE,
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
 
 
 def setup_folders():
@@ -35,71 +40,41 @@ def setup_folders():
     os.makedirs(TOKENS_FOLDER, exist_ok=True)
     os.makedirs(LEMMAS_FOLDER, exist_ok=True)
 
-#очищаем текст от тэгов
-def extract_text_from_html(file_path):
+#очищаем текст от тэгов; lower=False - с исходным регистром (для хранилища текстов)
+@timed('html_parse')
+def extract_text_from_html(file_path, backend=None, lower=True):
     try:
         with open(file_path, 'r', encoding='utf-8') as file:
-            soup = BeautifulSoup(file, 'html.parser')
-
-            for element in soup(['script', 'style', 'meta', 'link',
-                                 'footer', 'header', 'nav', 'noscript',
-                                 'iframe', 'svg', 'img', 'button']):
-                element.decompose()
-
-            article_body = soup.find('div', class_='tm-article-body') or soup.find('article')
-
-            if article_body:
-                for pre in article_body.find_all('pre'):
-                    pre.decompose()
-                for code in article_body.find_all('code'):
-                    code.decompose()
-                text = article_body.get_text(' ', strip=True)
-            else:
-                text = soup.get_text(' ', strip=True)
-
-            text = re.sub(r'\s+', ' ', text)
-            return text.lower()
+            if (backend or HTML_BACKEND) == 'stream':
+                return extract_article_text(file.read(), lower)
+            return _extract_text_bs4(file, lower)
 
     except Exception as e:
         logging.error(f"Ошибка при чтении {file_path}: {str(e)}")
         return ""
 
 
-def clean_and_tokenize(text):
-    try:
-        tokens = tokenizer.tokenize(text)
-
-        # фильтр стоп слов и коротких слов
-        clean_tokens = [
-            token for token in tokens
-            if (len(token) > 2 and
-                token not in stop_words_ru and
-                token not in stop_words_en and
-                not token.isdigit())
-        ]
-        return clean_tokens
-    except Exception as e:
-        logging.error(f"Ошибка токенизации: {str(e)}")
-        return []
+def _extract_text_bs4(file, lower=True):
+    soup = BeautifulSoup(file, 'html.parser')
 
+    for element in soup(['script', 'style', 'meta', 'link',
+                         'footer', 'header', 'nav', 'noscript',
+                         'iframe', 'svg', 'img', 'button']):
+        element.decompose()
 
-def lemmatize_tokens(tokens):
-    lemma_dict = {}
-    try:
-        for token in tokens:
-            try:
-                parsed = morph.parse(token)[0]
-                if parsed.score >= 0.5:
-                    lemma = parsed.normal_form
-                    if lemma not in lemma_dict:
-                        lemma_dict[lemma] = set()
-                    lemma_dict[lemma].add(token)
-            except:
-                continue
-    except Exception as e:
-        logging.error(f"Ошибка лемматизации: {str(e)}")
+    article_body = soup.find('div', class_='tm-article-body') or soup.find('article')
 
-    return {lemma: sorted(token_set) for lemma, token_set in lemma_dict.items()}
+    if article_body:
+        for pre in article_body.find_all('pre'):
+            pre.decompose()
+        for code in article_body.find_all('code'):
+            code.decompose()
+        text = article_body.get_text(' ', strip=True)
+    else:
+        text = soup.get_text(' ', strip=True)
+
+    text = re.sub(r'\s+', ' ', text)
+    return text.lower() if lower else text
 
 
 def save_results(filename, tokens, lemma_dict):
@@ -122,36 +97,105 @@ def save_results(filename, tokens, lemma_dict):
         logging.error(f"Ошибка сохранения {filename}: {str(e)}")
 
 
+def analyze_file(filename, input_folder=INPUT_FOLDER):
+    """HTML -> (токены, леммы, текст статьи) без записи на диск; None, если текста нет"""
+    file_path = os.path.join(input_folder, filename)
+    try:
+        text = extract_text_from_html(file_path, lower=False)
+        if text:
+            tokens = clean_and_tokenize(text.lower())
+            if tokens:
+                inc('documents_analyzed')
+                return tokens, lemmatize_tokens(tokens), text
+    except Exception as e:
+        logging.error(f"Ошибка при обработке {filename}: {str(e)}")
+    return None
+
+
+def analyze_batch(filenames, input_folder=INPUT_FOLDER, keep_text=False, fingerprint=False):
+    """Обработка пачки файлов в процессе-воркере: [(имя файла, токены, леммы,
+    текст, отпечаток)]; вместе с результатами возвращает статистику кэша лемм
+    и метрики воркера за эту пачку. Текст статьи (для doc_store) передается
+    только с keep_text, SimHash-отпечаток уже извлеченного текста (для dedup) -
+    только с fingerprint; иначе вместо них None."""
+    results = []
+    for filename in filenames:
+        result = analyze_file(filename, input_folder)
+        if result is not None:
+            tokens, lemma_dict, text = result
+            results.append((filename, tokens, lemma_dict, text if keep_text else None,
+                            simhash(text) if fingerprint else None))
+    text_analysis.lemma_cache.flush()
+    return results, text_analysis.lemma_cache.take_stats(), registry.take()
+
+
 def process_file(filename):
     if filename.endswith('.html'):
-        file_path = os.path.join(INPUT_FOLDER, filename)
-        try:
-            text = extract_text_from_html(file_path)
-            if text:
-                tokens = clean_and_tokenize(text)
-                if tokens:
-                    lemma_dict = lemmatize_tokens(tokens)
-                    save_results(filename, tokens, lemma_dict)
-        except Exception as e:
-            logging.error(f"Ошибка при обработке {filename}: {str(e)}")
+        init_analyzers()
+        result = analyze_file(filename)
+        if result is not None:
+            save_results(filename, *result[:2])
+
+
+def run_threads(files, workers, cache_path=None):
+    init_analyzers(cache_path)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(process_file, files))
+    text_analysis.lemma_cache.flush()
+    return text_analysis.lemma_cache.take_stats()
+
+
+def run_processes(files, workers, chunk_size, cache_path=None):
+    # каждый воркер получает пачки файлов, а все результаты пишет один процесс
+    batches = [files[i:i + chunk_size] for i in range(0, len(files), chunk_size)]
+    stats = {'hits': 0, 'disk_hits': 0, 'misses': 0}
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_analyzers,
+                             initargs=(cache_path,)) as executor:
+        futures = [executor.submit(analyze_batch, batch) for batch in batches]
+        for future in as_completed(futures):
+            results, batch_stats, batch_metrics = future.result()
+            registry.merge(batch_metrics)
+            for filename, tokens, lemma_dict, *_ in results:
+                save_results(filename, tokens, lemma_dict)
+            for key, value in batch_stats.items():
+                stats[key] += value
+    return stats
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Извлечение токенов и лемм из HTML-страниц")
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help="число воркеров (по умолчанию - число ядер)")
+    parser.add_argument('--mode', choices=('process', 'thread'), default='process',
+                        help="пул процессов или потоков")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help="число файлов в одной задаче пула процессов")
+    parser.add_argument('--lemma-cache', default=LEMMA_CACHE_FILE,
+                        help="sqlite-файл кэша лемм между запусками ('' - только в памяти)")
+    args = parser.parse_args()
+
+    setup_logging()
+    nltk.download('punkt')
+    nltk.download('stopwords')
+
     setup_folders()
-    files = [f for f in os.listdir(INPUT_FOLDER) if f.endswith('.html')]
+    files = sorted(f for f in os.listdir(INPUT_FOLDER) if f.endswith('.html'))
 
     if not files:
         logging.warning(f"В папке {INPUT_FOLDER} не найдено HTML-файлов")
         return
 
-    logging.info(f"Начало обработки {len(files)} файлов")
+    logging.info(f"Начало обработки {len(files)} файлов ({args.mode}, воркеров: {args.workers})")
 
-    # многопоточная обработка
-    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
-        executor.map(process_file, files)
+    cache_path = args.lemma_cache or None
+    if args.mode == 'process':
+        stats = run_processes(files, args.workers, args.chunk_size, cache_path)
+    else:
+        stats = run_threads(files, args.workers, cache_path)
 
-    logging.info("Обработка завершена")
-    print(f"Готово! Обработано {len(files)} файлов.")
+    logging.info(f"Обработка завершена, {format_stats(stats)}")
+    print(f"Готово! Обработано {len(files)} файлов.\n{format_stats(stats)}")
+    print_summary()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
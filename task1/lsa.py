@@ -0,0 +1,269 @@
+import os
+import argparse
+
+import numpy as np
+
+from search import top_k_indices
+from index_store import (COMPILED_INDEX_DIR, current_dir, current_version, exists, load_array,
+                         new_version_dir, open_current, open_index, publish, read_meta, write_meta)
+from instrumentation import timed
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+LSA_DIR = os.path.join(BASE_DIR, 'lsa_index')
+META_FILE = 'meta.json'
+FORMAT_VERSION = 1
+RANK = 128
+OVERSAMPLING = 10
+POWER_ITERATIONS = 4
+CHUNK_ROWS = 65536          # строк матрицы за одно произведение
+IVF_TRAIN_SAMPLE = 65536    # документов для обучения центроидов
+IVF_ITERATIONS = 10
+N_PROBE = 8                 # просматриваемых кластеров при поиске
+
+# Семантический режим (LSA): усеченное SVD матрицы TF-IDF компилированного
+# индекса, A ~ U S V^T. Документ представлен строкой A V, запрос - суммой
+# строк V по своим терминам с весами запроса; близость - косинус между ними.
+# SVD считается рандомизированным методом (Halko и др.): матрица нужна только
+# в произведениях A X и A^T Y, которые считаются по пачкам строк.
+#   components.npy         - V (термины x rank), столбцы как у индекса
+#   embeddings.npy         - нормированные векторы документов, float32 или
+#                            int8 (тогда scales.npy - множитель строки)
+#   doc_ids.npy            - номер документа для каждой строки embeddings
+#   centroids.npy,         - IVF: центроиды кластеров и границы кластеров
+#   lists.indptr.npy         в embeddings (строки сгруппированы по кластерам)
+# Индекс привязан к версии компилированного индекса (source_version) и
+# пересобирается с теми же параметрами при перекомпиляции (refresh_lsa_index).
+
+
+def _chunks(n_rows):
+    for start in range(0, n_rows, CHUNK_ROWS):
+        yield start, min(start + CHUNK_ROWS, n_rows)
+
+
+def _product(matrix, dense):
+    """A X по пачкам строк A"""
+    out = np.empty((matrix.shape[0], dense.shape[1]), dtype=np.float32)
+    for start, end in _chunks(matrix.shape[0]):
+        out[start:end] = matrix[start:end] @ dense
+    return out
+
+
+def _transposed_product(matrix, dense):
+    """A^T Y с накоплением по пачкам строк A"""
+    out = np.zeros((matrix.shape[1], dense.shape[1]), dtype=np.float32)
+    for start, end in _chunks(matrix.shape[0]):
+        out += matrix[start:end].T @ dense[start:end]
+    return out
+
+
+def randomized_svd(matrix, rank, oversampling=OVERSAMPLING, iterations=POWER_ITERATIONS, seed=0):
+    """Первые rank сингулярных чисел и правых сингулярных векторов (термины x rank)"""
+    rng = np.random.default_rng(seed)
+    sample = min(rank + oversampling, min(matrix.shape))
+    basis, _ = np.linalg.qr(_product(matrix, rng.standard_normal(
+        (matrix.shape[1], sample), dtype=np.float32)))
+    # степенные итерации с ортогонализацией уточняют базис для медленно
+    # убывающего спектра (типично для текстов)
+    for _ in range(iterations):
+        basis, _ = np.linalg.qr(_transposed_product(matrix, basis))
+        basis, _ = np.linalg.qr(_product(matrix, basis))
+    small = _transposed_product(matrix, basis).T          # sample x термины
+    _, singular, vt = np.linalg.svd(small, full_matrices=False)
+    return singular[:rank], np.ascontiguousarray(vt[:rank].T)
+
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, np.finfo(np.float32).tiny)
+
+
+def quantize(vectors):
+    """int8-векторы и множители строк: vectors ~ codes * scales[:, None]"""
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1
+    codes = np.rint(vectors / scales[:, None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def train_ivf(embeddings, n_lists, seed=0):
+    """Сферический k-means на выборке документов; номер кластера каждого документа"""
+    rng = np.random.default_rng(seed)
+    sample = embeddings
+    if len(embeddings) > IVF_TRAIN_SAMPLE:
+        sample = embeddings[rng.choice(len(embeddings), IVF_TRAIN_SAMPLE, replace=False)]
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+    for _ in range(IVF_ITERATIONS):
+        assignment = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+        empty = ~sums.any(axis=1)
+        # пустой кластер получает случайный документ выборки
+        sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+        centroids = normalize(sums)
+    assignment = np.concatenate([np.argmax(embeddings[start:end] @ centroids.T, axis=1)
+                                 for start, end in _chunks(len(embeddings))])
+    return centroids.astype(np.float32), assignment
+
+
+def build_lsa_index(index_dir=COMPILED_INDEX_DIR, out_dir=LSA_DIR, rank=RANK, int8=False,
+                    n_lists=0, seed=0):
+    """Сборка LSA-индекса по компилированному индексу; n_lists > 0 - с кластерами IVF"""
+    index = open_index(index_dir)
+    matrix = index.term_matrix().tocsr()
+    rank = max(1, min(rank, min(matrix.shape) - 1))
+    singular, components = randomized_svd(matrix, rank, seed=seed)
+    embeddings = normalize(_product(matrix, components))
+
+    n_docs = len(embeddings)
+    n_lists = min(n_lists, n_docs)
+    order = np.arange(n_docs)
+    indptr = np.array([0, n_docs])
+    centroids = None
+    if n_lists > 1:
+        centroids, assignment = train_ivf(embeddings, n_lists, seed)
+        order = np.argsort(assignment, kind='stable')
+        indptr = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=n_lists), out=indptr[1:])
+
+    version, tmp_dir = new_version_dir(out_dir)
+    save = lambda name, array: np.save(os.path.join(tmp_dir, f"{name}.npy"), array)
+    save('components', components.astype(np.float32))
+    save('singular_values', singular.astype(np.float32))
+    save('doc_ids', order.astype(np.int32))
+    save('lists.indptr', np.asarray(indptr, dtype=np.int64))
+    if centroids is not None:
+        save('centroids', centroids)
+    if int8:
+        codes, scales = quantize(embeddings[order])
+        save('embeddings', codes)
+        save('scales', scales)
+    else:
+        save('embeddings', embeddings[order].astype(np.float32))
+
+    meta = {
+        'format': FORMAT_VERSION,
+        'version': version,
+        'source_version': index.version,
+        'source_dir': os.path.abspath(index_dir),
+        'rank': rank,
+        'dtype': 'int8' if int8 else 'float32',
+        'n_docs': n_docs,
+        'n_terms': matrix.shape[1],
+        'n_lists': max(n_lists, 1),
+        'seed': seed,
+    }
+    write_meta(tmp_dir, meta, META_FILE)
+    publish(out_dir, tmp_dir)
+    return meta
+
+
+class LsaIndex:
+    """Открытый LSA-индекс (lsa_dir - каталог версии); массивы отображены в память"""
+
+    def __init__(self, lsa_dir):
+        self.lsa_dir = lsa_dir
+        self.meta = read_meta(lsa_dir, FORMAT_VERSION, META_FILE)
+        self.components = self._array('components')
+        self.embeddings = self._array('embeddings')
+        self.scales = self._array('scales', required=False)
+        self.doc_ids = self._array('doc_ids')
+        self.indptr = self._array('lists.indptr')
+        self.centroids = self._array('centroids', required=False)
+
+    @property
+    def version(self):
+        return self.meta['version']
+
+    @property
+    def source_version(self):
+        return self.meta['source_version']
+
+    def _array(self, name, required=True):
+        return load_array(self.lsa_dir, name, required)
+
+    def project(self, indices, weights):
+        """Нормированный вектор запроса: сумма строк V по терминам запроса"""
+        vector = np.asarray(weights, dtype=np.float32) @ self.components[indices]
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _scores(self, start, end, vector):
+        """Косинусы строк embeddings[start:end] с запросом"""
+        if self.scales is None:
+            return self.embeddings[start:end] @ vector
+        scores = np.empty(end - start, dtype=np.float32)
+        # int8 переводится в float32 пачками: BLAS-произведение без копии всей матрицы
+        for chunk_start, chunk_end in _chunks(end - start):
+            rows = slice(start + chunk_start, start + chunk_end)
+            scores[chunk_start:chunk_end] = self.embeddings[rows].astype(np.float32) @ vector
+        scores *= self.scales[start:end]
+        return scores
+
+    @timed('semantic_search')
+    def search(self, indices, weights, top_k, n_probe=N_PROBE):
+        """Номера top_k документов и косинусы (только положительные).
+
+        С кластерами просматриваются n_probe ближайших к запросу; без них -
+        все документы.
+        """
+        vector = self.project(indices, weights)
+        if not vector.any():
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        if self.centroids is None or n_probe >= len(self.centroids):
+            lists = range(len(self.indptr) - 1)
+        else:
+            lists = np.sort(np.argpartition(self.centroids @ vector, -n_probe)[-n_probe:])
+        rows = [np.arange(self.indptr[i], self.indptr[i + 1]) for i in lists]
+        scores = np.concatenate([self._scores(self.indptr[i], self.indptr[i + 1], vector)
+                                 for i in lists])
+        top = top_k_indices(scores, top_k)
+        return self.doc_ids[np.concatenate(rows)[top]].astype(np.int64), scores[top]
+
+
+def lsa_exists(lsa_dir):
+    return exists(lsa_dir, META_FILE)
+
+
+def open_lsa_index(lsa_dir=LSA_DIR):
+    if not lsa_exists(lsa_dir):
+        raise FileNotFoundError(f"LSA-индекс не найден: {lsa_dir}")
+    return open_current(lsa_dir, LsaIndex)
+
+
+def refresh_lsa_index(index_dir=COMPILED_INDEX_DIR, lsa_dir=LSA_DIR):
+    """Пересборка LSA-индекса, собранного по index_dir, после его перекомпиляции.
+
+    Параметры (размерность, int8, кластеры) берутся из прежней сборки. None,
+    если LSA-индекса нет, он собран по другому индексу или уже актуален.
+    """
+    if not lsa_exists(lsa_dir):
+        return None
+    meta = read_meta(current_dir(lsa_dir), name=META_FILE)
+    # сборки без source_dir делались по индексу по умолчанию
+    if meta.get('source_dir', os.path.abspath(COMPILED_INDEX_DIR)) != os.path.abspath(index_dir):
+        return None
+    if meta['source_version'] == current_version(index_dir):
+        return None
+    n_lists = meta['n_lists'] if meta['n_lists'] > 1 else 0
+    return build_lsa_index(index_dir, lsa_dir, meta['rank'], meta['dtype'] == 'int8', n_lists,
+                           meta.get('seed', 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LSA-индекс для семантического поиска")
+    parser.add_argument('--index', default=COMPILED_INDEX_DIR, help="компилированный индекс")
+    parser.add_argument('--out', default=LSA_DIR)
+    parser.add_argument('--rank', type=int, default=RANK, help="размерность векторов")
+    parser.add_argument('--int8', action='store_true', help="квантовать векторы документов в int8")
+    parser.add_argument('--lists', type=int, default=0, help="число кластеров IVF (0 - без кластеров)")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"Сборка LSA-индекса из: {args.index}")
+    meta = build_lsa_index(args.index, args.out, args.rank, args.int8, args.lists, args.seed)
+    print(f"Индекс сохранен в: {args.out}\n- Документов: {meta['n_docs']}\n- Размерность: {meta['rank']}"
+          f" ({meta['dtype']})\n- Кластеров: {meta['n_lists']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+import numpy as np
+
+from search import top_k_indices
+from index_store import impact_order
+from instrumentation import inc, timed
+
+# Относительный запас порога на погрешность float32: границы оценок
+# считаются в float64, а точная оценка накапливается в float32.
+THRESHOLD_SLACK = 1e-5
+MIN_DEPTH = 256     # глубина чтения списков в первом раунде
+DEPTH_GROWTH = 8    # во сколько раз она растет за раунд
+# если следующий раунд прочитал бы больше этой доли работы полного перебора
+# (списки запроса плюс проход по оценкам всех документов), отсечение не
+# окупается и документы оцениваются полным перебором
+FULL_SCAN_FRACTION = 0.05
+# на маленьком корпусе полный перебор быстрее накладных расходов отсечения
+MIN_FULL_SCAN = 100000
+
+# Поиск top-k с динамическим отсечением поверх списков, отсортированных по
+# убыванию веса. Из каждого списка читается префикс; для каждого
+# встреченного документа известна нижняя граница оценки (сумма прочитанных
+# вкладов) и верхняя (плюс вес на границе префикса в списках, где документ
+# еще не встречен). k-я нижняя граница - порог входа в top-k. Для каждого
+# термина при сборке сохраняется максимальный вес - граница его вклада.
+# Как в MaxScore, термины с наименьшими границами, сумма которых ниже порога,
+# несущественны: документ только из их списков в top-k не попадет, поэтому
+# дальше читаются только существенные списки. Чтение заканчивается, когда
+# ни один еще не встреченный документ не может набрать порог; точно
+# оцениваются только встреченные документы с верхней границей не ниже
+# порога. Точные оценки совпадают с полным перебором (score_documents) до
+# бита: вклады складываются в том же порядке и в том же типе, поэтому
+# совпадает и ранжирование.
+
+
+class MaxScoreIndex:
+    """Top-k с отсечением по CSC-матрице и ее спискам по убыванию веса"""
+
+    def __init__(self, term_matrix, impact_doc_ids=None, impact_weights=None, max_weights=None):
+        self.term_matrix = term_matrix
+        self.indptr = term_matrix.indptr
+        self.doc_ids = term_matrix.indices
+        self.weights = term_matrix.data
+        if impact_doc_ids is None:
+            # индекс без списков по весу (текстовые данные, старая сборка)
+            impact_doc_ids, impact_weights, max_weights = impact_order(
+                self.indptr, self.doc_ids, self.weights)
+        self.impact_doc_ids = impact_doc_ids
+        self.impact_weights = impact_weights
+        self.max_weights = max_weights
+
+    @classmethod
+    def from_index(cls, index):
+        """По компилированному индексу (index_store.CompiledIndex)"""
+        return cls(index.term_matrix(), index.impact_doc_ids, index.impact_weights,
+                   index.max_weights)
+
+    def _score(self, candidates, indices, weights, query_norm):
+        """Точные оценки кандидатов (candidates отсортированы по номеру)"""
+        scores = np.zeros(len(candidates), dtype=np.float32)
+        for col, weight in zip(indices, weights):
+            start, end = self.indptr[col], self.indptr[col + 1]
+            if start == end:
+                continue
+            docs = self.doc_ids[start:end]
+            pos = np.minimum(np.searchsorted(docs, candidates), len(docs) - 1)
+            hit = docs[pos] == candidates
+            scores += np.where(hit, self.weights[start + pos], 0) * weight
+        scores /= query_norm
+        return scores
+
+    def _search(self, indices, weights, query_norm, top_k):
+        """Документы, которые могут попасть в top-k; None, если отсечение не окупается"""
+        starts = self.indptr[indices].astype(np.int64)
+        lengths = self.indptr[np.asarray(indices) + 1] - starts
+        full_scan = lengths.sum() + self.term_matrix.shape[0]
+        if full_scan < MIN_FULL_SCAN:
+            return None
+        scale = np.asarray(weights, dtype=np.float64) / query_norm
+        bounds = self.max_weights[indices] * scale
+        order = np.argsort(bounds, kind='stable')
+
+        taken = np.zeros(len(indices), dtype=np.int64)
+        essential = np.ones(len(indices), dtype=bool)
+        threshold = 0.0
+        depth = max(top_k, MIN_DEPTH)
+        while True:
+            taken[essential] = np.minimum(lengths, depth)[essential]
+            docs = np.concatenate([self.impact_doc_ids[s:s + n] for s, n in zip(starts, taken)])
+            contributions = np.concatenate([self.impact_weights[s:s + n] * f
+                                            for s, n, f in zip(starts, taken, scale)])
+            # вклад за границей префикса не больше веса на этой границе
+            unread = taken < lengths
+            remaining = np.zeros(len(indices))
+            remaining[unread] = self.impact_weights[(starts + taken)[unread]] * scale[unread]
+
+            seen, inverse = np.unique(docs, return_inverse=True)
+            lower = np.bincount(inverse, contributions, minlength=len(seen))
+            upper = lower + remaining.sum() - np.bincount(
+                inverse, np.repeat(remaining, taken), minlength=len(seen))
+            if len(seen) >= top_k:
+                kth = np.partition(lower, -top_k)[-top_k] * (1 - THRESHOLD_SLACK)
+                threshold = max(threshold, kth)
+            if threshold > 0:
+                essential[:] = False
+                essential[order[np.cumsum(bounds[order]) >= threshold]] = True
+
+            # не встреченный ни в одном префиксе документ набирает не больше
+            # remaining.sum(), а если он есть только в несущественных списках,
+            # в top-k не попадает
+            if remaining.sum() < threshold or not np.any(unread & essential):
+                return seen[upper >= threshold]
+            depth *= DEPTH_GROWTH
+            if (np.minimum(lengths, depth)[essential].sum() + taken[~essential].sum()
+                    > FULL_SCAN_FRACTION * full_scan):
+                return None
+
+    @timed('scoring_pruned')
+    def top_k(self, indices, weights, top_k, query_norm=None):
+        """Номера top_k документов и их оценки - как top_k_indices(score_documents(...)).
+
+        query_norm по умолчанию - норма weights; шарды передают общую норму запроса.
+        """
+        if query_norm is None:
+            query_norm = np.linalg.norm(weights)
+        if not len(indices) or top_k <= 0 or query_norm == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        candidates = self._search(indices, weights, query_norm, top_k)
+        if candidates is None:
+            inc('pruning_full_scans')
+            scores = self.term_matrix[:, indices] @ np.asarray(weights, dtype=np.float32)
+            scores /= query_norm
+            top = top_k_indices(scores, top_k)
+            return top, scores[top]
+        inc('pruned_candidates', len(candidates))
+        # кандидаты по возрастанию номера: среди равных оценок раньше меньший номер
+        scores = self._score(candidates, indices, weights, query_norm)
+        top = top_k_indices(scores, top_k)
+        return candidates[top].astype(np.int64), scores[top]
@@ -0,0 +1,171 @@
+import os
+import argparse
+from collections import defaultdict
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import nltk
+
+import lemma_token_extractor as extractor
+import tf_idf_extractor
+import inverted_index
+from doc_store import DOC_STORE_DIR, DocStoreWriter
+from index_store import COMPILED_INDEX_DIR
+from lsa import LSA_DIR, refresh_lsa_index
+from dedup import DEDUP_DIR, MAX_DISTANCE, REPORT_FILE, SignatureIndex, max_distance_arg
+from lemma_cache import format_stats
+from instrumentation import print_summary, registry
+
+# Однопроходная сборка: HTML -> (doc_id, счетчики) -> DF, TF-IDF файлы и
+# булев индекс без промежуточных файлов tokens/lemmas. Промежуточные файлы
+# пишутся только с --debug-output, в том же виде, что у lemma_token_extractor.
+# Тексты статей по ходу сборки складываются в хранилище doc_store - из него
+# демо строит фрагменты для выдачи. Из тех же матриц TF-IDF публикуется
+# компилированный индекс (его обслуживает демо) и пересобирается LSA-индекс,
+# если он был собран по этому индексу.
+# Почти одинаковые страницы (редиректы, репосты) отсеиваются по
+# SimHash-отпечаткам уже извлеченного текста (dedup) и в TF-IDF, индекс и
+# хранилище не попадают; их файлы от прошлых сборок удаляются.
+
+
+def iter_documents(pages_dir=extractor.INPUT_FOLDER, workers=extractor.WORKERS,
+                   chunk_size=extractor.CHUNK_SIZE, cache_path=None, stats=None,
+                   signatures=None, keep_text=True):
+    """Поток (имя файла, токены, леммы, текст) по мере готовности пачек в воркерах;
+    без keep_text текст - None.
+
+    С signatures (dedup.SignatureIndex) воркеры считают отпечатки текста, а
+    дубликаты отбрасываются здесь. Пачки тогда разбираются в порядке файлов:
+    страница сравнивается с принятыми до нее, и из группы дубликатов при любом
+    числе воркеров остается одна и та же.
+    """
+    files = sorted(f for f in os.listdir(pages_dir) if f.endswith('.html'))
+    batches = [files[i:i + chunk_size] for i in range(0, len(files), chunk_size)]
+    dedup = signatures is not None
+    with ProcessPoolExecutor(max_workers=workers, initializer=extractor.init_analyzers,
+                             initargs=(cache_path,)) as executor:
+        futures = [executor.submit(extractor.analyze_batch, batch, pages_dir, keep_text, dedup)
+                   for batch in batches]
+        for future in (futures if dedup else as_completed(futures)):
+            results, batch_stats, batch_metrics = future.result()
+            registry.merge(batch_metrics)
+            if stats is not None:
+                for key, value in batch_stats.items():
+                    stats[key] = stats.get(key, 0) + value
+            for filename, tokens, lemma_dict, text, fingerprint in results:
+                if dedup and signatures.add(os.path.splitext(filename)[0], fingerprint) is not None:
+                    continue
+                yield filename, tokens, lemma_dict, text
+
+
+def remove_stale_outputs(doc_ids, *folders):
+    """Удаляет файлы документов не из этой сборки (дубликаты, удаленные страницы),
+    чтобы их не подхватили компиляция индекса и шарды; число удаленных файлов"""
+    removed = 0
+    for folder in folders:
+        if not os.path.isdir(folder):
+            continue
+        for filename in os.listdir(folder):
+            name, ext = os.path.splitext(filename)
+            if ext == '.txt' and name not in doc_ids:
+                os.remove(os.path.join(folder, filename))
+                removed += 1
+    return removed
+
+
+def run_pipeline(pages_dir=extractor.INPUT_FOLDER, workers=extractor.WORKERS,
+                 chunk_size=extractor.CHUNK_SIZE, cache_path=None, debug_output=False,
+                 store_dir=DOC_STORE_DIR, dedup_dir=DEDUP_DIR, max_distance=MAX_DISTANCE,
+                 index_dir=COMPILED_INDEX_DIR):
+    # те же структуры, что возвращает tf_idf_extractor.load_data
+    token_index = defaultdict(list)
+    lemma_index = defaultdict(list)
+    token_stats = defaultdict(dict)
+    lemma_stats = defaultdict(dict)
+    all_docs = set()
+    doc_lemmas = {}
+    stats = {}
+
+    if debug_output:
+        extractor.setup_folders()
+
+    signatures = SignatureIndex(max_distance) if dedup_dir else None
+    documents = iter_documents(pages_dir, workers, chunk_size, cache_path, stats, signatures,
+                               keep_text=bool(store_dir))
+    with DocStoreWriter(store_dir) if store_dir else nullcontext() as store:
+        for filename, tokens, lemma_dict, text in documents:
+            doc_id = os.path.splitext(filename)[0]
+            all_docs.add(doc_id)
+            if debug_output:
+                extractor.save_results(filename, tokens, lemma_dict)
+            if store is not None:
+                store.add(doc_id, text)
+
+            # файл токенов хранит уникальные токены, поэтому у каждого счетчик 1;
+            # порядок - как у строк промежуточных файлов, чтобы вывод совпадал
+            for token in sorted(set(tokens)):
+                token_index[token].append(doc_id)
+                token_stats[doc_id][token] = 1
+            # ключ с двоеточием - так лемма читается из строки "лемма: формы"
+            # в tf_idf_extractor.load_data, и в таком виде попадает в TF-IDF файлы
+            for lemma, forms in sorted(lemma_dict.items()):
+                lemma_index[f"{lemma}:"].append(doc_id)
+                lemma_stats[doc_id][f"{lemma}:"] = len(forms)
+            doc_lemmas[doc_id] = list(lemma_dict)
+
+    if signatures is not None:
+        signatures.save(dedup_dir)
+        print(f"[ДУБЛИКАТЫ] Пропущено страниц: {len(signatures.duplicates)}, "
+              f"отчет: {os.path.join(dedup_dir, REPORT_FILE)}")
+
+    tf_idf_extractor.compute_tfidf((token_index, lemma_index, token_stats, lemma_stats, all_docs),
+                                   index_dir=index_dir)
+    inverted_index.build_index_from_documents(
+        (doc_id, doc_lemmas[doc_id]) for doc_id in sorted(doc_lemmas)
+    )
+    removed = remove_stale_outputs(set(token_stats), tf_idf_extractor.TOKENS_OUTPUT,
+                                   extractor.TOKENS_FOLDER)
+    removed += remove_stale_outputs(set(lemma_stats), tf_idf_extractor.LEMMAS_OUTPUT,
+                                    extractor.LEMMAS_FOLDER)
+    if removed:
+        print(f"Удалено файлов документов не из этой сборки: {removed}")
+    if index_dir:
+        print(f"Компилированный индекс сохранен в: {index_dir}")
+        if refresh_lsa_index(index_dir):
+            print(f"LSA-индекс пересобран: {LSA_DIR}")
+    return len(all_docs), stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Однопроходная сборка TF-IDF и индекса из HTML")
+    parser.add_argument('--workers', type=int, default=extractor.WORKERS)
+    parser.add_argument('--chunk-size', type=int, default=extractor.CHUNK_SIZE)
+    parser.add_argument('--lemma-cache', default=extractor.LEMMA_CACHE_FILE,
+                        help="sqlite-файл кэша лемм ('' - только в памяти)")
+    parser.add_argument('--debug-output', action='store_true',
+                        help="дополнительно записать файлы tokens/ и lemmas/")
+    parser.add_argument('--doc-store', default=DOC_STORE_DIR,
+                        help="папка хранилища текстов статей ('' - не сохранять тексты)")
+    parser.add_argument('--dedup', default=DEDUP_DIR,
+                        help="папка отпечатков и отчета о дубликатах ('' - не искать дубликаты)")
+    parser.add_argument('--index-dir', default=COMPILED_INDEX_DIR,
+                        help="папка компилированного индекса ('' - не собирать)")
+    parser.add_argument('--max-distance', type=max_distance_arg, default=MAX_DISTANCE,
+                        help="наибольшее расстояние Хэмминга между SimHash-отпечатками дубликатов")
+    args = parser.parse_args()
+
+    extractor.setup_logging()
+    nltk.download('stopwords')
+
+    n_docs, stats = run_pipeline(workers=args.workers, chunk_size=args.chunk_size,
+                                 cache_path=args.lemma_cache or None,
+                                 debug_output=args.debug_output,
+                                 store_dir=args.doc_store or None,
+                                 dedup_dir=args.dedup or None, max_distance=args.max_distance,
+                                 index_dir=args.index_dir or None)
+    print(f"Готово! Обработано {n_docs} документов.\n{format_stats(stats)}")
+    print_summary()
+
+
+if __name__ == '__main__':
+    main()
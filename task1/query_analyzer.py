@@ -0,0 +1,59 @@
+import os
+import sqlite3
+from functools import lru_cache
+
+from instrumentation import timed
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# тот же sqlite-кэш лемм, что у сборки (lemma_token_extractor.LEMMA_CACHE_FILE
+# при запуске из task1); путь абсолютный - демо запускается из demo/
+LEMMA_CACHE_FILE = os.path.join(BASE_DIR, 'lemma_cache.sqlite')
+QUERY_CACHE_SIZE = 10000
+
+# Разбор запроса той же цепочкой, что и при индексации: токенизатор,
+# стоп-слова и фильтр коротких слов из text_analysis, леммы - через
+# общий LemmaCache. Иначе словоформа из запроса ("программами") не совпадает
+# с нормальной формой в индексе ("программа").
+
+
+class QueryAnalyzer:
+    def __init__(self, cache_path=None, maxsize=QUERY_CACHE_SIZE):
+        # импорт здесь: без pymorphy2/NLTK модуль поиска остается рабочим
+        import text_analysis
+        text_analysis.init_analyzers(cache_path)
+        self.analysis = text_analysis
+        # повторяющиеся запросы не разбираются заново
+        self._analyze = lru_cache(maxsize=maxsize)(self._analyze_uncached)
+
+    def lemma(self, token):
+        # разборы с низкой оценкой при индексации отбрасываются - такое слово
+        # остается как есть и просто не найдется
+        lemma, score = self.analysis.lemma_cache.parse(token)
+        return lemma if score >= 0.5 else token
+
+    @timed('query_lemmatize')
+    def _analyze_uncached(self, text):
+        return tuple(self.lemma(token) for token in self.analysis.clean_and_tokenize(text.lower()))
+
+    def analyze(self, text):
+        """Леммы слов текста в порядке следования (стоп-слова отброшены)"""
+        return list(self._analyze(text))
+
+    __call__ = analyze
+
+
+def load_query_analyzer(cache_path=LEMMA_CACHE_FILE):
+    """QueryAnalyzer или None, если pymorphy2/стоп-слова NLTK недоступны или
+    не запускаются - тогда слова запроса берутся как есть.
+
+    Разборы берутся из sqlite-кэша лемм cache_path и дописываются в него; если
+    файл не открывается (нет прав на запись), кэш остается только в памяти.
+    """
+    try:
+        return QueryAnalyzer(cache_path)
+    except sqlite3.Error as e:
+        print(f"[ПРЕДУПРЕЖДЕНИЕ] Кэш лемм {cache_path} недоступен ({e}), кэш только в памяти")
+        return load_query_analyzer(None)
+    except Exception as e:
+        print(f"[ПРЕДУПРЕЖДЕНИЕ] Лемматизация запросов отключена: {e}")
+        return None
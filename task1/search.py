@@ -1,6 +1,9 @@
 import os
 import numpy as np
-from sklearn.metrics.pairwise import cosine_similarity
+from scipy import sparse
+
+from query_analyzer import load_query_analyzer
+from instrumentation import timed
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 TFIDF_RESULTS_DIR = os.path.join(BASE_DIR, "tfidf_results", "lemmas")
@@ -11,8 +14,11 @@ def load_tfidf_data(folder_path):
     if not os.path.exists(folder_path):
         raise FileNotFoundError(f"Папка не найдена: {folder_path}")
 
-    all_words = set()
-    documents_tfidf = []
+    # Словарь термин -> номер столбца и CSR-разметка матрицы документов
+    vocab = {}
+    indptr = [0]
+    indices = []
+    weights = []
     filenames = []
 
     for filename in sorted(os.listdir(folder_path)):
@@ -31,53 +37,174 @@ def load_tfidf_data(folder_path):
                     word = parts[0].rstrip(':')
                     tf, idf = map(float, parts[1:3])
                     doc_words[word] = tf * idf
-                    all_words.add(word)
-
-                documents_tfidf.append(doc_words)
-                filenames.append(filename)
         except Exception as e:
             print(f"Ошибка чтения {filename}: {e}")
+            continue
 
-    vocab = sorted(all_words)
-    tfidf_matrix = np.zeros((len(documents_tfidf), len(vocab)))
+        for word, weight in doc_words.items():
+            indices.append(vocab.setdefault(word, len(vocab)))
+            weights.append(weight)
+        indptr.append(len(indices))
+        filenames.append(filename)
 
-    for i, doc in enumerate(documents_tfidf):
-        for j, word in enumerate(vocab):
-            tfidf_matrix[i, j] = doc.get(word, 0.0)
+    tfidf_matrix = sparse.csr_matrix(
+        (np.asarray(weights, dtype=np.float32),
+         np.asarray(indices, dtype=np.int32),
+         np.asarray(indptr, dtype=np.int64)),
+        shape=(len(filenames), len(vocab))
+    )
 
     return tfidf_matrix, vocab, filenames
 
 
-#2. Обработка запроса
-def process_query(query, vocab):
-    query_words = query.lower().split()
-    vector = np.zeros(len(vocab))
+def load_url_mapping(index_file):
+    """Соответствие имени файла документа и URL страницы из index.txt"""
+    mapping = {}
+    with open(index_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            parts = line.strip().split('\t')
+            if len(parts) >= 2:
+                mapping[f"page_{parts[0]}.txt"] = parts[1]
+    return mapping
 
-    for word in query_words:
-        if word in vocab:
-            idx = vocab.index(word)
-            vector[idx] += 1
 
-    if np.sum(vector) > 0:
-        vector /= len(query_words)
+#2. Обработка запроса
+@timed('query_vectorize')
+def process_query(query, vocab, analyzer=None):
+    """Разреженный вектор запроса: номера столбцов и веса терминов.
+
+    analyzer (QueryAnalyzer) приводит слова запроса к леммам индекса;
+    без него слова берутся как есть.
+    """
+    query_words = analyzer(query) if analyzer else query.lower().split()
+    counts = {}
 
-    return vector
+    for word in query_words:
+        col = vocab.get(word)
+        if col is not None:
+            counts[col] = counts.get(col, 0) + 1
+
+    indices = np.fromiter(counts.keys(), dtype=np.int32, count=len(counts))
+    weights = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+    if len(indices):
+        weights /= len(query_words)
+
+    return indices, weights
+
+
+def normalize_rows(tfidf_matrix):
+    """L2-нормировка строк матрицы; возвращает нормированную матрицу и нормы"""
+    doc_norms = np.sqrt(np.asarray(tfidf_matrix.multiply(tfidf_matrix).sum(axis=1)).ravel())
+    scale = np.divide(1.0, doc_norms, out=np.zeros_like(doc_norms), where=doc_norms > 0)
+    normalized = sparse.diags(scale.astype(np.float32)) @ tfidf_matrix
+    return normalized.tocsr(), doc_norms
+
+
+@timed('scoring')
+def score_documents(query_vector, term_matrix):
+    """Косинусная близость запроса к документам.
+
+    term_matrix - матрица с L2-нормированными строками в формате CSC, поэтому
+    оценка сводится к одному разреженному произведению по столбцам терминов
+    запроса.
+    """
+    indices, weights = query_vector
+    scores = term_matrix[:, indices] @ weights
+    query_norm = np.linalg.norm(weights)
+    if query_norm > 0:
+        scores /= query_norm
+    return scores
+
+
+@timed('top_k')
+def top_k_indices(scores, top_k):
+    """Номера top_k документов с ненулевой оценкой по убыванию оценки;
+    при равных оценках раньше идет документ с меньшим номером"""
+    candidates = np.flatnonzero(scores > 0)
+    if len(candidates) > top_k:
+        candidate_scores = scores[candidates]
+        kth = np.partition(candidate_scores, -top_k)[-top_k]
+        # из равных пороговой оценке берутся первые по номеру
+        above = candidates[candidate_scores > kth]
+        ties = candidates[candidate_scores == kth][:top_k - len(above)]
+        candidates = np.concatenate((above, ties))
+    return candidates[np.argsort(-scores[candidates], kind='stable')]
+
+
+def process_queries(queries, vocab, analyzer=None):
+    """Разреженная матрица пакета запросов (запросы x словарь) с нормированными строками"""
+    indptr = [0]
+    indices = []
+    weights = []
+    for query in queries:
+        query_indices, query_weights = process_query(query, vocab, analyzer)
+        norm = np.linalg.norm(query_weights)
+        indices.extend(query_indices)
+        weights.extend(query_weights / norm if norm > 0 else query_weights)
+        indptr.append(len(indices))
+
+    return sparse.csr_matrix(
+        (np.asarray(weights, dtype=np.float32),
+         np.asarray(indices, dtype=np.int32),
+         np.asarray(indptr, dtype=np.int64)),
+        shape=(len(queries), len(vocab))
+    )
+
+
+@timed('scoring_batch')
+def score_queries(query_matrix, term_matrix):
+    """Оценки всего пакета одним произведением матриц (запросы x документы)"""
+    return (query_matrix @ term_matrix.T).tocsr()
+
+
+@timed('top_k_batch')
+def top_k_rows(score_matrix, top_k):
+    """Для каждой строки - номера и оценки top_k ненулевых столбцов по убыванию.
+
+    Все ненулевые оценки сортируются разом по (строка, -оценка), после чего
+    из каждой строки берутся первые top_k элементов.
+    """
+    if score_matrix.shape[0] == 0:
+        return []
+    score_matrix.eliminate_zeros()
+    score_matrix.sort_indices()
+    counts = np.diff(score_matrix.indptr)
+    rows = np.repeat(np.arange(score_matrix.shape[0]), counts)
+    order = np.lexsort((-score_matrix.data, rows))
+    rank = np.arange(len(order)) - score_matrix.indptr[rows]
+    keep = order[rank < top_k]
+
+    bounds = np.cumsum(np.minimum(counts, top_k))[:-1]
+    return list(zip(np.split(score_matrix.indices[keep], bounds),
+                    np.split(score_matrix.data[keep], bounds)))
 
 
 # 3. Поиск документов
-def find_top_documents(query_vector, tfidf_matrix, filenames, top_k=5):
-    similarities = cosine_similarity(query_vector.reshape(1, -1), tfidf_matrix)[0]
-    top_indices = np.argsort(similarities)[-top_k:][::-1]
+def find_top_documents(query_vector, term_matrix, filenames, top_k=5):
+    similarities = score_documents(query_vector, term_matrix)
+    top_indices = top_k_indices(similarities, top_k)
     return [(filenames[i], similarities[i]) for i in top_indices]
 
 
+def find_top_documents_many(queries, vocab, term_matrix, filenames, top_k=5, analyzer=None):
+    """Пакетный поиск: список результатов find_top_documents для каждого запроса"""
+    score_matrix = score_queries(process_queries(queries, vocab, analyzer), term_matrix)
+    return [
+        [(filenames[i], score) for i, score in zip(top_indices, scores)]
+        for top_indices, scores in top_k_rows(score_matrix, top_k)
+    ]
+
+
 # --- Основной цикл ---
 def main():
     print(f"\nЗагрузка данных из: {TFIDF_RESULTS_DIR}")
 
     try:
         tfidf_matrix, vocab, filenames = load_tfidf_data(TFIDF_RESULTS_DIR)
+        tfidf_matrix, _ = normalize_rows(tfidf_matrix)
+        term_matrix = tfidf_matrix.tocsc()
         print(f"Успешно загружено:\n- Документов: {len(filenames)}\n- Уникальных слов: {len(vocab)}")
+        analyzer = load_query_analyzer()
 
         while True:
             print("\n" + "=" * 50)
@@ -89,8 +216,12 @@ def main():
                 print("Введите непустой запрос")
                 continue
 
-            query_vector = process_query(query, vocab)
-            results = find_top_documents(query_vector, tfidf_matrix, filenames)
+            query_vector = process_query(query, vocab, analyzer)
+            results = find_top_documents(query_vector, term_matrix, filenames)
+
+            if not results:
+                print("\nНичего не найдено")
+                continue
 
             print("\nТоп результатов:")
             for i, (filename, score) in enumerate(results, 1):
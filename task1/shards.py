@@ -0,0 +1,258 @@
+import os
+import heapq
+import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+from search import TFIDF_RESULTS_DIR, load_tfidf_data, load_url_mapping, normalize_rows
+from index_store import (INDEX_FILE, index_exists, new_version_dir, open_current, open_index,
+                         publish, read_meta, save_postings, write_meta)
+import inverted_index
+from inverted_index import evaluate, lemmatize_tree, parse_query
+from query_analyzer import load_query_analyzer
+from maxscore import MaxScoreIndex
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SHARDS_DIR = os.path.join(BASE_DIR, 'sharded_index')
+MANIFEST_FILE = 'shards.json'
+N_SHARDS = os.cpu_count() or 1
+
+# Шардированный индекс: документы делятся на N непрерывных диапазонов с
+# примерно равным числом постингов. Шард - два компилированных индекса
+# (index_store) со своими постингами и таблицей документов: vector/ из
+# TF-IDF файлов (веса, нормы, URL) и boolean/ из файлов лемм, как у
+# inverted_index. Веса считаются по всему корпусу, поэтому IDF общий. Запрос
+# рассылается по шардам, каждый возвращает свой top-k, а общий top-k
+# получается слиянием - с тем же порядком при равных оценках, что и у
+# единого индекса, так как шарды идут в порядке документов.
+#
+# Набор шардов публикуется одной версией: все шарды и shards.json пишутся в
+# каталог v-<версия> без собственных версий и указателей, и только потом
+# корневой CURRENT переключается на него. Поэтому читатель всегда открывает
+# шарды одной сборки, а не смесь старых и новых.
+
+
+def build_shards(data_dir=TFIDF_RESULTS_DIR, index_file=INDEX_FILE, out_dir=SHARDS_DIR,
+                 n_shards=N_SHARDS, lemmas_dir=None):
+    tfidf_matrix, vocab, filenames = load_tfidf_data(data_dir)
+    tfidf_matrix, doc_norms = normalize_rows(tfidf_matrix)
+    terms = sorted(vocab, key=lambda term: term.encode('utf-8'))
+    order = np.fromiter((vocab[term] for term in terms), dtype=np.int64, count=len(terms))
+    matrix = tfidf_matrix[:, order].tocsr()
+    url_mapping = load_url_mapping(index_file)
+    urls = [url_mapping.get(filename, "#") for filename in filenames]
+
+    # границы шардов - по накопленному числу постингов
+    n_docs = len(filenames)
+    n_shards = max(1, min(n_shards, n_docs))
+    cumulative = np.cumsum(np.diff(matrix.indptr))
+    total = cumulative[-1] if n_docs else 0
+    bounds = np.searchsorted(cumulative, total * np.arange(1, n_shards) / n_shards, side='right')
+    bounds = np.unique(np.concatenate(([0], np.clip(bounds, 1, n_docs), [n_docs])))
+
+    # леммы документов для булевой части, если файлы лемм есть
+    lemmas_dir = lemmas_dir or inverted_index.LEMMAS_FOLDER
+    doc_lemmas = {}
+    if os.path.isdir(lemmas_dir):
+        lemma_files = sorted(f for f in os.listdir(lemmas_dir) if f.endswith('.txt'))
+        doc_lemmas = dict(inverted_index.read_lemma_documents(lemma_files, lemmas_dir))
+
+    version, tmp_dir = new_version_dir(out_dir)
+    shards = []
+    for shard_no, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+        block = matrix[start:end].tocsc()
+        nonempty = np.flatnonzero(np.diff(block.indptr))
+        block = block[:, nonempty]
+        block.sort_indices()
+        name = f"shard_{shard_no:03d}"
+        save_postings(os.path.join(tmp_dir, name, 'vector'), [terms[col] for col in nonempty],
+                      block.indptr, block.indices, filenames[start:end], weights=block.data,
+                      doc_norms=doc_norms[start:end], urls=urls[start:end], versioned=False)
+        if doc_lemmas:
+            doc_ids = [os.path.splitext(filename)[0] for filename in filenames[start:end]]
+            inverted_index.build_index_from_documents(
+                ((doc_id, doc_lemmas[doc_id]) for doc_id in doc_ids if doc_id in doc_lemmas),
+                os.path.join(tmp_dir, name, 'boolean'), verbose=False, versioned=False)
+        shards.append({'name': name, 'first_doc': int(start), 'n_docs': int(end - start)})
+
+    manifest = {
+        'version': version,
+        'n_docs': n_docs,
+        'n_terms': len(terms),
+        'shards': shards,
+    }
+    write_meta(tmp_dir, manifest, MANIFEST_FILE)
+    publish(out_dir, tmp_dir)
+    return manifest
+
+
+class ShardSet:
+    """Открытые шарды и операции над одним шардом (index_dir - каталог версии)"""
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self.manifest = read_meta(index_dir, name=MANIFEST_FILE)
+        self.shards = [open_index(os.path.join(index_dir, shard['name'], 'vector'))
+                       for shard in self.manifest['shards']]
+        self.pruned = [MaxScoreIndex.from_index(shard) for shard in self.shards]
+        boolean_dirs = [os.path.join(index_dir, shard['name'], 'boolean')
+                        for shard in self.manifest['shards']]
+        self.boolean_shards = None
+        if all(index_exists(path) for path in boolean_dirs):
+            self.boolean_shards = [open_index(path) for path in boolean_dirs]
+
+    def __len__(self):
+        return len(self.shards)
+
+    def has_term(self, term):
+        return any(shard.vocab.get(term) is not None for shard in self.shards)
+
+    def top_k(self, shard_no, terms, weights, query_norm, top_k):
+        """Локальный top-k шарда: номера документов в шарде и оценки"""
+        vocab = self.shards[shard_no].vocab
+        cols = []
+        shard_weights = []
+        for term, weight in zip(terms, weights):
+            col = vocab.get(term)
+            if col is not None:
+                cols.append(col)
+                shard_weights.append(weight)
+        if not cols:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        # нормируется общей нормой запроса, а не нормой его части в шарде
+        return self.pruned[shard_no].top_k(np.asarray(cols, dtype=np.int32),
+                                           np.asarray(shard_weights, dtype=np.float32),
+                                           top_k, query_norm)
+
+    def boolean(self, shard_no, tree):
+        return evaluate(tree, self.boolean_shards[shard_no])
+
+
+# шарды процесса-воркера открываются один раз, страницы файлов общие через mmap
+_worker_shards = None
+
+
+def open_shards(index_dir=SHARDS_DIR):
+    return open_current(index_dir, ShardSet)
+
+
+def _init_worker(version_dir):
+    global _worker_shards
+    _worker_shards = ShardSet(version_dir)
+
+
+def _shard_call(method, shard_no, *args):
+    return getattr(_worker_shards, method)(shard_no, *args)
+
+
+class ShardedIndex:
+    """Запросы к шардам через пул потоков (mode='thread') или локальных
+    процессов-воркеров (mode='process') со слиянием результатов"""
+
+    def __init__(self, index_dir=SHARDS_DIR, workers=None, mode='thread', analyzer=None):
+        self.shard_set = open_shards(index_dir)
+        self.analyzer = load_query_analyzer() if analyzer is None else analyzer
+        self.mode = mode
+        workers = workers or min(len(self.shard_set), N_SHARDS)
+        if mode == 'process':
+            self.executor = ProcessPoolExecutor(workers, initializer=_init_worker,
+                                                # та же версия, что у родителя
+                                                initargs=(self.shard_set.index_dir,))
+        else:
+            self.executor = ThreadPoolExecutor(workers)
+
+    @property
+    def version(self):
+        return self.shard_set.manifest['version']
+
+    def _scatter(self, method, *args):
+        if self.mode == 'process':
+            futures = [self.executor.submit(_shard_call, method, shard_no, *args)
+                       for shard_no in range(len(self.shard_set))]
+        else:
+            call = getattr(self.shard_set, method)
+            futures = [self.executor.submit(call, shard_no, *args)
+                       for shard_no in range(len(self.shard_set))]
+        return [future.result() for future in futures]
+
+    def _query_vector(self, query):
+        """Термины и веса запроса как в search.process_query, но по словарям всех шардов"""
+        query_words = self.analyzer(query) if self.analyzer else query.lower().split()
+        counts = {}
+        for word in query_words:
+            if word in counts or self.shard_set.has_term(word):
+                counts[word] = counts.get(word, 0) + 1
+        weights = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+        if len(weights):
+            weights /= len(query_words)
+        return list(counts), weights
+
+    def search(self, query, top_k=10):
+        """[(имя документа, url, оценка)] по убыванию оценки"""
+        terms, weights = self._query_vector(query)
+        query_norm = np.linalg.norm(weights)
+        if not terms or query_norm == 0:
+            return []
+        parts = self._scatter('top_k', terms, weights, query_norm, top_k)
+        best = heapq.nsmallest(top_k, ((-score, shard_no, int(doc))
+                                       for shard_no, (docs, scores) in enumerate(parts)
+                                       for doc, score in zip(docs, scores)))
+        shards = self.shard_set.shards
+        return [(shards[shard_no].filenames[doc], shards[shard_no].urls[doc], float(-score))
+                for score, shard_no, doc in best]
+
+    def search_boolean(self, query):
+        """Булев поиск: имена документов в порядке документов (ValueError при ошибке разбора)"""
+        if self.shard_set.boolean_shards is None:
+            raise ValueError("в шардах нет булевой части (не было файлов лемм при сборке)")
+        tree = parse_query(query)
+        if self.analyzer:
+            tree = lemmatize_tree(tree, self.analyzer)
+            if tree is None:
+                return []
+        parts = self._scatter('boolean', tree)
+        return [self.shard_set.boolean_shards[shard_no].filenames[int(doc)]
+                for shard_no, docs in enumerate(parts) for doc in docs]
+
+    def close(self):
+        self.executor.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Шардированный индекс: сборка и поиск")
+    parser.add_argument('command', choices=('build', 'search'))
+    parser.add_argument('query', nargs='?', default='')
+    parser.add_argument('--shards', type=int, default=N_SHARDS, help="число шардов при сборке")
+    parser.add_argument('--index', default=SHARDS_DIR, help="папка шардированного индекса")
+    parser.add_argument('--workers', type=int, default=None, help="число воркеров запроса")
+    parser.add_argument('--mode', choices=('thread', 'process'), default='thread')
+    parser.add_argument('--boolean', action='store_true', help="булев запрос вместо векторного")
+    parser.add_argument('--top-k', type=int, default=10)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        manifest = build_shards(out_dir=args.index, n_shards=args.shards)
+        sizes = ', '.join(str(shard['n_docs']) for shard in manifest['shards'])
+        print(f"Индекс сохранен в: {args.index}\n- Документов: {manifest['n_docs']}\n"
+              f"- Шардов: {len(manifest['shards'])} (документов: {sizes})")
+        return
+
+    index = ShardedIndex(args.index, args.workers, args.mode)
+    try:
+        if args.boolean:
+            results = index.search_boolean(args.query)
+            print(f"Найдено документов: {len(results)}")
+            for doc in results:
+                print(f"- {doc}")
+        else:
+            for i, (filename, url, score) in enumerate(index.search(args.query, args.top_k), 1):
+                print(f"{i}. {filename} {url} (сходство: {score:.4f})")
+    except ValueError as e:
+        print(f"[ОШИБКА] Ошибка разбора запроса: {e}")
+    finally:
+        index.close()
+
+
+if __name__ == '__main__':
+    main()
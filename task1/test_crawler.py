@@ -0,0 +1,118 @@
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import crawler
+
+# Обход против локального HTTP-сервера: ответы по номеру поста задаются в
+# Handler.responses, по умолчанию - 200 со страницей.
+
+
+class Handler(BaseHTTPRequestHandler):
+    responses = {}      # номер поста -> список статусов по очереди (последний повторяется)
+    requests = []
+
+    def do_GET(self):
+        post_id = int(self.path.strip('/').split('/')[-1])
+        self.requests.append(post_id)
+        statuses = self.responses.get(post_id, [200])
+        status = statuses.pop(0) if len(statuses) > 1 else statuses[0]
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.end_headers()
+        if status == 200:
+            self.wfile.write(f'<html><body>пост {post_id}</body></html>'.encode('utf-8'))
+
+    def log_message(self, *args):
+        pass
+
+
+class CrawlerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_port}/post/'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        Handler.responses = {}
+        Handler.requests = []
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def crawler(self, target, **kwargs):
+        options = dict(concurrency=1, rate=1000, burst=1000, max_retries=2, backoff=0.01)
+        options.update(kwargs)
+        return crawler.Crawler(self.base_url, os.path.join(self.dir, 'pages'),
+                               os.path.join(self.dir, 'index.txt'),
+                               os.path.join(self.dir, 'state.json'), target=target, **options)
+
+    def index_lines(self):
+        with open(os.path.join(self.dir, 'index.txt'), 'r', encoding='utf-8') as f:
+            return [line.rstrip('\n').split('\t') for line in f]
+
+    def pages(self):
+        return sorted(os.listdir(os.path.join(self.dir, 'pages')))
+
+    def test_retries_temporary_errors(self):
+        Handler.responses = {1: [503, 429, 200]}
+        self.assertEqual(self.crawler(1).run(), 1)
+        self.assertEqual(Handler.requests, [1, 1, 1])
+        self.assertEqual(self.index_lines(), [['1', f'{self.base_url}1/']])
+
+    def test_skips_missing_posts(self):
+        Handler.responses = {2: [404]}
+        self.assertEqual(self.crawler(2).run(), 2)
+        self.assertEqual(Handler.requests, [1, 2, 3])
+        self.assertEqual([url for _, url in self.index_lines()],
+                         [f'{self.base_url}1/', f'{self.base_url}3/'])
+        self.assertEqual(self.pages(), ['page_1.html', 'page_2.html'])
+
+    def test_resume_retries_posts_that_kept_failing(self):
+        Handler.responses = {2: [503]}
+        self.assertEqual(self.crawler(2, max_retries=1).run(), 2)
+        self.assertNotIn(f'{self.base_url}2/', [url for _, url in self.index_lines()])
+
+        Handler.responses = {}
+        Handler.requests = []
+        self.assertEqual(self.crawler(3).run(), 3)
+        # пост 2 скачивается заново, уже обработанные не запрашиваются
+        self.assertEqual(Handler.requests, [2])
+        self.assertEqual(self.index_lines(), [['1', f'{self.base_url}1/'],
+                                              ['2', f'{self.base_url}3/'],
+                                              ['3', f'{self.base_url}2/']])
+
+    def test_resume_finishes_interrupted_publish(self):
+        first = self.crawler(2)
+
+        def crash(*args, **kwargs):
+            raise RuntimeError('сбой перед публикацией')
+        first._publish_page = crash
+        with self.assertRaises(RuntimeError):
+            first.run()
+
+        self.assertEqual(self.crawler(2).run(), 2)
+        self.assertEqual(self.index_lines(), [['1', f'{self.base_url}1/'],
+                                              ['2', f'{self.base_url}2/']])
+        self.assertEqual(self.pages(), ['page_1.html', 'page_2.html'])
+
+    def test_gives_up_after_consecutive_failures(self):
+        Handler.responses = {post_id: [404] for post_id in range(1, 100)}
+        self.assertEqual(self.crawler(5, max_failures=5).run(), 0)
+        self.assertEqual(len(Handler.requests), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
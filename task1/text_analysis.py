@@ -0,0 +1,70 @@
+import logging
+
+import pymorphy2
+from nltk.tokenize import RegexpTokenizer
+from nltk.corpus import stopwords
+
+from lemma_cache import LemmaCache
+from instrumentation import timed
+
+# Цепочка разбора текста - токенизатор, стоп-слова, фильтр коротких слов и
+# леммы через LemmaCache - общая для индексации (lemma_token_extractor) и
+# запросов (query_analyzer). Модуль ничего не настраивает при импорте: журнал
+# в файл включают только командные утилиты сборки.
+
+# Анализатор, кэш лемм и стоп-слова создаются init_analyzers() - один раз на процесс
+morph = None
+lemma_cache = None
+stop_words_ru = set()
+stop_words_en = set()
+tokenizer = RegexpTokenizer(r'\b[а-яА-ЯёЁa-zA-Z]+\b')
+
+
+def init_analyzers(cache_path=None):
+    global morph, lemma_cache, stop_words_ru, stop_words_en
+    if morph is None:
+        # morph присваивается последним: после ошибки (например, sqlite-файл
+        # кэша не открылся) повторный вызов инициализирует все заново
+        analyzer = pymorphy2.MorphAnalyzer()
+        lemma_cache = LemmaCache(analyzer, path=cache_path)
+        stop_words_ru = set(stopwords.words('russian'))
+        stop_words_en = set(stopwords.words('english'))
+        morph = analyzer
+
+
+@timed('tokenize')
+def clean_and_tokenize(text):
+    try:
+        tokens = tokenizer.tokenize(text)
+
+        # фильтр стоп слов и коротких слов
+        clean_tokens = [
+            token for token in tokens
+            if (len(token) > 2 and
+                token not in stop_words_ru and
+                token not in stop_words_en and
+                not token.isdigit())
+        ]
+        return clean_tokens
+    except Exception as e:
+        logging.error(f"Ошибка токенизации: {str(e)}")
+        return []
+
+
+@timed('lemmatize')
+def lemmatize_tokens(tokens):
+    lemma_dict = {}
+    try:
+        for token in tokens:
+            try:
+                lemma, score = lemma_cache.parse(token)
+                if score >= 0.5:
+                    if lemma not in lemma_dict:
+                        lemma_dict[lemma] = set()
+                    lemma_dict[lemma].add(token)
+            except:
+                continue
+    except Exception as e:
+        logging.error(f"Ошибка лемматизации: {str(e)}")
+
+    return {lemma: sorted(token_set) for lemma, token_set in lemma_dict.items()}
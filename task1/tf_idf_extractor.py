@@ -1,7 +1,13 @@
 import os
 import math
+import argparse
 from collections import defaultdict, Counter
 
+import numpy as np
+from scipy import sparse
+
+from instrumentation import inc, print_summary, timed
+
 # Конфигурация путей
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 TOKENS_DIR = os.path.join(BASE_DIR, 'lemma_token_output', 'tokens')
@@ -9,6 +15,7 @@ LEMMAS_DIR = os.path.join(BASE_DIR, 'lemma_token_output', 'lemmas')
 OUTPUT_DIR = os.path.join(BASE_DIR, 'tfidf_results')
 TOKENS_OUTPUT = os.path.join(OUTPUT_DIR, 'tokens')
 LEMMAS_OUTPUT = os.path.join(OUTPUT_DIR, 'lemmas')
+TFIDF_THRESHOLD = 0.0001
 
 # Создаем выходные директории
 os.makedirs(TOKENS_OUTPUT, exist_ok=True)
@@ -61,9 +68,103 @@ def load_data():
             all_docs)
 
 
-def compute_tfidf():
-    # 1. Загрузка данных
-    token_index, lemma_index, token_stats, lemma_stats, all_docs = load_data()
+class TfidfWeights:
+    """TF-IDF одного вида терминов (токены или леммы) в матричном виде.
+
+    Строки matrix - документы docs, столбцы - термины terms; внутри строки
+    термины идут в порядке словаря документа, как при построчной записи.
+    В матрице только веса, прошедшие фильтр TFIDF_THRESHOLD.
+    """
+
+    def __init__(self, stats, docs, total_docs):
+        self.docs = docs
+        vocab = {}
+        indptr = np.zeros(len(docs) + 1, dtype=np.int64)
+        indices = []
+        counts = []
+        for i, doc_id in enumerate(docs):
+            doc_stats = stats[doc_id]
+            indices.extend(vocab.setdefault(term, len(vocab)) for term in doc_stats)
+            counts.extend(doc_stats.values())
+            indptr[i + 1] = len(indices)
+        self.terms = list(vocab)
+        indices = np.asarray(indices, dtype=np.int64)
+        counts = np.asarray(counts, dtype=np.float64)
+        rows = np.repeat(np.arange(len(docs)), np.diff(indptr))
+
+        # DF - число документов с термином; IDF считается через math.log по
+        # различным значениям DF, чтобы совпадать с построчным расчетом
+        df = np.bincount(indices, minlength=len(self.terms))
+        idf_by_df = np.array([math.log((total_docs + 1) / (n + 1)) for n in range(df.max(initial=0) + 1)])
+        self.idf = idf_by_df[df]
+
+        totals = np.bincount(rows, weights=counts, minlength=len(docs))
+        tfidf = counts / totals[rows] * self.idf[indices]
+        keep = tfidf >= TFIDF_THRESHOLD
+        kept_indptr = np.zeros(len(docs) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows[keep], minlength=len(docs)), out=kept_indptr[1:])
+        self.matrix = sparse.csr_matrix((tfidf[keep], indices[keep], kept_indptr),
+                                        shape=(len(docs), len(self.terms)))
+
+    def write_text(self, out_dir):
+        """Файлы "термин idf tfidf" по документам, строки форматируются пачкой"""
+        # начало строки "термин idf " одинаково для всех документов
+        prefixes = [f"{term} {idf:.6f} " for term, idf in zip(self.terms, self.idf.tolist())]
+        indptr = self.matrix.indptr
+        values = [f"{value:.6f}\n" for value in self.matrix.data.tolist()]
+        indices = self.matrix.indices.tolist()
+        for i, doc_id in enumerate(self.docs):
+            start, end = indptr[i], indptr[i + 1]
+            with open(os.path.join(out_dir, f'{doc_id}.txt'), 'w', encoding='utf-8') as f:
+                f.write(''.join([prefixes[col] + value
+                                 for col, value in zip(indices[start:end], values[start:end])]))
+
+    def search_matrix(self):
+        """Матрица, vocab и имена файлов в том виде, в каком search.load_tfidf_data
+        читает записанные файлы: вес = idf * tfidf с округлением до 6 знаков,
+        документы по имени файла, двоеточие в конце леммы отброшено"""
+        filenames = [f'{doc_id}.txt' for doc_id in self.docs]
+        order = np.argsort(np.array(filenames, dtype=object), kind='stable')
+        matrix = self.matrix[order]
+        # idf округляется так же, как при записи текста
+        idf = np.array([float(f"{value:.6f}") for value in self.idf.tolist()])
+        weights = idf[matrix.indices] * np.round(matrix.data, 6)
+
+        vocab = {term.rstrip(':'): col for col, term in enumerate(self.terms)}
+        result = sparse.csr_matrix((weights.astype(np.float32), matrix.indices, matrix.indptr),
+                                   shape=(len(filenames), len(self.terms)))
+        return result, vocab, [filenames[i] for i in order]
+
+
+@timed('tfidf_write')
+def compute_tfidf(data=None, vectorized=True, text_output=True, index_dir=None, index_file=None):
+    """TF-IDF токенов и лемм.
+
+    В векторном режиме счетчики собираются в разреженные матрицы документы x
+    термины, и DF, IDF, TF и фильтр считаются операциями над массивами.
+    text_output - файлы tfidf_results/{tokens,lemmas}; index_dir - сразу
+    компилированный индекс (index_store) по леммам, без разбора этих файлов.
+    """
+    # 1. Загрузка данных (или готовые структуры той же формы, что у load_data)
+    token_index, lemma_index, token_stats, lemma_stats, all_docs = data or load_data()
+    total_docs = len(all_docs)
+    inc('tfidf_documents', total_docs)
+    if not vectorized:
+        return compute_tfidf_loops(token_index, lemma_index, token_stats, lemma_stats, all_docs)
+
+    token_weights = TfidfWeights(token_stats, [d for d in all_docs if d in token_stats], total_docs)
+    lemma_weights = TfidfWeights(lemma_stats, [d for d in all_docs if d in lemma_stats], total_docs)
+    if text_output:
+        token_weights.write_text(TOKENS_OUTPUT)
+        lemma_weights.write_text(LEMMAS_OUTPUT)
+    if index_dir:
+        from index_store import INDEX_FILE, save_vector_index
+        save_vector_index(index_dir, *lemma_weights.search_matrix(), index_file or INDEX_FILE)
+    return token_weights, lemma_weights
+
+
+def compute_tfidf_loops(token_index, lemma_index, token_stats, lemma_stats, all_docs):
+    """Построчный расчет на словарях (прежняя реализация, для сравнения)"""
     total_docs = len(all_docs)
 
     # 2. Расчет IDF с защитой от нулей
@@ -98,7 +199,29 @@ def compute_tfidf():
                         f.write(f"{lemma} {idf:.6f} {tfidf:.6f}\n")
 
 
-if __name__ == "__main__":
+def main():
+    parser = argparse.ArgumentParser(description="Расчет TF-IDF токенов и лемм")
+    parser.add_argument('--loops', action='store_true',
+                        help="построчный расчет на словарях вместо матричного")
+    parser.add_argument('--no-text', action='store_true', help="не записывать текстовые файлы")
+    parser.add_argument('--index-dir', default=None,
+                        help="записать компилированный индекс по леммам в эту папку")
+    args = parser.parse_args()
+    if args.loops and (args.no_text or args.index_dir):
+        parser.error("--no-text и --index-dir доступны только в матричном режиме")
+
     print("Запуск расчета TF-IDF с раздельными папками...")
-    compute_tfidf()
-    print(f"Результаты сохранены:\n- Токены: {TOKENS_OUTPUT}\n- Леммы: {LEMMAS_OUTPUT}")
\ No newline at end of file
+    compute_tfidf(vectorized=not args.loops, text_output=not args.no_text, index_dir=args.index_dir)
+    if not args.no_text:
+        print(f"Результаты сохранены:\n- Токены: {TOKENS_OUTPUT}\n- Леммы: {LEMMAS_OUTPUT}")
+    if args.index_dir:
+        print(f"Компилированный индекс сохранен в: {args.index_dir}")
+        # LSA-индекс, собранный по этой папке, иначе отстал бы от новой версии
+        from lsa import LSA_DIR, refresh_lsa_index
+        if refresh_lsa_index(args.index_dir):
+            print(f"LSA-индекс пересобран: {LSA_DIR}")
+    print_summary()
+
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file